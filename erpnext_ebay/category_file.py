@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""Compact binary file of the eBay categories and resolved features.
+
+The file is generated from the SQL caches after each category or features
+build, and memory-mapped read-only at runtime. All workers on a server
+share the same pages through the page cache, so lookups need no SQL and
+almost no per-process memory.
+
+File layout (little-endian):
+    header        HEADER
+    categories    n_categories RECORDs, in breadth-first order, so the
+                  children of each category are contiguous
+    id index      n_categories ID_INDEX entries, sorted by CategoryID
+    feature sets  n_feature_sets STRING_REF entries (JSON features)
+    strings       UTF-8 string table referenced by (offset, length)
+
+A new file is written to a temporary file and renamed into place; open
+files keep the old data until they are reopened.
+"""
+
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+
+import frappe
+
+from .ebay_get_requests import ebay_logger
+
+MAGIC = b'ERPEBCAT'
+FORMAT_VERSION = 1
+FILE_NAME = 'erpnext_ebay.categories.bin'
+
+# magic, format version, n_categories, n_feature_sets, categories offset,
+# id index offset, feature sets offset, strings offset, CategoryVersion
+# (offset, length), features CategoryVersion (offset, length)
+HEADER = struct.Struct('<8sIIIQQQQIIII')
+# CategoryID, parent index, first child index, number of children, name
+# (offset, length), feature set (NO_INDEX if none), level, flags
+RECORD = struct.Struct('<QIIIIIIHBx')
+# CategoryID, record index
+ID_INDEX = struct.Struct('<QI')
+# offset, length
+STRING_REF = struct.Struct('<II')
+
+NO_INDEX = 0xFFFFFFFF
+
+FLAG_LEAF = 1
+FLAG_EXPIRED = 2
+FLAG_VIRTUAL = 4
+
+CategoryRecord = collections.namedtuple(
+    'CategoryRecord', ('category_id', 'name', 'parent_id', 'level', 'leaf',
+                       'expired', 'virtual'))
+
+# Open category files in this process, by site
+_category_files = {}
+_category_files_lock = threading.Lock()
+
+
+def get_file_path():
+    """Return the path of the category file for the current site."""
+    return os.path.join(frappe.utils.get_site_path(), FILE_NAME)
+
+
+def get_cache_versions():
+    """Return the CategoryVersions of the categories cache and of the
+    resolved features cache ('' if there is no features cache).
+    """
+    categories_version = frappe.db.sql("""
+        SELECT CategoryVersion FROM eBay_categories_info;
+        """)[0][0]
+    features_version = ''
+    if 'eBay_features_resolved' in frappe.db.get_tables():
+        features_version = frappe.db.sql("""
+            SELECT CategoryVersion FROM eBay_features_sets LIMIT 1;
+            """)
+        features_version = features_version[0][0] if features_version else ''
+    return categories_version, features_version
+
+
+class StringTable():
+    """Builder for the string table of a category file."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, value):
+        """Add a string and return its (offset, length)."""
+        encoded = value.encode('utf-8')
+        offset = len(self.data)
+        self.data.extend(encoded)
+        return offset, len(encoded)
+
+
+def write_category_file():
+    """Write the category file for the current site from the categories
+    cache and (if present) the resolved features cache.
+    """
+    tables_list = frappe.db.get_tables()
+    categories_version, features_version = get_cache_versions()
+    cats = frappe.db.sql("""
+        SELECT CategoryID, CategoryName, CategoryLevel, CategoryParentID,
+            LeafCategory, Expired, Virtual
+            FROM eBay_categories_hierarchy;
+        """, as_dict=True)
+    feature_sets = []
+    category_sets = {}
+    if 'eBay_features_resolved' in tables_list:
+        set_records = frappe.db.sql("""
+            SELECT FeatureSetID, Features
+                FROM eBay_features_sets
+                ORDER BY FeatureSetID;
+            """)
+        set_index = {}
+        for set_id, features in set_records:
+            set_index[set_id] = len(feature_sets)
+            feature_sets.append(features)
+        category_sets = {
+            category_id: set_index[set_id]
+            for category_id, set_id in frappe.db.sql("""
+                SELECT CategoryID, FeatureSetID
+                    FROM eBay_features_resolved;
+                """)
+        }
+
+    # Order categories breadth-first, with each category's children
+    # together and sorted by name
+    children = collections.defaultdict(list)
+    for cat in cats:
+        if cat.CategoryParentID is not None:
+            children[cat.CategoryParentID].append(cat)
+    root, = [x for x in cats if x.CategoryParentID is None]
+    ordered = [root]
+    first_child = {}
+    for cat in ordered:
+        cat_children = sorted(children[cat.CategoryID],
+                              key=lambda x: x.CategoryName)
+        first_child[cat.CategoryID] = len(ordered)
+        ordered.extend(cat_children)
+    index = {cat.CategoryID: i for i, cat in enumerate(ordered)}
+
+    strings = StringTable()
+    records = bytearray()
+    for cat in ordered:
+        flags = (
+            (FLAG_LEAF if cat.LeafCategory else 0)
+            | (FLAG_EXPIRED if cat.Expired else 0)
+            | (FLAG_VIRTUAL if cat.Virtual else 0)
+        )
+        records += RECORD.pack(
+            int(cat.CategoryID),
+            index.get(cat.CategoryParentID, NO_INDEX),
+            first_child[cat.CategoryID],
+            len(children[cat.CategoryID]),
+            *strings.add(cat.CategoryName),
+            category_sets.get(cat.CategoryID, NO_INDEX),
+            int(cat.CategoryLevel),
+            flags)
+    id_index = bytearray()
+    for category_id, i in sorted((int(x), i) for x, i in index.items()):
+        id_index += ID_INDEX.pack(category_id, i)
+    sets = bytearray()
+    for features in feature_sets:
+        sets += STRING_REF.pack(*strings.add(features))
+    version_ref = strings.add(categories_version)
+    features_version_ref = strings.add(features_version)
+
+    records_offset = HEADER.size
+    id_index_offset = records_offset + len(records)
+    sets_offset = id_index_offset + len(id_index)
+    strings_offset = sets_offset + len(sets)
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, len(ordered), len(feature_sets),
+        records_offset, id_index_offset, sets_offset, strings_offset,
+        *version_ref, *features_version_ref)
+
+    file_path = get_file_path()
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            for part in (header, records, id_index, sets, strings.data):
+                f.write(part)
+        os.replace(temp_path, file_path)
+    except Exception:
+        # Don't leave a partial temporary file behind
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    frappe.local.ebay_category_file = None
+
+
+class CategoryFile():
+    """Read-only memory-mapped category file."""
+
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, format_version, self.n_categories, self.n_feature_sets,
+         self.records_offset, self.id_index_offset, self.sets_offset,
+         self.strings_offset, *version_refs) = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported eBay category file {file_path}')
+        self.categories_version = self._string(*version_refs[:2])
+        self.features_version = self._string(*version_refs[2:])
+
+    def __len__(self):
+        return self.n_categories
+
+    def close(self):
+        """Unmap the file."""
+        self.mmap.close()
+
+    def is_current(self, stat):
+        """Return True if this is the file with the given os.stat result."""
+        return (self.stat.st_ino, self.stat.st_mtime_ns) == (
+            stat.st_ino, stat.st_mtime_ns)
+
+    def matches_versions(self, versions):
+        """Return True if this file was written from caches with the
+        given (categories, features) CategoryVersions.
+        """
+        return (self.categories_version, self.features_version) == versions
+
+    def _string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.mmap[start:start+length].decode('utf-8')
+
+    def _record(self, i):
+        return RECORD.unpack_from(self.mmap,
+                                  self.records_offset + i * RECORD.size)
+
+    def _find(self, category_id):
+        """Return the record index of a CategoryID (binary search)."""
+        try:
+            category_id = int(category_id)
+        except ValueError:
+            raise ValueError(f'eBay category ID {category_id} not found')
+        lo, hi = 0, self.n_categories
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id, i = ID_INDEX.unpack_from(
+                self.mmap, self.id_index_offset + mid * ID_INDEX.size)
+            if mid_id < category_id:
+                lo = mid + 1
+            elif mid_id > category_id:
+                hi = mid
+            else:
+                return i
+        raise ValueError(f'eBay category ID {category_id} not found')
+
+    def _category(self, i):
+        (category_id, parent, first_child, n_children, name_offset,
+         name_length, feature_set, level, flags) = self._record(i)
+        parent_id = (None if parent == NO_INDEX
+                     else str(self._record(parent)[0]))
+        return CategoryRecord(
+            str(category_id), self._string(name_offset, name_length),
+            parent_id, level, bool(flags & FLAG_LEAF),
+            bool(flags & FLAG_EXPIRED), bool(flags & FLAG_VIRTUAL))
+
+    def __getitem__(self, category_id):
+        return self._category(self._find(category_id))
+
+    def __contains__(self, category_id):
+        try:
+            self._find(category_id)
+        except ValueError:
+            return False
+        return True
+
+    def children(self, category_id):
+        """Return the CategoryRecords of the children of a category."""
+        record = self._record(self._find(category_id))
+        first_child, n_children = record[2:4]
+        return [self._category(i)
+                for i in range(first_child, first_child + n_children)]
+
+    def _stack(self, category_id):
+        """Yield the records from a category up to its top-level
+        category (excluding the root).
+        """
+        record = self._record(self._find(category_id))
+        while record[1] != NO_INDEX:
+            yield record
+            record = self._record(record[1])
+
+    def get_category_stack(self, category_id):
+        """Return the CategoryIDs from a category up to its top-level
+        category.
+        """
+        return [str(x[0]) for x in self._stack(category_id)]
+
+    def get_category_name_stack(self, category_id):
+        """Return the CategoryNames from a category up to its top-level
+        category.
+        """
+        return [self._string(x[4], x[5]) for x in self._stack(category_id)]
+
+    def get_category_features(self, category_id):
+        """Return the resolved features of a leaf category."""
+        feature_set = self._record(self._find(category_id))[6]
+        if feature_set == NO_INDEX:
+            raise ValueError(
+                f'eBay leaf category ID {category_id} has no resolved features')
+        offset, length = STRING_REF.unpack_from(
+            self.mmap, self.sets_offset + feature_set * STRING_REF.size)
+        return json.loads(self._string(offset, length))
+
+
+def get_category_file():
+    """Return the CategoryFile for the current site, writing the file if
+    it does not exist or is out of date.
+
+    Open files are kept for the life of the process (replaced files are
+    unmapped). The file is normally written by the cache build jobs. Once
+    per request, the file is checked to see if it has been replaced, and
+    its versions are compared with the SQL caches; if these differ (e.g.
+    the caches were rebuilt on another host of the bench) the file is
+    rewritten here, which is logged.
+    """
+    site = frappe.local.site
+    category_file = _category_files.get(site)
+    if category_file and getattr(frappe.local, 'ebay_category_file', None):
+        return category_file
+    file_path = get_file_path()
+    versions = get_cache_versions()
+    with _category_files_lock:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            ebay_logger().warning(
+                f'eBay category file {file_path} missing; writing it')
+            write_category_file()
+            stat = os.stat(file_path)
+        old_file = _category_files.get(site)
+        category_file = old_file
+        if category_file is None or not category_file.is_current(stat):
+            category_file = CategoryFile(file_path)
+        if not category_file.matches_versions(versions):
+            ebay_logger().warning(
+                f'eBay category file {file_path} is out of date '
+                + f'(versions {category_file.categories_version!r}, '
+                + f'{category_file.features_version!r}; caches '
+                + f'{versions[0]!r}, {versions[1]!r}); rewriting it')
+            write_category_file()
+            if category_file is not old_file:
+                category_file.close()
+            category_file = CategoryFile(file_path)
+        if old_file is not None and old_file is not category_file:
+            old_file.close()
+        _category_files[site] = category_file
+    frappe.local.ebay_category_file = True
+    return category_file
@@ -3,6 +3,7 @@ run from: premium report, garagsale_xml
 """
 
 import datetime
+import time
 
 import frappe
 
@@ -10,11 +11,32 @@ from ebaysdk.exception import ConnectionError
 from ebaysdk.trading import Connection as Trading
 
 from .ebay_constants import EBAY_TRANSACTION_SITE_IDS, HOME_SITE_ID
-from .ebay_get_requests import get_seller_list, PATH_TO_YAML
+from .ebay_get_requests import get_seller_list
+from .utils.bulk_sql import bulk_insert
+from .utils.redis_lock import LeaseLock
 
 from erpnext_ebay.erpnext_ebay.doctype.ebay_manager_settings.ebay_manager_settings import (
     use_sandbox)
 
+# Columns of the zeBayListings table
+LISTING_FIELDS = ('sku', 'ebay_id', 'qty', 'price', 'site')
+
+# Number of listing snapshots retained in zeBayListingsHistory
+SNAPSHOTS_KEPT = 5
+
+# Redis lease lock held while updating zeBayListings. The lease (seconds)
+# must exceed the longest update; a crashed update releases it after this.
+UPDATE_LOCK_NAME = 'zeBayListings'
+UPDATE_LOCK_LEASE = 900
+# Time (seconds) to wait for an update running elsewhere, and poll interval
+UPDATE_WAIT_TIMEOUT = 900
+UPDATE_POLL_INTERVAL = 2
+
+# Cache key for the time of the last completed update
+LAST_UPDATE_KEY = 'erpnext_ebay.last_update'
+# Default maximum age (seconds) of listings data that is reused
+DEFAULT_MAX_AGE = 60
+
 OUTPUT_SELECTOR = [
     'ItemArray.Item.SKU',
     'ItemArray.Item.Quantity',
@@ -22,10 +44,227 @@ OUTPUT_SELECTOR = [
     'ItemArray.Item.SellingStatus.QuantitySold']
 
 
+def create_listings_table(table):
+    """Create a listings table (zeBayListings or a shadow table) if it
+    does not exist. Causes an implicit commit.
+    """
+    frappe.db.sql(f"""
+        CREATE TABLE IF NOT EXISTS `{table}` (
+            sku VARCHAR(140) NOT NULL,
+            ebay_id VARCHAR(38),
+            qty INTEGER,
+            price DECIMAL(18,6),
+            site VARCHAR(40),
+            snapshot_id BIGINT,
+            INDEX sku_site (sku, site),
+            INDEX ebay_id (ebay_id)
+            ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+        """)
+
+
+def ensure_listings_table(print=print):
+    """Create the zeBayListings table and the snapshot tables if they do
+    not exist.
+
+    Note that this causes an implicit commit if any table is created.
+    """
+    if not frappe.db.sql("""SHOW TABLES LIKE 'zeBayListings';"""):
+        print('Setting up zeBayListings table')
+        create_listings_table('zeBayListings')
+    frappe.db.sql("""
+        CREATE TABLE IF NOT EXISTS `zeBayListingSnapshots` (
+            snapshot_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            created DATETIME(6) NOT NULL,
+            n_listings INTEGER NOT NULL
+            );
+        """)
+    frappe.db.sql("""
+        CREATE TABLE IF NOT EXISTS `zeBayListingsHistory` (
+            snapshot_id BIGINT NOT NULL,
+            sku VARCHAR(140) NOT NULL,
+            ebay_id VARCHAR(38),
+            qty INTEGER,
+            price DECIMAL(18,6),
+            site VARCHAR(40),
+            INDEX snapshot_ebay_id (snapshot_id, ebay_id)
+            ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+        """)
+
+
+def publish_listings(records):
+    """Publish a new snapshot of listings from records, a list of
+    (sku, ebay_id, qty, price, site) tuples. Returns the snapshot ID.
+
+    The records are written into a shadow table with multi-row inserts,
+    which then atomically replaces zeBayListings with RENAME TABLE, so
+    readers never see a partial or empty table. Once published, the
+    snapshot is also kept in zeBayListingsHistory, which retains the last
+    SNAPSHOTS_KEPT snapshots. If publishing fails, the snapshot is
+    removed again. Causes implicit commits.
+    """
+    # Create the shadow table before writing anything, so the DDL
+    # doesn't lead to an implicit commit of pending writes
+    frappe.db.sql("""DROP TABLE IF EXISTS `zeBayListings_new`;""")
+    create_listings_table('zeBayListings_new')
+
+    frappe.db.sql("""
+        INSERT INTO `zeBayListingSnapshots` (created, n_listings)
+            VALUES (%s, %s);
+        """, (frappe.utils.now_datetime(), len(records)))
+    snapshot_id = frappe.db.sql("""SELECT LAST_INSERT_ID();""")[0][0]
+
+    try:
+        bulk_insert('zeBayListings_new', LISTING_FIELDS + ('snapshot_id',),
+                    [record + (snapshot_id,) for record in records])
+        frappe.db.commit()
+
+        frappe.db.sql("""DROP TABLE IF EXISTS `zeBayListings_old`;""")
+        frappe.db.sql("""
+            RENAME TABLE `zeBayListings` TO `zeBayListings_old`,
+                `zeBayListings_new` TO `zeBayListings`;
+            """)
+        frappe.db.sql("""DROP TABLE `zeBayListings_old`;""")
+
+        # Keep the published snapshot in the history
+        columns = ', '.join(('snapshot_id',) + LISTING_FIELDS)
+        frappe.db.sql(f"""
+            INSERT INTO `zeBayListingsHistory` ({columns})
+                SELECT {columns} FROM `zeBayListings`;
+            """)
+        prune_snapshots()
+        frappe.db.commit()
+    except Exception:
+        # Don't leave a snapshot that was not published (or has no
+        # history)
+        frappe.db.rollback()
+        frappe.db.sql("""
+            DELETE FROM `zeBayListingsHistory` WHERE snapshot_id = %s;
+            """, (snapshot_id,))
+        frappe.db.sql("""
+            DELETE FROM `zeBayListingSnapshots` WHERE snapshot_id = %s;
+            """, (snapshot_id,))
+        frappe.db.commit()
+        raise
+
+    return snapshot_id
+
+
+def prune_snapshots(keep=SNAPSHOTS_KEPT):
+    """Delete all but the last keep snapshots (does not commit)."""
+    cutoff = frappe.db.sql("""
+        SELECT snapshot_id FROM `zeBayListingSnapshots`
+            ORDER BY snapshot_id DESC
+            LIMIT 1 OFFSET %(offset)s;
+        """, {'offset': keep - 1})
+    if not cutoff:
+        return
+    cutoff = cutoff[0][0]
+    frappe.db.sql("""
+        DELETE FROM `zeBayListingsHistory` WHERE snapshot_id < %s;
+        """, (cutoff,))
+    frappe.db.sql("""
+        DELETE FROM `zeBayListingSnapshots` WHERE snapshot_id < %s;
+        """, (cutoff,))
+
+
+def get_listing_snapshots():
+    """Return the retained listing snapshots, newest first."""
+    return frappe.db.sql("""
+        SELECT snapshot_id, created, n_listings
+            FROM `zeBayListingSnapshots`
+            ORDER BY snapshot_id DESC;
+        """, as_dict=True)
+
+
+@frappe.whitelist()
+def get_listings_delta(from_snapshot, to_snapshot=None):
+    """Return the listings added, removed and changed (by eBay ItemID)
+    between two retained snapshots. If to_snapshot is not given, the
+    latest snapshot is used.
+
+    Returns a dict with lists of listing dicts under 'added' and
+    'removed', and under 'changed' a list of dicts with the new values
+    and the old values (as old_qty, old_price etc.).
+    """
+
+    # This is a whitelisted function; check permissions.
+    if not frappe.has_permission('eBay Manager'):
+        frappe.throw('You do not have permission to access the eBay Manager',
+                     frappe.PermissionError)
+
+    snapshot_ids = {x.snapshot_id for x in get_listing_snapshots()}
+    from_snapshot = int(from_snapshot)
+    if to_snapshot is None:
+        to_snapshot = max(snapshot_ids, default=None)
+    else:
+        to_snapshot = int(to_snapshot)
+    for snapshot_id in (from_snapshot, to_snapshot):
+        if snapshot_id not in snapshot_ids:
+            frappe.throw(f'Listing snapshot {snapshot_id} is not available')
+
+    values = {'from_snapshot': from_snapshot, 'to_snapshot': to_snapshot}
+    fields = ', '.join(f'a.{x}' for x in LISTING_FIELDS)
+
+    def one_sided(snapshot_a, snapshot_b):
+        # Listings in snapshot_a but not snapshot_b
+        return frappe.db.sql(f"""
+            SELECT {fields}
+                FROM `zeBayListingsHistory` AS a
+                LEFT JOIN `zeBayListingsHistory` AS b
+                    ON b.snapshot_id = %({snapshot_b})s
+                        AND b.ebay_id = a.ebay_id
+                WHERE a.snapshot_id = %({snapshot_a})s
+                    AND b.ebay_id IS NULL;
+            """, values, as_dict=True)
+
+    old_fields = ', '.join(f'b.{x} AS old_{x}' for x in LISTING_FIELDS)
+    changed_condition = ' OR '.join(
+        f'NOT (a.{x} <=> b.{x})' for x in LISTING_FIELDS)
+    changed = frappe.db.sql(f"""
+        SELECT {fields}, {old_fields}
+            FROM `zeBayListingsHistory` AS a
+            JOIN `zeBayListingsHistory` AS b
+                ON b.snapshot_id = %(from_snapshot)s
+                    AND b.ebay_id = a.ebay_id
+            WHERE a.snapshot_id = %(to_snapshot)s
+                AND ({changed_condition});
+        """, values, as_dict=True)
+
+    return {
+        'from_snapshot': from_snapshot,
+        'to_snapshot': to_snapshot,
+        'added': one_sided('to_snapshot', 'from_snapshot'),
+        'removed': one_sided('from_snapshot', 'to_snapshot'),
+        'changed': changed
+    }
+
+
+def get_last_update():
+    """Return the time of the last completed update (or None).
+
+    This is read from Redis every time, not from the request-local cache,
+    so that updates by other workers are seen.
+    """
+    cache = frappe.cache()
+    frappe.local.cache.pop(cache.make_key(LAST_UPDATE_KEY), None)
+    return cache.get_value(LAST_UPDATE_KEY, expires=True)
+
+
+def listings_are_fresh(max_age):
+    """Return True if the last update completed less than max_age seconds
+    ago.
+    """
+    last_update = get_last_update()
+    if not last_update:
+        return False
+    seconds_ago = (datetime.datetime.now() - last_update).total_seconds()
+    return seconds_ago < max_age
+
+
 @frappe.whitelist()
 def generate_active_ebay_data(print=print, multiple_error_sites=None,
                               extra_output_selector=None,
-                              multiple_skip_only=False):
+                              multiple_skip_only=False, max_age=None):
     """Get all the active eBay listings for the selected eBay site
     and save them to the temporary data table.
 
@@ -33,7 +272,18 @@ def generate_active_ebay_data(print=print, multiple_error_sites=None,
     eBay sites are considered an error. If multiple_skip_only is True,
     the item is skipped but no error is returned (only a warning).
 
+    If the listings were updated less than max_age seconds ago (default
+    DEFAULT_MAX_AGE, or zero if extra_output_selector is supplied), they
+    are not pulled again and None is returned. If another update is in
+    progress, this waits for it and reuses its result (unless
+    extra_output_selector is supplied, as the extra fields are only
+    returned to the caller that requested them). In a web request this
+    does not wait: it returns None (or, with extra_output_selector,
+    throws) if another update is in progress.
+
     Data in the table will not be over-written in the event of error.
+    The table is replaced atomically, so readers never block or see
+    partial data.
     """
 
     # This is a whitelisted function; check permissions.
@@ -41,127 +291,136 @@ def generate_active_ebay_data(print=print, multiple_error_sites=None,
         frappe.throw('You do not have permission to access the eBay Manager',
                      frappe.PermissionError)
 
-    if extra_output_selector:
-        output_selector = OUTPUT_SELECTOR + extra_output_selector
-    else:
-        output_selector = OUTPUT_SELECTOR
-
-    if not frappe.db.sql("""SHOW TABLES LIKE 'zeBayListings';"""):
-        print('Setting up zeBayListings table')
-        # Set up the zeBayListings table if it does not exist
+    if max_age is None:
+        max_age = 0 if extra_output_selector else DEFAULT_MAX_AGE
+    max_age = float(max_age)
 
-        frappe.db.sql("""
-        CREATE TABLE IF NOT EXISTS `zeBayListings` (
-            sku VARCHAR(20) NOT NULL,
-            ebay_id VARCHAR(38),
-            qty INTEGER,
-            price DECIMAL(18,6),
-            site VARCHAR(40)
-            );
-        """, auto_commit=True)
+    if listings_are_fresh(max_age):
+        print(f'Last update was completed less than {max_age}s ago.')
+        return
 
-    # Before we get the table lock, get the sandbox value (we can't access
-    # any other table once we have a table lock, unless we lock that table
-    # as well)
-    force_sandbox_value = use_sandbox('GetSellerList')
+    ensure_listings_table(print=print)
 
-    print('Getting table lock')
-    # Try and get table lock. If we fail (due to timeout), throw an error
-    # message. Unlock the tables in any circumstance except success.
-    success = False
+    print('Getting update lock')
+    # Only one update may run at a time, across all workers. Readers of
+    # zeBayListings are never blocked.
+    lock = LeaseLock(UPDATE_LOCK_NAME, UPDATE_LOCK_LEASE)
+    last_update = get_last_update()
+    if getattr(frappe.local, 'request', None):
+        # Don't hold a web worker waiting for another update
+        wait_timeout = 0
+    else:
+        wait_timeout = UPDATE_WAIT_TIMEOUT
+    wait_until = time.monotonic() + wait_timeout
+    while not lock.acquire():
+        if time.monotonic() >= wait_until:
+            if wait_timeout or extra_output_selector:
+                frappe.throw(
+                    'Unable to lock eBay update; may already be running.')
+            frappe.msgprint('An eBay listings update is already running; '
+                            + 'the listings will be updated when it '
+                            + 'finishes.')
+            return
+        time.sleep(UPDATE_POLL_INTERVAL)
+        if not extra_output_selector and get_last_update() != last_update:
+            print('Using data from an update completed while waiting.')
+            return
+
+    # Now that we have the lock, make sure we release it in the event of
+    # an exception.
     try:
-        frappe.db.sql("""LOCK TABLES `zeBayListings` WRITE WAIT 60;""")
-        success = True
-    except frappe.db.InternalError:
-        frappe.db.sql("""UNLOCK TABLES;""")
-        frappe.throw('Unable to lock eBay update; may already be running.')
+        # Another update may have completed before we got the lock
+        if listings_are_fresh(max_age):
+            print(f'Last update was completed less than {max_age}s ago.')
+            return
+        return pull_active_ebay_data(
+            lock, print=print, multiple_error_sites=multiple_error_sites,
+            output_selector=output_selector_for(extra_output_selector),
+            multiple_skip_only=multiple_skip_only)
     finally:
-        if not success:
-            frappe.db.sql("""UNLOCK TABLES;""")
+        lock.release()
 
-    # Now that we have a table lock, make sure we unlock it in the event of
-    # an exception.
-    try:
 
-        # If the data has been pulled down in the last 60 seconds, don't
-        # update it again, unless we have been passed extra_output_selector
-        if not extra_output_selector:
-            last_update = frappe.cache().get_value('erpnext_ebay.last_update')
-            if last_update:
-                seconds_ago = (
-                    (datetime.datetime.now() - last_update).total_seconds()
-                )
-                if seconds_ago < 60:
-                    print('Last update was completed less than 60s ago.')
-                    # Table will be unlocked by finally clause
-                    return
-
-        print('Getting data from eBay via GetSellerList call')
-        # Get data from GetSellerList
-        listings = get_seller_list(site_id=0,  # Use US site
-                                   output_selector=output_selector,
-                                   granularity_level='Fine',
-                                   force_sandbox_value=force_sandbox_value,
-                                   print=print)
-
-        multiple_check = set()
-        multiple_error = set()
-        multiple_warnings = set()
-
-        print('Updating table and checking data')
-        records = []
-        for item in listings:
-            # Loop over each eBay item on each site
-            ebay_id = item['ItemID']
-            original_qty = int(item['Quantity'])
-            qty_sold = int(item['SellingStatus']['QuantitySold'])
-            sku = item.get('SKU', '')
-            price = float(item['SellingStatus']['CurrentPrice']['value'])
-            site = item['Site']
-
-            if sku:
-                # Check that this item appears only once
-                mult_tuple = (sku, site)
-                if mult_tuple in multiple_check:
-                    if (not multiple_error_sites
-                            or (site in multiple_error_sites)):
-                        multiple_error.add(mult_tuple)
-                    else:
-                        multiple_warnings.add(mult_tuple)
-                    continue
-                multiple_check.add(mult_tuple)
-
-            qty = original_qty - qty_sold
-            records.append((sku, ebay_id, qty, price, site))
-
-        msgs = []
-        if multiple_error:
-            for sku, site in multiple_error:
-                msgs.append(f'The item {sku} has multiple ebay listings on the '
-                            + f'eBay site {site}!')
-            if not multiple_skip_only:
-                frappe.throw('\n'.join(msgs))
-        if multiple_warnings:
-            for sku, site in multiple_warnings:
-                msgs.append(f'The item {sku} has multiple ebay listings on the '
-                            + f'eBay site {site}!')
-        if msgs:
-            frappe.msgprint('\n'.join(msgs))
-
-        # Truncate table now we have good data
-        frappe.db.sql("""TRUNCATE TABLE `zeBayListings`;""", auto_commit=True)
-
-        for record in records:
-            # Insert eBay listings into the zeBayListings temporary table"""
-            frappe.db.sql("""
-                INSERT INTO `zeBayListings`
-                    VALUES (%s, %s, %s, %s, %s);
-                """, record, auto_commit=True)
-
-        frappe.cache().set_value('erpnext_ebay.last_update',
-                                 datetime.datetime.now())
-    finally:
-        frappe.db.sql("""UNLOCK TABLES;""")
+def output_selector_for(extra_output_selector):
+    """Return the GetSellerList output selector, with any extra fields."""
+    if extra_output_selector:
+        return OUTPUT_SELECTOR + extra_output_selector
+    return OUTPUT_SELECTOR
+
+
+def pull_active_ebay_data(lock, print, multiple_error_sites,
+                          output_selector, multiple_skip_only):
+    """Pull the active listings from eBay and publish them to the
+    zeBayListings table. The update lock must be held; its lease is
+    renewed after each page of listings, and the update is abandoned if
+    the lock has been lost.
+    """
+    force_sandbox_value = use_sandbox('GetSellerList')
+
+    def renew_lock():
+        if not lock.extend():
+            frappe.throw('Lost the eBay update lock; update abandoned.')
+
+    print('Getting data from eBay via GetSellerList call')
+    # Get data from GetSellerList
+    listings = get_seller_list(site_id=0,  # Use US site
+                               output_selector=output_selector,
+                               granularity_level='Fine',
+                               force_sandbox_value=force_sandbox_value,
+                               print=print, page_callback=renew_lock)
+
+    multiple_check = set()
+    multiple_error = set()
+    multiple_warnings = set()
+
+    print('Updating table and checking data')
+    records = []
+    for item in listings:
+        # Loop over each eBay item on each site
+        ebay_id = item['ItemID']
+        original_qty = int(item['Quantity'])
+        qty_sold = int(item['SellingStatus']['QuantitySold'])
+        sku = item.get('SKU', '')
+        price = float(item['SellingStatus']['CurrentPrice']['value'])
+        site = item['Site']
+
+        if sku:
+            # Check that this item appears only once
+            mult_tuple = (sku, site)
+            if mult_tuple in multiple_check:
+                if (not multiple_error_sites
+                        or (site in multiple_error_sites)):
+                    multiple_error.add(mult_tuple)
+                else:
+                    multiple_warnings.add(mult_tuple)
+                continue
+            multiple_check.add(mult_tuple)
+
+        qty = original_qty - qty_sold
+        records.append((sku, ebay_id, qty, price, site))
+
+    msgs = []
+    if multiple_error:
+        for sku, site in multiple_error:
+            msgs.append(f'The item {sku} has multiple ebay listings on the '
+                        + f'eBay site {site}!')
+        if not multiple_skip_only:
+            frappe.throw('\n'.join(msgs))
+    if multiple_warnings:
+        for sku, site in multiple_warnings:
+            msgs.append(f'The item {sku} has multiple ebay listings on the '
+                        + f'eBay site {site}!')
+    if msgs:
+        frappe.msgprint('\n'.join(msgs))
+
+    # Publish the new data now we have good data
+    print('Writing eBay listings')
+    # Only publish if we still hold the lock (this also renews the lease
+    # for the publish)
+    renew_lock()
+    publish_listings(records)
+
+    frappe.cache().set_value(LAST_UPDATE_KEY, datetime.datetime.now())
 
     return listings
 
@@ -172,8 +431,12 @@ def generate_active_ebay_data(print=print, multiple_error_sites=None,
 
 
 @frappe.whitelist()
-def update_ebay_data(multiple_error_sites=None, multiple_skip_only=False):
-    """Get eBay data, set eBay IDs and set eBay first listed dates."""
+def update_ebay_data(multiple_error_sites=None, multiple_skip_only=False,
+                     max_age=None):
+    """Get eBay data, set eBay IDs and set eBay first listed dates.
+
+    max_age is passed to generate_active_ebay_data.
+    """
 
     # This is a whitelisted function; check permissions.
     if not frappe.has_permission('eBay Manager'):
@@ -181,7 +444,8 @@ def update_ebay_data(multiple_error_sites=None, multiple_skip_only=False):
                      frappe.PermissionError)
 
     generate_active_ebay_data(multiple_error_sites=multiple_error_sites,
-                              multiple_skip_only=multiple_skip_only)
+                              multiple_skip_only=multiple_skip_only,
+                              max_age=max_age)
     sync_ebay_ids()
     set_on_sale_from_date()
     frappe.cache().set_value('erpnext_ebay.last_full_update',
@@ -224,7 +488,12 @@ def set_on_sale_from_date():
 
 
 def sync_ebay_ids(site_id=HOME_SITE_ID):
-    """Synchronize system eBay IDs from the temporary table"""
+    """Synchronize system eBay IDs from the temporary table.
+
+    The changes are applied with two set-based UPDATEs in one
+    transaction. Returns a list of (item_code, old ebay_id, new ebay_id)
+    for the changed Items.
+    """
 
     site_name = EBAY_TRANSACTION_SITE_IDS[site_id]
 
@@ -256,18 +525,44 @@ def sync_ebay_ids(site_id=HOME_SITE_ID):
             AND IFNULL(item.ebay_id, '') <> ''
         """, {'site_name': site_name}, as_dict=True)
 
+    changes = []
     for r in records:
         if r.live_ebay_id:
             if r.item_code:
                 # Item is live but eBay IDs don't match
-                # Update system with live version
-                set_item_ebay_id(r.item_code, r.live_ebay_id)
+                changes.append((r.item_code, r.dead_ebay_id, r.live_ebay_id))
             else:
                 # eBay item does not appear on system
                 frappe.msgprint(
                     'eBay item cannot be found in the system; '
                     + f'unable to record eBay id {r.live_ebay_id}')
-        else:
+        elif r.dead_ebay_id != 'Awaiting Garagesale':
             # No live eBay ID; clear any value on system
-            # (unless Awaiting Garagesale)
-            set_item_ebay_id(r.item_code, None)
+            changes.append((r.item_code, r.dead_ebay_id, None))
+
+    # Update system with live eBay IDs where they don't match
+    frappe.db.sql("""
+        UPDATE `tabItem` AS item
+            JOIN `zeBayListings` AS ebay
+                ON ebay.sku = item.item_code
+                    AND ebay.site = %(site_name)s
+            SET item.ebay_id = ebay.ebay_id
+            WHERE IFNULL(ebay.sku, '') <> ''
+                AND IFNULL(item.ebay_id, '') <> IFNULL(ebay.ebay_id, '');
+        """, {'site_name': site_name})
+
+    # Clear eBay IDs with no live listing (unless Awaiting Garagesale)
+    frappe.db.sql("""
+        UPDATE `tabItem` AS item
+            LEFT JOIN `zeBayListings` AS ebay
+                ON ebay.sku = item.item_code
+                    AND ebay.site = %(site_name)s
+            SET item.ebay_id = NULL
+            WHERE ebay.ebay_id IS NULL
+                AND IFNULL(item.ebay_id, '') <> ''
+                AND item.ebay_id <> 'Awaiting Garagesale';
+        """, {'site_name': site_name})
+
+    frappe.db.commit()
+
+    return changes
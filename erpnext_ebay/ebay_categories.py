@@ -5,18 +5,64 @@ import operator
 import os
 import pickle
 import collections
+import json
+import threading
+import time
+from collections.abc import Sequence
 
 import frappe
 from frappe import msgprint
 
+from .category_file import get_category_file, write_category_file
 from .ebay_get_requests import (
-    get_categories_versions, get_categories, get_features
+    clear_features_checkpoints, get_categories_versions, get_categories,
+    get_features
 )
 from .ebay_constants import *
+from .utils.bulk_sql import (
+    BATCH_SIZE, batches, bulk_delete, bulk_insert, fields_differ
+)
 
 
 USE_FEATURES = False
 
+# Recorded GetCategories result (in the site directory), for debugging
+CATEGORIES_FIXTURE = 'erpnext_ebay.categories.pkl'
+# Small sample GetCategories result (in the app), for benchmarks
+CATEGORIES_SAMPLE = os.path.join(
+    os.path.dirname(__file__), 'test_data', 'ebay_categories_sample.json')
+
+# Columns of the eBay_categories_info table
+CATEGORY_INFO_FIELDS = (
+    'Build', 'CategoryCount', 'CategoryVersion', 'MinimumReservePrice',
+    'ReduceReserveAllowed', 'ReservePriceAllowed', 'Timestamp', 'UpdateTime',
+    'Version')
+
+# Columns of the eBay_categories_hierarchy table
+CATEGORY_FIELDS = (
+    'CategoryID', 'CategoryName', 'CategoryLevel', 'CategoryParentID',
+    'LeafCategory', 'Virtual', 'Expired', 'AutoPayEnabled', 'B2BVATEnabled',
+    'BestOfferEnabled', 'LSD', 'ORPA', 'ORRA')
+PARENT_INDEX = CATEGORY_FIELDS.index('CategoryParentID')
+# Materialized path columns of the eBay_categories_hierarchy table
+CATEGORY_PATH_FIELDS = ('CategoryIDPath', 'CategoryNamePath')
+
+# Fields of Item Group eBay set from the categories cache
+IGE_FIELDS = ('ebay_category_id', 'ebay_category_name', 'ebay_category',
+              'ebay_expired', 'ebay_virtual')
+STANDARD_FIELDS = ('name', 'creation', 'modified', 'owner', 'modified_by',
+                   'docstatus')
+
+# Days for which processed categories changelog rows are kept
+CHANGELOG_DAYS_KEPT = 90
+
+# Separator of CategoryIDs in CategoryIDPath
+ID_PATH_SEPARATOR = ','
+
+# Category trees loaded in this process, by site
+_category_trees = {}
+_category_trees_lock = threading.Lock()
+
 
 def _infinite_strings(key=None):
     """Returns a function which returns a float: either 'inf' for a
@@ -93,12 +139,14 @@ def category_sync(force_override_categories=False,
     # Do we need to update the cache?
     update_categories = force_override_categories or not categories_ok
     update_features = force_override_features or not features_ok
-    # Update the cache if required
-    ensure_updated_cache(update_categories, update_features)
+    # Update the cache if required; the categories are only rebuilt from
+    # scratch if we are forcing an override
+    ensure_updated_cache(update_categories, update_features,
+                         incremental=not force_override_categories)
     # Update the Item Group eBay categories if required.
     if update_categories:
         # We only wipe the tables if we are forcing an override
-        # otherwise we just update the existing entries.
+        # otherwise we just update the entries for changed categories.
         create_item_group_ebay(force_override_categories)
 
 
@@ -109,8 +157,8 @@ def check_cache_versions():
     tables_list = frappe.db.get_tables()
 
     # Check categories cache
-    if 'eBay_categories_info' in tables_list:
-        # Table exists
+    if categories_cache_exists():
+        # Tables exist and are up to date
         categories_cache_version = frappe.db.sql(
             """SELECT CategoryVersion FROM eBay_categories_info""")
         if categories_cache_version:
@@ -141,10 +189,23 @@ def check_cache_versions():
             features_version == features_cache_version)
 
 
-def ensure_updated_cache(update_categories=False, update_features=False):
+def hierarchy_has_paths():
+    """Return True if the eBay_categories_hierarchy table has the
+    materialized path columns (caches built before these were added must
+    be rebuilt).
+    """
+    return bool(frappe.db.sql("""
+        SHOW COLUMNS FROM eBay_categories_hierarchy LIKE 'CategoryIDPath'
+        """))
+
+
+def ensure_updated_cache(update_categories=False, update_features=False,
+                         incremental=True):
     """Check if the SQL database cache of the eBay Categories and Features
     is up to date.
     If not, request new caches as needed and call create_sql_cache.
+    If incremental is set and a categories cache exists, only the changed
+    categories are updated.
     """
 
     if update_categories:
@@ -154,15 +215,17 @@ def ensure_updated_cache(update_categories=False, update_features=False):
         categories_data, max_level = get_categories()
 
         # Alternatives for debugging only
-        # categories_data = _load_ebay_cache_from_file(
-        #    'erpnext_ebay.categories.pkl')
+        # categories_data = _load_ebay_cache_from_file(CATEGORIES_FIXTURE)
         # max_level = 6
 
-        # _write_ebay_cache_to_file(
-        #     'erpnext_ebay.categories.pkl', categories_data)
+        # _write_ebay_cache_to_file(CATEGORIES_FIXTURE, categories_data)
 
-        # Create SQL cache
-        create_ebay_categories_cache(categories_data)
+        # Create or update SQL cache
+        if incremental and categories_cache_exists():
+            update_ebay_categories_cache(categories_data)
+        else:
+            create_ebay_categories_cache(categories_data)
+        write_category_file()
         frappe.db.set_value('eBay Manager Settings', None,
                             'ebay_categories_cache_maximum_level',
                             max_level)
@@ -186,22 +249,67 @@ def ensure_updated_cache(update_categories=False, update_features=False):
 
         # Create SQL cache
         create_ebay_features_cache(features_data)
+        create_resolved_features_cache(features_data)
+        write_category_file()
+        clear_features_checkpoints()
 
 
-def create_ebay_categories_cache(categories_data):
-    """Create SQL caches for the categories dictionaries"""
+def category_rows(categories_data):
+    """Yield a row of CATEGORY_FIELDS + CATEGORY_PATH_FIELDS values for
+    each category, starting with a fake 'root' node (CategoryID 0) that is
+    the parent of the top-level categories.
 
-    tables_list = frappe.db.get_tables()  # Can't use db.table_exists here
+    CategoryIDPath is the comma-separated CategoryIDs from the top-level
+    category down to the category itself; CategoryNamePath is a JSON list
+    of the matching CategoryNames. Both are empty for the root.
+    """
+    yield (0, 'ROOT', 0, None, False,
+           True, False, False, False, False, False, False, False,
+           '', '[]')
 
-    # Drop the tables if they exist
-    if 'eBay_categories_info' in tables_list:
-        frappe.db.sql("""DROP TABLE eBay_categories_info""")
-    if 'eBay_categories_hierarchy' in tables_list:
-        frappe.db.sql("""DROP TABLE eBay_categories_hierarchy""")
+    def row(cat, id_path, name_path):
+        # Don't need to worry about inherited properties for categories
+        values = tuple(_bool_process(cat[key]) if key in cat else False
+                       for key in CATEGORY_FIELDS)
+        return values + (ID_PATH_SEPARATOR.join(id_path),
+                         json.dumps(name_path))
 
-    # Create the tables
-    frappe.db.sql("""
-        CREATE TABLE eBay_categories_info (
+    for cat in categories_data['TopLevel']:
+        top_paths = ([cat['CategoryID']], [cat['CategoryName']])
+        top_row = row(cat, *top_paths)
+        # Point the top-level categories at the root, not themselves
+        yield top_row[:PARENT_INDEX] + (0,) + top_row[PARENT_INDEX+1:]
+
+        # Add the children, with the paths of their parents
+        cat_children = [(x, top_paths) for x in cat['Children']]
+        while cat_children:
+            # Breadth-first walk through categories
+            next_level = []
+            for cat_child, (id_path, name_path) in cat_children:
+                child_paths = (id_path + [cat_child['CategoryID']],
+                               name_path + [cat_child['CategoryName']])
+                yield row(cat_child, *child_paths)
+                next_level.extend(
+                    (x, child_paths) for x in cat_child['Children'])
+            cat_children = next_level
+
+
+def build_categories_tables(categories_data, suffix='_new',
+                            batch_size=BATCH_SIZE):
+    """Build the categories tables with the given suffix (replacing any
+    existing tables of that name) using multi-row INSERTs of batch_size
+    rows, and create the categories changelog if it does not exist.
+    Causes implicit commits.
+    """
+    # The changelog is written after the categories, so must be created
+    # before anything is written
+    ensure_categories_changelog_table()
+
+    for table in ('eBay_categories_info', 'eBay_categories_hierarchy'):
+        frappe.db.sql(f"""DROP TABLE IF EXISTS `{table}{suffix}`""")
+
+    frappe.db.sql(f"""
+        CREATE TABLE `eBay_categories_info{suffix}` (
             Build NVARCHAR(1000),
             CategoryCount INT,
             CategoryVersion NVARCHAR(1000),
@@ -213,8 +321,10 @@ def create_ebay_categories_cache(categories_data):
             Version NVARCHAR(100)
         )""")
 
-    frappe.db.sql("""
-        CREATE TABLE eBay_categories_hierarchy (
+    # The parent is indexed rather than a foreign key, so the table can be
+    # renamed freely and rows need not be inserted parents-first
+    frappe.db.sql(f"""
+        CREATE TABLE `eBay_categories_hierarchy{suffix}` (
             CategoryID NVARCHAR(19) NOT NULL,
             CategoryName NVARCHAR(60),
             CategoryLevel INT,
@@ -228,83 +338,286 @@ def create_ebay_categories_cache(categories_data):
             LSD BOOLEAN,
             ORPA BOOLEAN,
             ORRA BOOLEAN,
+            CategoryIDPath NVARCHAR(255),
+            CategoryNamePath TEXT,
             PRIMARY KEY (CategoryID),
-            FOREIGN KEY (CategoryParentID)
-                REFERENCES eBay_categories_hierarchy(CategoryID)
+            INDEX CategoryParentID (CategoryParentID)
         )""")
 
     # Load the basic info into the info table
-    info_od = collections.OrderedDict()
-    keys = ('Build', 'CategoryCount', 'CategoryVersion',
-            'MinimumReservePrice', 'ReduceReserveAllowed',
-            'ReservePriceAllowed', 'Timestamp', 'UpdateTime',
-            'Version')
-    for key in keys:
-        if key in categories_data:
-            info_od[key] = _bool_process(categories_data[key])
-        else:
-            info_od[key] = False
-    frappe.db.sql("""
-        INSERT INTO eBay_categories_info
-            (""" + ", ".join(list(info_od.keys())) + """)
-            VALUES (""" + _s_for(info_od.values()) + """)
-        """, list(info_od.values()))  # nosec
-    # nosec: keys are hardcoded, and values are passed by parameterisation.
+    info_values = [
+        _bool_process(categories_data[key]) if key in categories_data
+        else False
+        for key in CATEGORY_INFO_FIELDS
+    ]
+    bulk_insert(f'eBay_categories_info{suffix}', CATEGORY_INFO_FIELDS,
+                [info_values])
 
     # Load the categories into the database
+    bulk_insert(f'eBay_categories_hierarchy{suffix}',
+                CATEGORY_FIELDS + CATEGORY_PATH_FIELDS,
+                category_rows(categories_data), batch_size=batch_size)
+    frappe.db.commit()
+
+
+def create_ebay_categories_cache(categories_data, batch_size=BATCH_SIZE):
+    """Create SQL caches for the categories dictionaries.
+
+    The new tables are built as staging tables with multi-row INSERTs of
+    batch_size rows, then swapped in with a single RENAME, so the current
+    tables remain readable until the new ones are complete.
+    """
+
+    # Build the staging tables
+    build_categories_tables(categories_data, batch_size=batch_size)
+
+    # Swap the staging tables in
+    swap_tables(('eBay_categories_info', 'eBay_categories_hierarchy'))
+    frappe.local.ebay_categories_version = None
+
+    # Every category may have changed
+    add_categories_changelog(
+        categories_data.get('CategoryVersion'), [(None, 'rebuild')])
+    frappe.db.commit()
+
+
+def categories_cache_exists():
+    """Return True if the categories cache exists, with the materialized
+    path columns and the categories changelog.
+    """
+    tables_list = frappe.db.get_tables()
+    return ('eBay_categories_info' in tables_list
+            and 'eBay_categories_hierarchy' in tables_list
+            and 'eBay_categories_changelog' in tables_list
+            and hierarchy_has_paths())
+
 
-    # A fake 'root' node
-    keys = (
-        'CategoryID', 'CategoryName', 'CategoryLevel', 'CategoryParentID',
-        'LeafCategory', 'Virtual', 'Expired', 'AutoPayEnabled',
-        'B2BVATEnabled', 'BestOfferEnabled', 'LSD', 'ORPA', 'ORRA')
-    values = (0, 'ROOT', 0, None, False,
-              True, False, False, False, False, False, False, False)
-    hierarchy_od = collections.OrderedDict(zip(keys, values))
+def ensure_categories_changelog_table():
+    """Create the categories changelog table if it does not exist.
+
+    Each row records a category changed by a categories cache update. A
+    row with a null CategoryID means the cache was rebuilt from scratch.
+    Rows are marked Processed once Item Group eBay has been reconciled.
+    """
     frappe.db.sql("""
-        INSERT INTO eBay_categories_hierarchy
-            (""" + ", ".join(hierarchy_od.keys()) + """)
-            VALUES (""" + _s_for(hierarchy_od.values()) + """)
-        """, list(hierarchy_od.values()))  # nosec
-    # nosec: keys are hardcoded, and values are passed by parameterisation.
+        CREATE TABLE IF NOT EXISTS eBay_categories_changelog (
+            ChangeID BIGINT NOT NULL AUTO_INCREMENT,
+            CategoryVersion NVARCHAR(1000),
+            CategoryID NVARCHAR(19),
+            ChangeType NVARCHAR(20) NOT NULL,
+            Changed DATETIME NOT NULL,
+            Processed BOOLEAN NOT NULL DEFAULT false,
+            PRIMARY KEY (ChangeID),
+            INDEX Processed (Processed)
+        )""")
 
-    for cat in categories_data['TopLevel']:
-        # Don't need to worry about inherited properties for categories
-        for key in hierarchy_od.keys():
-            if key in cat:
-                hierarchy_od[key] = _bool_process(cat[key])
-            else:
-                hierarchy_od[key] = False
-        # Point the top-level categories at the root, not themselves
-        hierarchy_od['CategoryParentID'] = 0
-        frappe.db.sql("""
-            INSERT INTO eBay_categories_hierarchy
-                (""" + ", ".join(hierarchy_od.keys()) + """)
-                VALUES (""" + _s_for(hierarchy_od.values()) + """)
-            """, list(hierarchy_od.values()))
 
-        # Add the children
-        cat_children = cat['Children']
-        while cat_children:
-            # Breadth-first walk through categories
-            next_level = []
-            for cat_child in cat_children:
-                for key in list(hierarchy_od.keys()):
-                    if key in cat_child:
-                        hierarchy_od[key] = _bool_process(cat_child[key])
-                    else:
-                        hierarchy_od[key] = False
-                frappe.db.sql("""
-                INSERT INTO eBay_categories_hierarchy
-                    (""" + ", ".join(hierarchy_od.keys()) + """)
-                    VALUES (""" + _s_for(hierarchy_od.values()) + """)
-                """, list(hierarchy_od.values()))  # nosec
-                # nosec: keys are hardcoded, and values
-                # are passed by parameterisation.
-                next_level.extend(cat_child['Children'])
-            cat_children = next_level
+def add_categories_changelog(category_version, changes):
+    """Record changes (a list of (CategoryID, ChangeType)) in the
+    categories changelog (does not commit). The changelog is created with
+    the categories cache.
+    """
+    now = frappe.utils.now_datetime()
+    bulk_insert(
+        'eBay_categories_changelog',
+        ('CategoryVersion', 'CategoryID', 'ChangeType', 'Changed'),
+        [(category_version, category_id, change_type, now)
+         for category_id, change_type in changes])
+
 
+def get_unprocessed_category_changes():
+    """Return the set of CategoryIDs changed since Item Group eBay was
+    last reconciled, or None if every category may have changed.
+    """
+    ensure_categories_changelog_table()
+    changes = frappe.db.sql("""
+        SELECT DISTINCT CategoryID FROM eBay_categories_changelog
+            WHERE NOT Processed;
+        """)
+    category_ids = {x[0] for x in changes}
+    if None in category_ids:
+        return None
+    return category_ids
+
+
+def mark_category_changes_processed():
+    """Mark all changelog rows as processed, and remove processed rows
+    older than CHANGELOG_DAYS_KEPT (does not commit).
+    """
+    frappe.db.sql("""
+        UPDATE eBay_categories_changelog SET Processed = true
+            WHERE NOT Processed;
+        """)
+    frappe.db.sql("""
+        DELETE FROM eBay_categories_changelog
+            WHERE Processed AND Changed < %(cutoff)s;
+        """, {'cutoff': frappe.utils.add_days(
+            frappe.utils.now_datetime(), -CHANGELOG_DAYS_KEPT)})
+
+
+def normalize_category_row(row):
+    """Convert a row of CATEGORY_FIELDS + CATEGORY_PATH_FIELDS values to
+    the types loaded from eBay_categories_hierarchy, for comparison.
+    """
+    (category_id, name, level, parent_id, *flags, id_path, name_path) = row
+    return (
+        (str(category_id), name, int(level),
+         None if parent_id is None else str(parent_id))
+        + tuple(int(bool(x)) for x in flags)
+        + (id_path, name_path)
+    )
+
+
+def diff_categories(existing, new):
+    """Compare existing and new categories (dicts of CategoryID:
+    normalized row).
+
+    Returns (rows, changes): the rows to insert or update, and a list of
+    (CategoryID, ChangeType) for the changelog. Categories that are no
+    longer returned by eBay are marked expired rather than deleted.
+    """
+    expired_index = CATEGORY_FIELDS.index('Expired')
+    name_index = CATEGORY_FIELDS.index('CategoryName')
+    rows = []
+    changes = []
+    for category_id, row in new.items():
+        old_row = existing.get(category_id)
+        if old_row is None:
+            rows.append(row)
+            changes.append((category_id, 'insert'))
+        elif old_row != row:
+            rows.append(row)
+            if old_row[PARENT_INDEX] != row[PARENT_INDEX]:
+                change_type = 'reparent'
+            elif old_row[name_index] != row[name_index]:
+                change_type = 'rename'
+            elif old_row[expired_index] != row[expired_index]:
+                change_type = 'expire'
+            elif old_row[-2:] != row[-2:]:
+                # An ancestor was renamed or re-parented
+                change_type = 'path'
+            else:
+                change_type = 'update'
+            changes.append((category_id, change_type))
+    for category_id, old_row in existing.items():
+        if category_id not in new and not old_row[expired_index]:
+            rows.append(old_row[:expired_index] + (1,)
+                        + old_row[expired_index+1:])
+            changes.append((category_id, 'expire'))
+    return rows, changes
+
+
+def update_ebay_categories_cache(categories_data, batch_size=BATCH_SIZE):
+    """Update the categories cache in place from new categories data,
+    writing only new and changed categories, and record the changes in
+    the categories changelog.
+    """
+    fields = CATEGORY_FIELDS + CATEGORY_PATH_FIELDS
+    existing = {
+        row[0]: row for row in frappe.db.sql(f"""
+            SELECT {', '.join(fields)}
+                FROM eBay_categories_hierarchy;
+            """)
+    }
+    new = {}
+    for row in category_rows(categories_data):
+        row = normalize_category_row(row)
+        new[row[0]] = row
+
+    rows, changes = diff_categories(existing, new)
+    bulk_insert('eBay_categories_hierarchy', fields, rows,
+                update_fields=fields[1:], batch_size=batch_size)
+
+    # Replace the basic info
+    info_values = [
+        _bool_process(categories_data[key]) if key in categories_data
+        else False
+        for key in CATEGORY_INFO_FIELDS
+    ]
+    frappe.db.sql("""DELETE FROM eBay_categories_info""")
+    bulk_insert('eBay_categories_info', CATEGORY_INFO_FIELDS, [info_values])
+
+    add_categories_changelog(categories_data.get('CategoryVersion'), changes)
     frappe.db.commit()
+    frappe.local.ebay_categories_version = None
+    return changes
+
+
+def swap_tables(tables):
+    """Atomically replace each table with its _new staging table, then drop
+    the old tables. The staging tables must exist.
+
+    Foreign keys referencing the tables (from the features cache) are not
+    checked during the swap; they refer to the tables by name, so apply to
+    the new tables afterwards.
+    """
+    tables_list = frappe.db.get_tables()  # Can't use db.table_exists here
+    renames = []
+    for table in tables:
+        if table in tables_list:
+            renames.append(f'`{table}` TO `{table}_old`')
+        renames.append(f'`{table}_new` TO `{table}`')
+    frappe.db.sql("""SET FOREIGN_KEY_CHECKS = 0""")
+    try:
+        frappe.db.sql('RENAME TABLE ' + ', '.join(renames))
+        for table in tables:
+            frappe.db.sql(f"""DROP TABLE IF EXISTS `{table}_old`""")
+    finally:
+        frappe.db.sql("""SET FOREIGN_KEY_CHECKS = 1""")
+
+
+def replicate_categories(categories_data, copies):
+    """Return a copy of categories data with the categories repeated
+    copies times (with new CategoryIDs), for benchmarks.
+    """
+    def offset_ids(cat, offset):
+        cat = dict(cat)
+        for key in ('CategoryID', 'CategoryParentID'):
+            cat[key] = str(int(cat[key]) + offset)
+        cat['Children'] = [offset_ids(x, offset) for x in cat['Children']]
+        return cat
+
+    categories_data = dict(categories_data)
+    top_level = categories_data['TopLevel']
+    categories_data['TopLevel'] = [
+        offset_ids(cat, i * 10**9) for i in range(copies) for cat in top_level
+    ]
+    return categories_data
+
+
+def benchmark_categories_cache(fn=None, batch_sizes=(1, BATCH_SIZE),
+                               copies=1000):
+    """Time building the categories tables for each batch size. A batch
+    size of 1 is equivalent to one INSERT per category.
+
+    The categories are loaded from a recorded GetCategories result in the
+    site directory (written with _write_ebay_cache_to_file) if fn is
+    given, or else from the sample in the app repeated copies times.
+
+    For use from bench execute. The tables are built into scratch
+    (_bench) tables which are then dropped; the categories cache and the
+    categories changelog are not touched.
+    """
+    if fn:
+        categories_data = _load_ebay_cache_from_file(fn)
+    else:
+        with open(CATEGORIES_SAMPLE) as f:
+            categories_data = replicate_categories(json.load(f), copies)
+    n_rows = sum(1 for x in category_rows(categories_data))
+    timings = {}
+    try:
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            build_categories_tables(categories_data, suffix='_bench',
+                                    batch_size=batch_size)
+            timings[batch_size] = time.perf_counter() - start
+            print(f'Batch size {batch_size}: {n_rows} categories in '
+                  + f'{timings[batch_size]:.2f}s '
+                  + f'({n_rows / timings[batch_size]:.0f} rows/s)')
+    finally:
+        for table in ('eBay_categories_info', 'eBay_categories_hierarchy'):
+            frappe.db.sql(f"""DROP TABLE IF EXISTS `{table}_bench`""")
+    return timings
 
 
 def create_ebay_features_cache(features_data):
@@ -572,26 +885,218 @@ def create_ebay_features_cache(features_data):
     frappe.db.commit()
 
 
+def resolve_features(features, overrides):
+    """Return the features of a category with the given overrides (a
+    GetCategoryFeatures Category dict) applied to its parent's features.
+    ListingDuration is overridden per listing type; other features are
+    replaced whole.
+    """
+    resolved = dict(features)
+    for key, value in overrides.items():
+        if key == 'CategoryID':
+            continue
+        if key == 'ListingDuration':
+            if not isinstance(value, Sequence):
+                value = (value,)
+            durations = dict(resolved.get('ListingDuration', {}))
+            for ld_dict in value:
+                durations[ld_dict['_type']] = ld_dict['value']
+            resolved['ListingDuration'] = durations
+        else:
+            resolved[key] = value
+    return resolved
+
+
+def resolved_features_rows(features_data):
+    """Yield (CategoryID, compact JSON features) for each leaf category,
+    resolving the inheritance of features from SiteDefaults and from each
+    parent category.
+    """
+    overrides = {
+        str(cat['CategoryID']): cat for cat in features_data['Category']
+    }
+    tree = get_category_tree()
+    root_features = resolve_features({}, features_data['SiteDefaults'])
+    # Resolved features of non-leaf categories (parents before children)
+    resolved = {'0': root_features}
+    for cat in sorted(tree, key=operator.attrgetter('level')):
+        if cat.category_id == '0':
+            continue
+        features = resolved[cat.parent_id]
+        if cat.category_id in overrides:
+            features = resolve_features(
+                features, overrides[cat.category_id])
+        if cat.leaf:
+            yield cat.category_id, json.dumps(
+                features, sort_keys=True, separators=(',', ':'))
+        else:
+            resolved[cat.category_id] = features
+
+
+def create_resolved_features_cache(features_data):
+    """Create the SQL cache of the resolved (effective) features of each
+    leaf category. Must be run after create_ebay_features_cache.
+
+    Identical feature sets are stored once, in eBay_features_sets, and
+    each leaf category refers to its set in eBay_features_resolved.
+    """
+    features_version = features_data['CategoryVersion']
+
+    for table in ('eBay_features_sets', 'eBay_features_resolved'):
+        frappe.db.sql(f"""DROP TABLE IF EXISTS `{table}_new`""")
+
+    frappe.db.sql("""
+        CREATE TABLE eBay_features_sets_new (
+            FeatureSetID INT NOT NULL,
+            CategoryVersion NVARCHAR(1000),
+            Features MEDIUMTEXT NOT NULL,
+            PRIMARY KEY (FeatureSetID)
+        )""")
+
+    frappe.db.sql("""
+        CREATE TABLE eBay_features_resolved_new (
+            CategoryID NVARCHAR(19) NOT NULL,
+            FeatureSetID INT NOT NULL,
+            PRIMARY KEY (CategoryID)
+        )""")
+
+    set_ids = {}
+    leaf_rows = []
+    for category_id, features in resolved_features_rows(features_data):
+        set_id = set_ids.setdefault(features, len(set_ids) + 1)
+        leaf_rows.append((category_id, set_id))
+    bulk_insert('eBay_features_sets_new',
+                ('FeatureSetID', 'CategoryVersion', 'Features'),
+                [(set_id, features_version, features)
+                 for features, set_id in set_ids.items()])
+    bulk_insert('eBay_features_resolved_new', ('CategoryID', 'FeatureSetID'),
+                leaf_rows)
+    frappe.db.commit()
+
+    swap_tables(('eBay_features_sets', 'eBay_features_resolved'))
+
+
+def get_category_features(category_id):
+    """Return the effective features of a leaf category (a new dict each
+    call), with inheritance from parent categories and SiteDefaults
+    already resolved. ListingDuration is a dict of listing type:
+    durationSetID.
+    """
+    return get_category_file().get_category_features(category_id)
+
+
+Category = collections.namedtuple(
+    'Category', ('category_id', 'name', 'parent_id', 'level', 'leaf',
+                 'expired', 'virtual', 'id_path', 'name_path'))
+Category.__doc__ = """A category from the categories cache. id_path and
+name_path are tuples from the top-level category down to this category.
+"""
+
+
+class CategoryTree():
+    """Immutable in-memory copy of the categories cache.
+
+    Categories are looked up by CategoryID (as a string). The version is
+    the (CategoryVersion, Timestamp) of the cache it was loaded from.
+    """
+
+    def __init__(self, version, categories):
+        self.version = version
+        self._categories = categories
+        children = collections.defaultdict(list)
+        for cat in categories.values():
+            if cat.parent_id is not None:
+                children[cat.parent_id].append(cat.category_id)
+        self._children = {k: tuple(v) for k, v in children.items()}
+
+    def __len__(self):
+        return len(self._categories)
+
+    def __contains__(self, category_id):
+        return str(category_id) in self._categories
+
+    def __iter__(self):
+        return iter(self._categories.values())
+
+    def __getitem__(self, category_id):
+        try:
+            return self._categories[str(category_id)]
+        except KeyError:
+            raise ValueError(f'eBay category ID {category_id} not found')
+
+    def children(self, category_id):
+        """Return the CategoryIDs of the children of a category."""
+        return self._children.get(str(category_id), ())
+
+    def get_category_stack(self, category_id):
+        """Return the CategoryIDs from a category up to its top-level
+        category.
+        """
+        return list(reversed(self[category_id].id_path))
+
+    def get_category_name_stack(self, category_id):
+        """Return the CategoryNames from a category up to its top-level
+        category.
+        """
+        return list(reversed(self[category_id].name_path))
+
+
+def get_categories_cache_version():
+    """Return the (CategoryVersion, Timestamp) of the categories cache, or
+    None if the cache is empty.
+    """
+    version = frappe.db.sql("""
+        SELECT CategoryVersion, Timestamp FROM eBay_categories_info;
+        """)
+    return tuple(version[0]) if version else None
+
+
+def load_category_tree(version):
+    """Load a CategoryTree from the categories cache."""
+    records = frappe.db.sql("""
+        SELECT CategoryID, CategoryName, CategoryLevel, CategoryParentID,
+            LeafCategory, Expired, Virtual, CategoryIDPath, CategoryNamePath
+            FROM eBay_categories_hierarchy;
+        """)
+    categories = {}
+    for (cat_id, name, level, parent_id, leaf, expired, virtual,
+            id_path, name_path) in records:
+        categories[cat_id] = Category(
+            cat_id, name, parent_id, level, bool(leaf), bool(expired),
+            bool(virtual),
+            tuple(id_path.split(ID_PATH_SEPARATOR)) if id_path else (),
+            tuple(json.loads(name_path)))
+    return CategoryTree(version, categories)
+
+
+def get_category_tree():
+    """Return the CategoryTree for the current site.
+
+    The tree is kept for the life of the process, and reloaded when the
+    categories cache version changes. The version is checked once per
+    request.
+    """
+    version = getattr(frappe.local, 'ebay_categories_version', None)
+    if version is None:
+        version = get_categories_cache_version()
+        frappe.local.ebay_categories_version = version
+    site = frappe.local.site
+    tree = _category_trees.get(site)
+    if tree is None or tree.version != version:
+        with _category_trees_lock:
+            tree = _category_trees.get(site)
+            if tree is None or tree.version != version:
+                tree = load_category_tree(version)
+                _category_trees[site] = tree
+    return tree
+
+
 def get_category_stack(category_id):
     """Given a CategoryID, return the category_stack.
 
     The category stack goes from deepest -> top category.
     """
-    category_stack = []
-    while category_id != "0":
-        category_stack.append(category_id)
-        category_query = frappe.db.sql("""
-            SELECT CategoryParentID
-                FROM eBay_categories_hierarchy
-                WHERE CategoryID=%s
-            """, (category_id,), as_dict=True)
-        if len(category_query) == 0:
-            raise ValueError('eBay category ID {} not found'.format(
-                category_id))
-        if len(category_query) > 1:
-            raise ValueError('eBay category with non-unique CategoryID!')
-        category_id = category_query[0]['CategoryParentID']
-    return category_stack
+    return get_category_file().get_category_stack(category_id)
 
 
 def get_category_name_stack(category_id):
@@ -599,119 +1104,144 @@ def get_category_name_stack(category_id):
 
     The category stack goes from deepest -> top category.
     """
-    category_name_stack = []
-    while category_id != "0":
-        category_query = frappe.db.sql("""
-            SELECT CategoryParentID, CategoryName
+    return get_category_file().get_category_name_stack(category_id)
+
+
+def load_item_group_ebay_categories(category_ids=None):
+    """Return a dict of CategoryID: Item Group eBay field values for each
+    leaf category in the categories cache (only for category_ids, if
+    supplied).
+    """
+    cats = []
+    for batch in (batches(category_ids) if category_ids is not None
+                  else [None]):
+        cats.extend(frappe.db.sql(f"""
+            SELECT CategoryID, CategoryName, Expired, Virtual,
+                CategoryNamePath
                 FROM eBay_categories_hierarchy
-                WHERE CategoryID=%s
-            """, (category_id,), as_dict=True)
-        if len(category_query) == 0:
-            raise ValueError('eBay category ID {} not found'.format(
-                category_id))
-        if len(category_query) > 1:
-            raise ValueError('eBay category with non-unique CategoryID!')
-        category_id = category_query[0]['CategoryParentID']
-        category_name_stack.append(category_query[0]['CategoryName'])
-    return category_name_stack
+                WHERE LeafCategory
+                    {'' if batch is None else 'AND CategoryID IN %(ids)s'};
+            """, {'ids': tuple(batch or ())}, as_dict=True))
+    return {
+        cat.CategoryID: {
+            'ebay_category_id': cat.CategoryID,
+            'ebay_category_name': f'{cat.CategoryName} {cat.CategoryID}',
+            'ebay_category': ' | '.join(json.loads(cat.CategoryNamePath)),
+            'ebay_expired': int(cat.Expired),
+            'ebay_virtual': int(cat.Virtual)
+        }
+        for cat in cats
+    }
+
+
+def diff_item_group_ebay(existing, new):
+    """Compare existing Item Group eBay rows (a dict of CategoryID: row
+    with name) with new rows (from load_item_group_ebay_categories).
+
+    Returns (inserts, updates, deletes): a list of new rows, a list of
+    (name, new row) and a list of names. Rows for categories that have
+    gone are deleted, unless an Item links to them; those are marked
+    expired instead.
+    """
+    inserts = [row for cat_id, row in new.items() if cat_id not in existing]
+    updates = [
+        (row.name, new[cat_id]) for cat_id, row in existing.items()
+        if cat_id in new and fields_differ(row, new[cat_id], IGE_FIELDS)
+    ]
+    gone = {row.name: row for cat_id, row in existing.items()
+            if cat_id not in new}
+    linked = set()
+    if gone:
+        linked = {x[0] for x in frappe.db.sql("""
+            SELECT DISTINCT item_group_ebay FROM `tabItem`
+                WHERE item_group_ebay IN %(names)s;
+            """, {'names': tuple(gone)})}
+    for name in linked:
+        if not gone[name].ebay_expired:
+            updates.append((name, dict(gone[name], ebay_expired=1)))
+    deletes = [name for name in gone if name not in linked]
+    return inserts, updates, deletes
+
+
+def apply_item_group_ebay_changes(inserts, updates, deletes):
+    """Apply the changes from diff_item_group_ebay with bulk SQL (does not
+    commit).
+
+    New rows are named as by the document model (autoname
+    field:ebay_category_name); updated rows keep their names.
+    """
+    now = frappe.utils.now_datetime()
+    user = frappe.session.user
+
+    bulk_delete('tabItem Group eBay', 'name', deletes)
+
+    rows = [
+        (name, now, now, user, user, 0) + tuple(row[x] for x in IGE_FIELDS)
+        for name, row in updates
+    ]
+    bulk_insert(
+        'tabItem Group eBay',
+        STANDARD_FIELDS + IGE_FIELDS,
+        rows,
+        update_fields=('modified', 'modified_by') + IGE_FIELDS
+    )
+
+    # Plain INSERTs, so a clash with another row's unique field is an
+    # error rather than an update of that row
+    rows = [
+        (row['ebay_category_name'], now, now, user, user, 0)
+        + tuple(row[x] for x in IGE_FIELDS)
+        for row in inserts
+    ]
+    bulk_insert('tabItem Group eBay', STANDARD_FIELDS + IGE_FIELDS, rows)
 
 
 def create_item_group_ebay(force_delete=False):
-    """Creates Item Group Ebay documents from the eBay categories cache."""
+    """Creates Item Group Ebay documents from the eBay categories cache.
+
+    Existing documents are reconciled with the leaf categories using bulk
+    SQL, so only new, changed and removed categories are written. Only
+    the categories in the categories changelog since the last run are
+    reconciled, unless the categories cache was rebuilt. If force_delete
+    is set (or there are duplicate eBay category IDs), all documents are
+    deleted and recreated.
+    """
 
     # DANGER - items that link to these Item Group eBay documents will be
-    # left hanging if the categories disappear.
+    # left hanging if the categories disappear and force_delete is set.
+
+    category_ids = None if force_delete else get_unprocessed_category_changes()
 
     if not force_delete:
         # If we are not force-deleting, check for current Item Group eBay
         # entries. We will prefer to update these rather than replace them.
-        ige_list = frappe.db.sql("""
-            SELECT ebay_category_id, ebay_category_name, ebay_category,
-                ebay_expired, ebay_virtual, name
-                FROM `tabItem Group eBay`;
-            """, as_dict=True)
+        ige_list = []
+        for batch in (batches(category_ids) if category_ids is not None
+                      else [None]):
+            ige_list.extend(frappe.db.sql(f"""
+                SELECT name, {', '.join(IGE_FIELDS)}
+                    FROM `tabItem Group eBay`
+                    {'' if batch is None
+                     else 'WHERE ebay_category_id IN %(ids)s'};
+                """, {'ids': tuple(batch or ())}, as_dict=True))
 
         ige_dict = {x['ebay_category_id']: x for x in ige_list}
 
         if len(ige_list) != len(ige_dict):
             # There are multiple categories with the same ebay_category_id
             force_delete = True
+            category_ids = None
         del ige_list
 
     if force_delete:
         # This is slower than TRUNCATE TABLE but doesn't lead to an
         # implicit commit, which often causes an error.
         frappe.db.sql("""DELETE FROM `tabItem Group eBay`;""")
-        frappe.db.commit()
         ige_dict = {}
 
-    cats = frappe.db.sql("""
-        SELECT CategoryID, CategoryParentID, CategoryName,
-            LeafCategory, Expired, Virtual
-            FROM eBay_categories_hierarchy;
-        """, as_dict=True)
-
-    parent_dict = {}
-    names_dict = {}
-    for cat in cats:
-        parent_dict[cat['CategoryID']] = cat['CategoryParentID']
-        names_dict[cat['CategoryID']] = cat['CategoryName']
-
-    for i, cat in enumerate(cats):
-        #print(' {:05} / {}'.format(i + 1, len(cats)))
-        if not cat['LeafCategory']:
-            # Don't add non-leaf categories
-            continue
-        # We need the following check, which prevents us adding the root node,
-        # only if we are adding leaf categories
-        #if cat['CategoryID'] == '0':
-            #continue
-
-        cat_id = cat['CategoryID']
-        cat_name = '{} {}'.format(cat['CategoryName'], cat_id)
-        cat_name_stack = [cat['CategoryName']]
-        cat_search_id = parent_dict[cat_id]
-        while cat_search_id != "0":
-            cat_name_stack.append(names_dict[cat_search_id])
-            cat_search_id = parent_dict[cat_search_id]
-
-        cat_name_stack.reverse()
-        cat_label = ' | '.join(cat_name_stack)  # or ' => '
-
-        # Test if this category already exists
-        if not force_delete and cat['CategoryID'] in ige_dict:
-            # Matching category ID exists. If it matches perfectly,
-            # we do nothing.
-            ige = ige_dict[cat_id]
-            if not (ige['ebay_category_name'] == cat_name
-                    and ige['ebay_category'] == cat_label
-                    and ige['ebay_expired'] == cat['Expired']
-                    and ige['ebay_virtual'] == cat['Virtual']):
-                # Update the not-quite matching category
-                item_group_ebay_doc = frappe.get_doc(
-                    'Item Group eBay', ige['name'])
-                item_group_ebay_doc.ebay_category_name = cat_name
-                item_group_ebay_doc.ebay_category = cat_label
-                item_group_ebay_doc.ebay_expired = cat['Expired']
-                item_group_ebay_doc.ebay_expired = cat['Virtual']
-                item_group_ebay_doc.save()
-            del ige_dict[cat_id]
-
-        else:
-            # No matching category found - create a new category
-            item_group_ebay_doc = frappe.get_doc({
-                "doctype": "Item Group eBay",
-                "ebay_category_id": cat['CategoryID'],
-                "ebay_category_name": cat_name,
-                "ebay_category": cat_label,
-                "ebay_expired": cat['Expired'],
-                "ebay_virtual": cat['Virtual']})
-
-            item_group_ebay_doc.insert(ignore_permissions=True)
-
-    # Now we delete any categories that exist in the DB but are not current
-    for ige in ige_dict.values():
-        item_group_ebay_doc = frappe.get_doc('Item Group eBay', ige['name'])
-        item_group_ebay_doc.delete()
+    inserts, updates, deletes = diff_item_group_ebay(
+        ige_dict, load_item_group_ebay_categories(category_ids))
+    apply_item_group_ebay_changes(inserts, updates, deletes)
+    mark_category_changes_processed()
 
     frappe.db.commit()
@@ -6,10 +6,13 @@ import sys
 import time
 import threading
 import operator
+import pickle
 
 import datetime
 from collections.abc import Sequence
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+)
 
 import redo
 import requests
@@ -27,10 +30,31 @@ from erpnext_ebay.ebay_constants import (
 )
 from erpnext_ebay.erpnext_ebay.doctype.ebay_manager_settings.ebay_manager_settings\
     import use_sandbox
+from erpnext_ebay.sync_profiler import hook_connection
+
+# Timeout (seconds) for each GetCategoryFeatures request, after which the
+# category is split into its children
+FEATURES_TIMEOUT = EBAY_TIMEOUT * 2
+# Maximum number of simultaneous GetCategoryFeatures requests
+FEATURES_WORKERS = min(EBAY_WORKERS, 10)
+# Attempts for a request that times out and cannot be split
+FEATURES_ATTEMPTS = 3
+# Maximum number of simultaneous GetOrders page requests
+ORDERS_WORKERS = min(EBAY_WORKERS, 10)
+
+
+def get_yaml_path():
+    """Return the path to the ebay.yaml file for the current site."""
+    return os.path.join(
+        os.sep, frappe.utils.get_bench_path(), 'sites',
+        frappe.get_site_path(), 'ebay.yaml')
 
-PATH_TO_YAML = os.path.join(
-    os.sep, frappe.utils.get_bench_path(), 'sites',
-    frappe.get_site_path(), 'ebay.yaml')
+
+def __getattr__(name):
+    """Provide PATH_TO_YAML lazily (it depends on the current site)."""
+    if name == 'PATH_TO_YAML':
+        return get_yaml_path()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def ebay_logger():
@@ -157,7 +181,7 @@ def get_trading_api(site_id=HOME_SITE_ID, warnings=True, timeout=EBAY_TIMEOUT,
 
     trading_kwargs = {
         'domain': domain,
-        'config_file': PATH_TO_YAML,
+        'config_file': get_yaml_path(),
         'siteid': site_id,
         'warnings': warnings,
         'timeout': timeout
@@ -165,34 +189,80 @@ def get_trading_api(site_id=HOME_SITE_ID, warnings=True, timeout=EBAY_TIMEOUT,
     trading_kwargs.update(kwargs)
 
     if executor:
-        return ParallelTrading(**trading_kwargs, executor=executor)
+        api = ParallelTrading(**trading_kwargs, executor=executor)
     else:
-        return Trading(**trading_kwargs)
+        api = Trading(**trading_kwargs)
+    # Count calls in the sync profiler, if profiling
+    return hook_connection(api)
+
+
+def ebay_timestamp(dt):
+    """Format a naive UTC datetime as an eBay API timestamp."""
+    return dt.isoformat(timespec='milliseconds') + 'Z'
 
 
 def get_orders(order_status='All', include_final_value_fees=True,
-               num_days=None):
-    """Returns a tuple of a list of, and the number of, recent orders
-    from the eBay TradingAPI.
+               num_days=None, mod_time_from=None, mod_time_to=None):
+    """Returns a tuple of a list of, and the number of days covered by,
+    recent orders from the eBay TradingAPI.
+
+    If mod_time_from (a naive UTC datetime) is given, only orders modified
+    between mod_time_from and mod_time_to (default now) are returned, and
+    num_days is ignored (and returned as None). eBay only accepts
+    modification time ranges of up to 30 days.
+
+    The first page is fetched to find the number of pages; the remaining
+    pages are then fetched in parallel, at most ORDERS_WORKERS at a time.
 
     This list is NOT filtered by a siteid as the API call does not filter
     by siteid.
     """
 
-    if num_days is None:
-        num_days = int(frappe.get_value(
-            'eBay Manager Settings', filters=None, fieldname='ebay_sync_days'))
+    if mod_time_from is None:
+        if num_days is None:
+            num_days = int(frappe.get_value(
+                'eBay Manager Settings', filters=None,
+                fieldname='ebay_sync_days'))
 
-    try:
-        if num_days < 1:
-            frappe.msgprint('Invalid number of days: ' + str(num_days))
-    except TypeError:
-        raise ValueError('Invalid type in ebay_sync_days')
+        try:
+            if num_days < 1:
+                frappe.msgprint('Invalid number of days: ' + str(num_days))
+        except TypeError:
+            raise ValueError('Invalid type in ebay_sync_days')
+    else:
+        num_days = None
 
     orders = []
-    page = 1
 
-    api_options = {}
+    # Create executor for futures (bounds the simultaneous requests)
+    executor = ThreadPoolExecutor(max_workers=ORDERS_WORKERS)
+
+    api = None
+    api_options = {
+        'OrderStatus': order_status,
+        'Pagination': {
+            'EntriesPerPage': 100,
+            'PageNumber': 1}
+    }
+    if mod_time_from is None:
+        api_options['NumberOfDays'] = num_days
+    else:
+        mod_time_to = mod_time_to or datetime.datetime.utcnow()
+        api_options['ModTimeFrom'] = ebay_timestamp(mod_time_from)
+        api_options['ModTimeTo'] = ebay_timestamp(mod_time_to)
+    if include_final_value_fees:
+        api_options['IncludeFinalValueFee'] = 'true'
+
+    def add_orders(response):
+        orders_api = response.dict()
+        test_for_message(orders_api)
+        n_orders = int(orders_api['ReturnedOrderCountActual'])
+        if n_orders > 0:
+            if not isinstance(orders_api['OrderArray']['Order'], list):
+                raise AssertionError('Invalid type in get_orders!')
+            orders.extend(orders_api['OrderArray']['Order'])
+        return orders_api
+
     try:
         # Initialize TradingAPI
 
@@ -201,45 +271,49 @@ def get_orders(order_status='All', include_final_value_fees=True,
         # siteID anyway
 
         api = get_trading_api(site_id=0, warnings=True, timeout=EBAY_TIMEOUT,
-                              api_call='GetOrders')
+                              api_call='GetOrders', executor=executor)
 
-        while True:
-            # TradingAPI results are paginated, so loop until
-            # all pages have been obtained
-            api_options = {
-                'NumberOfDays': num_days,
-                'OrderStatus': order_status,
-                'Pagination': {
-                    'EntriesPerPage': 50,
-                    'PageNumber': page}
-                }
-            if include_final_value_fees:
-                api_options['IncludeFinalValueFee'] = 'true'
-
-            # Retry is built-in for ParallelTrading
-            api.execute('GetOrders', api_options)
-
-            orders_api = api.response.dict()
-            test_for_message(orders_api)
-
-            n_orders = int(orders_api['ReturnedOrderCountActual'])
-            if n_orders > 0:
-                if not isinstance(orders_api['OrderArray']['Order'], list):
-                    raise AssertionError('Invalid type in get_orders!')
-                orders.extend(orders_api['OrderArray']['Order'])
-            if orders_api['HasMoreOrders'] == 'false':
-                break
-            page += 1
+        # First call to get number of pages
+        redo.retry(
+            api.execute, attempts=REDO_ATTEMPTS, sleeptime=REDO_SLEEPTIME,
+            sleepscale=REDO_SLEEPSCALE, retry_exceptions=REDO_EXCEPTIONS,
+            args=('GetOrders', api_options)
+        )
+        orders_api = add_orders(api.future.result())
+        n_pages = int(orders_api['PaginationResult']['TotalNumberOfPages'])
+
+        # Request the remaining pages in parallel
+        futures = []
+        for page in range(2, n_pages+1):
+            api_options['Pagination']['PageNumber'] = page
+            redo.retry(
+                api.execute, attempts=REDO_ATTEMPTS, sleeptime=REDO_SLEEPTIME,
+                sleepscale=REDO_SLEEPSCALE, retry_exceptions=REDO_EXCEPTIONS,
+                args=('GetOrders', api_options)
+            )
+            futures.append(api.future)
+
+        # Process responses in page order
+        for future in futures:
+            add_orders(future.result())
 
     except ConnectionError as e:
         handle_ebay_error(e, api_options)
 
+    finally:
+        executor.shutdown()
+        if api:
+            api.session.close()
+
     return orders, num_days
 
 
 def get_my_ebay_selling(listings_type='Summary', api_options=None,
                         api_inner_options=None, site_id=HOME_SITE_ID):
     """Returns a list of listings from the GetMyeBaySelling eBay TradingAPI.
+
+    The first page is fetched to find the number of pages; the remaining
+    pages are then fetched in parallel and combined in page order.
     """
 
     INNER_PAGINATE = ('ActiveList', 'ScheduledList', 'SoldList', 'UnsoldList')
@@ -257,8 +331,7 @@ def get_my_ebay_selling(listings_type='Summary', api_options=None,
         raise ValueError('Set listing type and inner options separately!')
 
     listings = []
-    page = 1
-    n_pages = None
+    summary = None
 
     if api_options is None:
         api_options = {}
@@ -273,78 +346,93 @@ def get_my_ebay_selling(listings_type='Summary', api_options=None,
 
         api_options[listings_type] = api_inner_options
 
+    def add_listings(listings_api):
+        # Locate the appropriate results
+        nonlocal listings
+        field, array = RESPONSE_FIELDS[listings_type]
+        if field is None:
+            listings = listings_api
+        elif array is None:
+            listings = (
+                listings_api[field] if field in listings_api else None)
+        else:
+            entries = listings_api[listings_type][field][array]
+            # Check for single (non-list) entry
+            if isinstance(entries, Sequence):
+                listings.extend(entries)
+            else:
+                listings.append(entries)
+
+    # Create executor for futures
+    executor = ThreadPoolExecutor(max_workers=EBAY_WORKERS)
+
+    api = None
     try:
         # Initialize TradingAPI
 
         api = get_trading_api(site_id=site_id, warnings=True,
                               timeout=EBAY_TIMEOUT,
-                              api_call='GetMyeBaySelling')
-        while True:
-            # TradingAPI results are often paginated, so loop until
-            # all pages have been obtained
-            if listings_type in INNER_PAGINATE:
-                api_options[listings_type]['Pagination'] = {
-                    'EntriesPerPage': 100, 'PageNumber': page}
+                              api_call='GetMyeBaySelling', executor=executor)
+
+        # First call to get number of pages (and summary)
+        if listings_type in INNER_PAGINATE:
+            api_options[listings_type]['Pagination'] = {
+                'EntriesPerPage': 100, 'PageNumber': 1}
+        redo.retry(
+            api.execute, attempts=REDO_ATTEMPTS, sleeptime=REDO_SLEEPTIME,
+            sleepscale=REDO_SLEEPSCALE, retry_exceptions=REDO_EXCEPTIONS,
+            args=('GetMyeBaySelling', api_options)
+        )
+        listings_api = api.future.result().dict()
+        test_for_message(listings_api)
+
+        # Get Summary if it exists
+        if 'Summary' in listings_api:
+            summary = listings_api['Summary']
+        n_pages = 1
+        if listings_type in INNER_PAGINATE:
+            if 'PaginationResult' in listings_api[listings_type]:
+                n_pages = int(
+                    (listings_api[listings_type]
+                        ['PaginationResult']['TotalNumberOfPages']))
+        ebay_logger().info(f'n_pages = {n_pages}')
+        if (listings_type in listings_api
+                and 'ItemArray' in listings_api[listings_type]
+                and listings_api[listings_type]['ItemArray']
+                and 'Item' in listings_api[listings_type]['ItemArray']):
+            n_items = len(
+                listings_api[listings_type]['ItemArray']['Item'])
+        else:
+            n_items = 0
+        ebay_logger().info(f'n_items per page = {n_items}')
+        add_listings(listings_api)
 
+        # Request the remaining pages in parallel
+        futures = []
+        for page in range(2, n_pages+1):
+            api_options[listings_type]['Pagination']['PageNumber'] = page
             redo.retry(
                 api.execute, attempts=REDO_ATTEMPTS, sleeptime=REDO_SLEEPTIME,
                 sleepscale=REDO_SLEEPSCALE, retry_exceptions=REDO_EXCEPTIONS,
                 args=('GetMyeBaySelling', api_options)
             )
+            futures.append(api.future)
 
-            listings_api = api.response.dict()
+        # Process responses in page order
+        for page, future in enumerate(futures, start=2):
+            listings_api = future.result().dict()
             test_for_message(listings_api)
-
-            # If appropriate on our first time around, find the total
-            # number of pages.
-            if n_pages is None:
-                # Get Summary if it exists
-                if 'Summary' in listings_api:
-                    summary = listings_api['Summary']
-                else:
-                    summary = None
-                if listings_type in INNER_PAGINATE:
-                    if 'PaginationResult' in listings_api[listings_type]:
-                        n_pages = int(
-                            (listings_api[listings_type]
-                                ['PaginationResult']['TotalNumberOfPages']))
-                    else:
-                        n_pages = 1
-                ebay_logger().info(f'n_pages = {n_pages}')
-                if ('ItemArray' in listings_api[listings_type]
-                        and listings_api[listings_type]['ItemArray']
-                        and 'Item' in listings_api[listings_type]['ItemArray']):
-                    n_items = len(
-                        listings_api[listings_type]['ItemArray']['Item'])
-                else:
-                    n_items = 0
-                ebay_logger().info(f'n_items per page = {n_items}')
-            if n_pages > 1:
-                ebay_logger().info(f'page {page} / {n_pages}')
-
-            # Locate the appropriate results
-            field, array = RESPONSE_FIELDS[listings_type]
-            if field is None:
-                listings = listings_api
-            elif array is None:
-                listings = (
-                    listings_api[field] if field in listings_api else None)
-            else:
-                entries = listings_api[listings_type][field][array]
-                # Check for single (non-list) entry
-                if isinstance(entries, Sequence):
-                    listings.extend(entries)
-                else:
-                    listings.append(entries)
-
-            # If we are on the last page or there are no pages, break.
-            if page >= (n_pages or 0):
-                break
-            page += 1
+            ebay_logger().info(f'page {page} / {n_pages}')
+            add_listings(listings_api)
 
     except ConnectionError as e:
         handle_ebay_error(e, api_options)
 
+    finally:
+        executor.shutdown()
+        if api:
+            api.session.close()
+
     return listings, summary
 
 
@@ -366,12 +454,14 @@ def get_seller_list(item_codes=None, site_id=HOME_SITE_ID,
                     output_selector=None, granularity_level='Coarse',
                     detail_level=None, days_before=0, days_after=119,
                     active_only=True, force_sandbox_value=None,
-                    print=ebay_logger().info):
+                    print=ebay_logger().info, page_callback=None):
     """Runs GetSellerList to obtain a list of items.
     Note that this call does NOT filter by SiteID, but does return it.
     Items are returned ending between days_before now and days_after now, with
     defaults of 0 days before and 119 days after, respectively.
     If active_only is True (the default), only 'Active' items are returns.
+    If page_callback is supplied, it is called (with no arguments) after
+    each page of results is processed.
     """
 
     # eBay has a limit of 300 calls in 15 seconds
@@ -466,6 +556,8 @@ def get_seller_list(item_codes=None, site_id=HOME_SITE_ID,
         print(f'n_pages = {n_pages}')
         print(f'total number of items: {total_entries}')
         print(f'n_items per page = {n_listings}')
+        if page_callback:
+            page_callback()
 
         # Generate list of futures, rate-limiting in blocks of time
         start_time = time.monotonic()
@@ -505,6 +597,8 @@ def get_seller_list(item_codes=None, site_id=HOME_SITE_ID,
                 listings.extend(listings_api['ItemArray']['Item'])
 
             print(f'page {future.page_number} / {n_pages} ({n_listings} items)')
+            if page_callback:
+                page_callback()
 
             # Ping the database so we don't time out on interactive console
             frappe.db.sql("""SELECT 1""")
@@ -661,109 +755,226 @@ def get_categories(site_id=HOME_SITE_ID):
     return categories_data, max_level
 
 
-def get_features(site_id=HOME_SITE_ID):
+def ensure_features_checkpoint_table():
+    """Create the GetCategoryFeatures checkpoint table if it does not
+    exist.
+
+    Each row holds the (pickled) response for a category, or marks a
+    category that was split into its children. level_limit is zero for a
+    request for the whole subtree of the category.
+    """
+    frappe.db.sql("""
+        CREATE TABLE IF NOT EXISTS `zeBayFeaturesCheckpoint`
+        (
+            category_id VARCHAR(19) NOT NULL,
+            level_limit INT NOT NULL,
+            category_version VARCHAR(100) NOT NULL,
+            split TINYINT NOT NULL DEFAULT 0,
+            response LONGBLOB NULL,
+            PRIMARY KEY (category_id, level_limit)
+        );
+        """)
+
+
+def load_features_checkpoints(category_version):
+    """Return a dict of (category_id, level_limit): (split, response) for
+    the checkpoints of the current download, discarding any for other
+    category versions.
+    """
+    ensure_features_checkpoint_table()
+    frappe.db.sql("""
+        DELETE FROM `zeBayFeaturesCheckpoint`
+            WHERE category_version <> %(category_version)s;
+        """, {'category_version': category_version})
+    frappe.db.commit()
+    records = frappe.db.sql("""
+        SELECT category_id, level_limit, split, response
+            FROM `zeBayFeaturesCheckpoint`;
+        """)
+    return {
+        (category_id, level_limit): (
+            split, None if response is None else pickle.loads(response))
+        for category_id, level_limit, split, response in records
+    }
+
+
+def save_features_checkpoint(category_version, category_id, level_limit,
+                             response_dict=None):
+    """Record a completed GetCategoryFeatures request (or, if
+    response_dict is None, a split category), and commit.
+    """
+    frappe.db.sql("""
+        REPLACE INTO `zeBayFeaturesCheckpoint`
+            (category_id, level_limit, category_version, split, response)
+            VALUES (%(category_id)s, %(level_limit)s, %(category_version)s,
+                    %(split)s, %(response)s);
+        """, {'category_id': category_id, 'level_limit': level_limit,
+              'category_version': category_version,
+              'split': int(response_dict is None),
+              'response': (
+                  None if response_dict is None
+                  else pickle.dumps(response_dict, pickle.HIGHEST_PROTOCOL))})
+    frappe.db.commit()
+
+
+def clear_features_checkpoints():
+    """Remove all checkpoints, once the features cache has been built."""
+    if frappe.db.sql("SHOW TABLES LIKE 'zeBayFeaturesCheckpoint'"):
+        frappe.db.sql("""DELETE FROM `zeBayFeaturesCheckpoint`;""")
+        frappe.db.commit()
+
+
+def get_child_categories(category_id):
+    """Return the child categories of a category from the categories
+    cache, excluding expired categories (which have no features).
+    """
+    return frappe.db.sql("""
+        SELECT CategoryID, CategoryName, CategoryLevel
+            FROM eBay_categories_hierarchy
+            WHERE CategoryParentID=%s AND NOT Expired
+        """, (category_id,), as_dict=True)
+
+
+def get_features(site_id=HOME_SITE_ID, print=None):
     """Load the eBay category features for the features cache.
     Always uses the live eBay API.
+
+    The top-level categories are requested in parallel. A category whose
+    request times out is split: the category itself is requested alone
+    (with a LevelLimit), and each of its children is requested with its
+    subtree. Completed requests are checkpointed, so a failed download
+    resumes where it stopped (for the same CategoryVersion).
     """
+    if print is None:
+        print = ebay_logger().info
+
+    category_version = frappe.db.sql("""
+        SELECT CategoryVersion FROM eBay_categories_info
+        """)[0][0]
+    checkpoints = load_features_checkpoints(category_version)
 
+    responses = []
+    pending = {}
+
+    # Create executor for futures
+    executor = ThreadPoolExecutor(max_workers=FEATURES_WORKERS)
+    api = None
     try:
-        # Initialize TradingAPI; default timeout is twice default.
+        # Initialize TradingAPI
         api = get_trading_api(site_id=site_id, warnings=True,
-                              timeout=EBAY_TIMEOUT * 2,
-                              api_call='GetCategoryFeatures')
+                              timeout=FEATURES_TIMEOUT,
+                              api_call='GetCategoryFeatures',
+                              executor=executor)
+
+        def submit(category, level_limit, attempt=1):
+            """Submit a GetCategoryFeatures request for a category."""
+            category_id = category['CategoryID']
+            category_level = int(category['CategoryLevel'])
+            sub_string = 'sub' * (category_level-1)
+            print(f'Loading for {sub_string}category {category_id}...')
+            api_options = {
+                'CategoryID': category_id,
+                'DetailLevel': 'ReturnAll',
+                'ViewAllNodes': 'true'
+            }
+            if level_limit:
+                api_options['LevelLimit'] = level_limit
+            redo.retry(
+                api.execute, attempts=REDO_ATTEMPTS, sleeptime=REDO_SLEEPTIME,
+                sleepscale=REDO_SLEEPSCALE, retry_exceptions=REDO_EXCEPTIONS,
+                args=('GetCategoryFeatures', api_options)
+            )
+            pending[api.future] = (category, level_limit, attempt)
+
+        def queue(category, level_limit=0):
+            """Queue a request for a category, unless checkpointed."""
+            key = (category['CategoryID'], level_limit)
+            if key not in checkpoints:
+                submit(category, level_limit)
+                return
+            split, response_dict = checkpoints[key]
+            if split:
+                queue_split(category)
+            else:
+                responses.append(response_dict)
+
+        def queue_split(category):
+            """Queue requests for a category alone and for each child."""
+            queue(category, level_limit=int(category['CategoryLevel']))
+            for child in get_child_categories(category['CategoryID']):
+                queue(child)
+
+        # Start with each top-level category
+        for category in get_child_categories(0):
+            queue(category)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                category, level_limit, attempt = pending.pop(future)
+                category_id = category['CategoryID']
+                try:
+                    response_dict = future.result().dict()
+                except requests.exceptions.Timeout:
+                    if not level_limit and get_child_categories(category_id):
+                        print(f'Category {category_id} timed out; '
+                              + 'loading its subcategories separately')
+                        save_features_checkpoint(
+                            category_version, category_id, level_limit)
+                        queue_split(category)
+                    elif attempt < FEATURES_ATTEMPTS:
+                        submit(category, level_limit, attempt + 1)
+                    else:
+                        frappe.throw('GetCategoryFeatures timed out for '
+                                     + f'category {category_id}')
+                    continue
+                test_for_message(response_dict)
+                save_features_checkpoint(
+                    category_version, category_id, level_limit,
+                    response_dict)
+                responses.append(response_dict)
 
     except ConnectionError as e:
         handle_ebay_error(e)
 
+    finally:
+        executor.shutdown()
+        if api:
+            api.session.close()
+
+    return merge_features_responses(responses)
+
+
+def merge_features_responses(responses):
+    """Combine GetCategoryFeatures responses into a single features
+    dictionary, and return (features_version, features_data).
+    """
     features_data = None
     feature_definitions = set()
     listing_durations = {}
 
-    # Loop over each top-level category, pulling in all of the data
-    search_categories = frappe.db.sql("""
-        SELECT CategoryID, CategoryName, CategoryLevel
-            FROM eBay_categories_hierarchy WHERE CategoryParentID=0
-        """, as_dict=True)
-
-    # BEGIN DUBIOUS WORKAROUND
-    # Even some top-level categories have a habit of timing out
-    # Run over their subcategories instead
-    problematic_categories = ['1']  # Categories that timeout
-    problem_parents = []
-    problem_children = []
-    for category in search_categories:
-        category_id = category['CategoryID']
-        if category_id in problematic_categories:
-            problem_parents.append(category)
-            children = frappe.db.sql("""
-                SELECT CategoryID, CategoryName, CategoryLevel
-                FROM eBay_categories_hierarchy WHERE CategoryParentID=%s
-                """, (category_id,), as_dict=True)
-            problem_children.extend(children)
-    for parent in problem_parents:
-        search_categories.remove(parent)
-    search_categories.extend(problem_children)
-    search_categories.extend(problem_parents)  # Now at end of list
-    # END DUBIOUS WORKAROUND
-
-    for category in search_categories:
-        category_id = category['CategoryID']
-        category_level = int(category['CategoryLevel'])
-        sub_string = 'sub' * (category_level-1)
-        print(f'Loading for {substring}category {category_id}...')
-        api_options = {
-            'CategoryID': category_id,
-            'DetailLevel': 'ReturnAll',
-            'ViewAllNodes': 'true'
-        }
-        # BEGIN DUBIOUS WORKAROUND
-        # Only look at the top level for this category
-        if category_id in problematic_categories:
-            api_options['LevelLimit'] = 1
-        # END DUBIOUS WORKAROUND
-
-        try:
-            redo.retry(
-                api.execute, attempts=REDO_ATTEMPTS, sleeptime=REDO_SLEEPTIME,
-                sleepscale=REDO_SLEEPSCALE, retry_exceptions=REDO_EXCEPTIONS,
-                args=('GetCategoryFeatures', api_options)
-            )
-        except ConnectionError as e:
-            handle_ebay_error(e)
-        response_dict = api.response.dict()
-        test_for_message(response_dict)
-
+    for response_dict in responses:
+        cat_list = response_dict.get('Category', [])
+        if not isinstance(cat_list, Sequence):
+            cat_list = [cat_list]  # in case there is only one category
         if features_data is None:
             # First batch of new categories
             features_data = response_dict   # Initialize with the whole dataset
-            # Extract all the FeatureDefinition keys
-            feature_definitions.update(
-                features_data['FeatureDefinitions'].keys())
-            # Special-case the ListingDurations
+            features_data['Category'] = list(cat_list)
             lds = response_dict['FeatureDefinitions']['ListingDurations']
             features_data['ListingDurationsVersion'] = lds['_Version']
-            if 'ListingDuration' in lds:
-                for ld in lds['ListingDuration']:
-                    listing_durations[ld['_durationSetID']] = ld['Duration']
-            del (features_data['FeatureDefinitions'])
         else:
-            # Add new categories to existing dictionary
-            if 'Category' not in response_dict:
-                # No over-ridden categories returned
-                continue
-            cat_list = response_dict['Category']
-            if not isinstance(cat_list, Sequence):
-                cat_list = [cat_list]  # in case there is only one category
-            # Add the new categories, FeatureDefinitions, ListingDurations
+            # Add the new categories to existing dictionary
             features_data['Category'].extend(cat_list)
-            feature_definitions.update(
-                response_dict['FeatureDefinitions'].keys())
-            lds = response_dict['FeatureDefinitions']['ListingDurations']
-            if 'ListingDuration' in lds:
-                for ld in lds['ListingDuration']:
-                    if ld['_durationSetID'] in listing_durations:
-                        continue
-                    listing_durations[ld['_durationSetID']] = ld['Duration']
+        # Add the FeatureDefinitions and ListingDurations
+        feature_definitions.update(
+            response_dict['FeatureDefinitions'].keys())
+        lds = response_dict['FeatureDefinitions']['ListingDurations']
+        if 'ListingDuration' in lds:
+            for ld in lds['ListingDuration']:
+                if ld['_durationSetID'] in listing_durations:
+                    continue
+                listing_durations[ld['_durationSetID']] = ld['Duration']
 
     # Store the FeatureDefinitions and ListingDurations in a sensible place
     feature_definitions.remove('ListingDurations')
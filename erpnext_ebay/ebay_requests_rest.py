@@ -15,6 +15,7 @@ from erpnext_ebay.ebay_constants import (
     REDO_SLEEPSCALE, REDO_EXCEPTIONS
 )
 from erpnext_ebay.ebay_tokens import get_api
+from erpnext_ebay.sync_profiler import count_api_calls
 from erpnext_ebay.erpnext_ebay.doctype.ebay_manager_settings.ebay_manager_settings\
     import use_sandbox
 
@@ -91,6 +92,7 @@ def single_api_call(api_call, sandbox=False, *args, **kwargs):
         )
     except eBayRestError as e:
         handle_ebay_error(e)
+    count_api_calls()
     # Check for warnings
     check_for_warnings(result)
 
@@ -114,6 +116,7 @@ def paged_api_call(api_call, record_field, sandbox=False, *args, **kwargs):
         )
     except eBayRestError as e:
         handle_ebay_error(e)
+    count_api_calls(len(pages))
     # Check for warnings
     check_for_warnings(pages[0])
 
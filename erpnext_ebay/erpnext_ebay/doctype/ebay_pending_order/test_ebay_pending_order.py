@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Ben Glazier and Contributors
+# See license.txt
+
+import datetime
+import unittest
+
+from erpnext_ebay.sync_pending_orders import (
+    active_orders, diff_pending_orders
+)
+
+
+def make_pending_order(ebay_order_id, name=None):
+    """Return a minimal pending order dict, as from build_pending_orders
+    (or, with a name, from load_pending_orders).
+    """
+    order = {
+        'ebay_order_id': ebay_order_id,
+        'last_modified': datetime.datetime(2021, 1, 1),
+        'items': [{'item_code': 'ITEM-00001', 'qty': 1, 'price': 10.0,
+                   'ebay_id': '1234'}]
+    }
+    if name:
+        order['name'] = name
+    return order
+
+
+class TesteBayPendingOrder(unittest.TestCase):
+
+    def test_incremental_sync_mixed_statuses(self):
+        """Completed orders in an incremental sync remove their pending
+        orders and are not inserted.
+        """
+        orders = [
+            {'OrderID': 'A', 'OrderStatus': 'Active'},
+            {'OrderID': 'B', 'OrderStatus': 'Completed'},
+            {'OrderID': 'C', 'OrderStatus': 'Completed'},
+        ]
+        active = active_orders(orders)
+        self.assertEqual([x['OrderID'] for x in active], ['A'])
+
+        existing_orders = {
+            'A': make_pending_order('A', name='PENDING-A'),
+            'B': make_pending_order('B', name='PENDING-B'),
+            'D': make_pending_order('D', name='PENDING-D'),
+        }
+        new_orders = {'A': make_pending_order('A')}
+        inserts, updates, item_changes, deletes = diff_pending_orders(
+            existing_orders, new_orders,
+            seen_order_ids={x['OrderID'] for x in orders})
+
+        self.assertEqual(inserts, [])
+        self.assertEqual(updates, [])
+        self.assertEqual(item_changes, [])
+        # B has completed; D was not returned, so is unchanged
+        self.assertEqual(deletes, ['PENDING-B'])
@@ -0,0 +1,67 @@
+// Copyright (c) 2015, Ben Glazier and contributors
+// For license information, please see license.txt
+
+const sync_log_module = 'erpnext_ebay.erpnext_ebay.doctype.ebay_sync_log.ebay_sync_log';
+const SYNC_LOG_PAGE_LENGTH = 100;
+
+const SYNC_LOG_COLUMNS = [
+    ['ebay_change', 'Change'],
+    ['ebay_user_id', 'eBay user ID'],
+    ['customer_name', 'Customer name'],
+    ['customer', 'Customer'],
+    ['address', 'Address'],
+    ['ebay_order', 'eBay order']
+];
+
+function render_sync_log_page(frm, start) {
+    // Load and display a page of log entries from the sync log table
+    const wrapper = frm.get_field('ebay_log_viewer').$wrapper;
+    frappe.call({
+        method: sync_log_module + '.get_sync_log_entries',
+        args: {
+            sync_run: frm.doc.name,
+            start: start,
+            page_length: SYNC_LOG_PAGE_LENGTH
+        }
+    }).then(({message: result}) => {
+        if (!result.total) {
+            wrapper.html('<p class="text-muted">No log entries.</p>');
+            return;
+        }
+        const header = SYNC_LOG_COLUMNS.map(
+            ([field, label]) => `<th>${label}</th>`).join('');
+        const rows = result.entries.map((entry) => {
+            const cells = SYNC_LOG_COLUMNS.map(([field, label]) => {
+                const value = frappe.utils.escape_html(entry[field] || '');
+                return `<td style="white-space: pre-wrap">${value}</td>`;
+            }).join('');
+            return `<tr>${cells}</tr>`;
+        }).join('');
+        const end = start + result.entries.length;
+        wrapper.html(`
+            <div class="sync-log-pager" style="margin-bottom: 10px">
+                <span>Entries ${start + 1}-${end} of ${result.total}</span>
+                <button class="btn btn-xs btn-default sync-log-prev"
+                    ${start > 0 ? '' : 'disabled'}>Previous</button>
+                <button class="btn btn-xs btn-default sync-log-next"
+                    ${end < result.total ? '' : 'disabled'}>Next</button>
+            </div>
+            <table class="table table-bordered table-condensed">
+                <thead><tr>${header}</tr></thead>
+                <tbody>${rows}</tbody>
+            </table>`);
+        wrapper.find('.sync-log-prev').on('click', () => {
+            render_sync_log_page(
+                frm, Math.max(0, start - SYNC_LOG_PAGE_LENGTH));
+        });
+        wrapper.find('.sync-log-next').on('click', () => {
+            render_sync_log_page(frm, start + SYNC_LOG_PAGE_LENGTH);
+        });
+    });
+}
+
+frappe.ui.form.on('eBay sync log', {
+    refresh(frm) {
+        render_sync_log_page(frm, 0);
+    }
+});
@@ -2,10 +2,161 @@
 # Copyright (c) 2015, Ben Glazier and contributors
 # For license information, please see license.txt
 
+"""eBay sync log.
 
+Sync log entries are stored in the append-only zeBaySyncLog table rather
+than as child rows (older logs may still have entries in ebay_log_table).
+Entries are written in bulk by SyncLogWriter, and a summary is rolled up
+onto the eBay sync log document.
+"""
 
+import frappe
 from frappe.model.document import Document
 
+from erpnext_ebay.utils.bulk_sql import BATCH_SIZE, bulk_insert
+
+# Fields stored for each sync log entry
+ENTRY_FIELDS = ('ebay_change', 'ebay_user_id', 'customer_name', 'customer',
+                'address', 'ebay_order')
+
+# Maximum number of change types listed in the summary
+SUMMARY_MAX_LINES = 20
+
 
 class eBaysynclog(Document):
-    pass
+
+    def on_trash(self):
+        """Delete this log's entries from the sync log table."""
+        if not sync_log_table_exists():
+            return
+        frappe.db.sql("""
+            DELETE FROM `zeBaySyncLog` WHERE sync_run = %s
+            """, (self.name,))
+
+
+def sync_log_table_exists():
+    """Return True if the sync log entry table exists."""
+    return bool(frappe.db.sql("SHOW TABLES LIKE 'zeBaySyncLog'"))
+
+
+def ensure_sync_log_table():
+    """Create the sync log entry table if it does not exist.
+
+    Note that this causes an implicit commit if the table is created.
+    """
+    frappe.db.sql("""
+        CREATE TABLE IF NOT EXISTS `zeBaySyncLog`
+        (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            sync_run VARCHAR(140) NOT NULL,
+            creation DATETIME(6) NOT NULL,
+            ebay_change TEXT,
+            ebay_user_id VARCHAR(140),
+            customer_name VARCHAR(140),
+            customer VARCHAR(140),
+            address VARCHAR(140),
+            ebay_order VARCHAR(140),
+            INDEX sync_run_user_order (sync_run, ebay_user_id, ebay_order)
+        );
+        """)
+
+
+class SyncLogWriter():
+    """Append-only writer for eBay sync log entries.
+
+    Entries are appended (like a list of dicts) and buffered in memory,
+    then written to the zeBaySyncLog table in multi-row INSERTs when
+    flush() is called (normally just before a commit). If sync_run is None,
+    entries are discarded.
+    """
+
+    def __init__(self, sync_run, batch_size=BATCH_SIZE):
+        self.sync_run = sync_run
+        self.batch_size = batch_size
+        self.buffer = []
+        if sync_run:
+            ensure_sync_log_table()
+
+    def __str__(self):
+        return f'eBay sync log {self.sync_run}'
+
+    def append(self, change):
+        """Add a change entry (a dict with keys from ENTRY_FIELDS)."""
+        if self.sync_run:
+            self.buffer.append(
+                (self.sync_run, frappe.utils.now_datetime())
+                + tuple(change.get(x) for x in ENTRY_FIELDS)
+            )
+
+    def flush(self):
+        """Write all buffered entries to the database (does not commit)."""
+        buffer, self.buffer = self.buffer, []
+        bulk_insert('zeBaySyncLog', ('sync_run', 'creation') + ENTRY_FIELDS,
+                    buffer, batch_size=self.batch_size)
+
+
+def update_sync_log_summary(sync_run):
+    """Roll up the entry count and a summary by change type onto the
+    eBay sync log (does not commit).
+
+    The log row is locked first, as several background jobs may update
+    the same log.
+    """
+    frappe.db.sql("""
+        SELECT name FROM `tabeBay sync log` WHERE name = %s FOR UPDATE
+        """, (sync_run,))
+    counts = frappe.db.sql("""
+        SELECT ebay_change, COUNT(*) FROM `zeBaySyncLog`
+            WHERE sync_run = %s
+            GROUP BY ebay_change
+            ORDER BY COUNT(*) DESC, ebay_change;
+        """, (sync_run,))
+    total = sum(x[1] for x in counts)
+    summary = [f'{(change or "")[:80]}: {count}'
+               for change, count in counts[:SUMMARY_MAX_LINES]]
+    others = sum(x[1] for x in counts[SUMMARY_MAX_LINES:])
+    if others:
+        summary.append(f'Other: {others}')
+    frappe.db.set_value('eBay sync log', sync_run, {
+        'ebay_log_entries': total,
+        'ebay_log_summary': '\n'.join(summary)
+    }, update_modified=False)
+
+
+@frappe.whitelist()
+def get_sync_log_entries(sync_run, start=0, page_length=100,
+                         ebay_user_id=None, ebay_order=None):
+    """Return a page of entries for an eBay sync log.
+
+    Optionally filter by ebay_user_id and/or ebay_order. Returns a dict
+    with the total number of matching entries and the entries themselves.
+    """
+    frappe.has_permission('eBay sync log', doc=sync_run, throw=True)
+    if not sync_log_table_exists():
+        return {'total': 0, 'entries': []}
+
+    conditions = ['sync_run = %(sync_run)s']
+    if ebay_user_id:
+        conditions.append('ebay_user_id = %(ebay_user_id)s')
+    if ebay_order:
+        conditions.append('ebay_order = %(ebay_order)s')
+    values = {'sync_run': sync_run,
+              'ebay_user_id': ebay_user_id,
+              'ebay_order': ebay_order,
+              'start': int(start),
+              'page_length': min(int(page_length), 1000)}
+    where = ' AND '.join(conditions)
+
+    total = frappe.db.sql(f"""
+        SELECT COUNT(*) FROM `zeBaySyncLog` WHERE {where}
+        """, values)[0][0]
+    entries = frappe.db.sql(f"""
+        SELECT id, creation, {', '.join(ENTRY_FIELDS)}
+            FROM `zeBaySyncLog`
+            WHERE {where}
+            ORDER BY id
+            LIMIT %(start)s, %(page_length)s
+        """, values, as_dict=True)
+
+    return {'total': total, 'entries': entries}
+
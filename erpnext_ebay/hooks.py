@@ -101,6 +101,10 @@ doc_events = {
             "erpnext_ebay.custom_methods.item_methods.item_onload",
         "before_save":
             "erpnext_ebay.custom_methods.item_methods.item_before_save"
+    },
+    "Company": {
+        "on_update": "erpnext_ebay.sync_settings.clear_sync_settings",
+        "after_rename": "erpnext_ebay.sync_settings.clear_sync_settings"
     }
 }
 
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Local cache of eBay listings for each SKU.
+
+The Item form shows Online Selling Items built from the cached listings
+rather than from live GetSellerList calls. Entries are written by
+refresh_listing_cache (all listings in the LISTING_DAYS_BEFORE/AFTER
+window), and the listing sync merges the current active listings into
+them. Revising, relisting or ending listings, or a listing ending, marks
+the entries for those items as stale.
+
+Stale entries, incomplete entries and entries older than the listing
+cache lifetime in eBay Manager Settings are still served, but a
+background refresh is queued. Only an item with no entry at all is
+fetched live.
+"""
+
+import datetime
+import json
+
+import frappe
+from frappe.utils.background_jobs import enqueue
+
+from .utils.bulk_sql import batches, bulk_insert
+
+# Window of listing end dates (days before and after now) that is cached
+LISTING_DAYS_BEFORE = 60
+LISTING_DAYS_AFTER = 59
+
+# Columns of the zeBayListingCache table
+CACHE_FIELDS = ('sku', 'listings', 'complete', 'active', 'fetched')
+
+# Time (seconds) for which a queued refresh blocks further refreshes
+REFRESH_PENDING_EXPIRY = 300
+
+
+def listing_cache_table_exists():
+    """Return True if the listing cache table exists."""
+    return bool(frappe.db.sql("SHOW TABLES LIKE 'zeBayListingCache'"))
+
+
+def ensure_listing_cache_table():
+    """Create the listing cache table if it does not exist.
+
+    Note that this causes an implicit commit if the table is created.
+    """
+    frappe.db.sql("""
+        CREATE TABLE IF NOT EXISTS `zeBayListingCache`
+        (
+            sku VARCHAR(140) PRIMARY KEY,
+            listings MEDIUMTEXT NOT NULL,
+            complete TINYINT NOT NULL DEFAULT 0,
+            active TINYINT NOT NULL DEFAULT 0,
+            fetched DATETIME NULL
+        ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+        """)
+
+
+def is_active(listing):
+    """Return True if a GetSellerList listing is active."""
+    return listing['SellingStatus']['ListingStatus'] == 'Active'
+
+
+def cache_listings(listings_by_sku, complete=False):
+    """Store listings (a dict of SKU: list of GetSellerList listings) in
+    the cache (does not commit).
+
+    complete should be True only if the listings include all listings in
+    the full cache window, not just active listings.
+    """
+    ensure_listing_cache_table()
+    now = frappe.utils.now_datetime()
+    rows = [
+        (sku, json.dumps(listings), int(complete),
+         int(any(is_active(x) for x in listings)), now)
+        for sku, listings in listings_by_sku.items()
+    ]
+    bulk_insert('zeBayListingCache', CACHE_FIELDS, rows,
+                update_fields=CACHE_FIELDS[1:])
+
+
+def merge_active_listings(listings_by_sku):
+    """Merge the active listings from a listings sync (a dict of SKU: list
+    of active GetSellerList listings) into the cache (does not commit).
+
+    Existing entries keep their other listings, complete flag and fetch
+    time, and are only written if their listings have changed. Entries
+    with a cached active listing that is no longer active are marked
+    stale. New entries are incomplete.
+    """
+    ensure_listing_cache_table()
+    existing = {}
+    for batch in batches(listings_by_sku):
+        for sku, listings, complete, fetched in frappe.db.sql("""
+                SELECT sku, listings, complete, fetched
+                    FROM `zeBayListingCache`
+                    WHERE sku IN %(skus)s;
+                """, {'skus': tuple(batch)}):
+            existing[sku] = (json.loads(listings), complete, fetched)
+
+    now = frappe.utils.now_datetime()
+    rows = []
+    ended = set()
+    for sku, active_listings in listings_by_sku.items():
+        if sku not in existing:
+            rows.append((sku, json.dumps(active_listings), 0, 1, now))
+            continue
+        cached, complete, fetched = existing[sku]
+        active_ids = {x['ItemID'] for x in active_listings}
+        if any(is_active(x) and x['ItemID'] not in active_ids
+               for x in cached):
+            ended.add(sku)
+        merged = (
+            [x for x in cached if x['ItemID'] not in active_ids]
+            + active_listings
+        )
+        if ({x['ItemID']: x for x in merged}
+                == {x['ItemID']: x for x in cached}):
+            continue
+        rows.append((sku, json.dumps(merged), complete, 1, fetched))
+    bulk_insert('zeBayListingCache', CACHE_FIELDS, rows,
+                update_fields=CACHE_FIELDS[1:])
+
+    # Items with cached active listings that are no longer listed
+    ended.update(
+        sku for sku, in frappe.db.sql("""
+            SELECT sku FROM `zeBayListingCache` WHERE active;
+            """)
+        if sku not in listings_by_sku
+    )
+    if ended:
+        mark_listings_stale(item_codes=ended)
+
+
+def mark_listings_stale(item_codes=None, ebay_ids=None,
+                        fetched_before=None):
+    """Mark cache entries as stale (does not commit).
+
+    Entries are selected by item code, by the eBay ItemID of the Item,
+    and/or by having been fetched before fetched_before.
+    """
+    if not listing_cache_table_exists():
+        return
+    if item_codes:
+        frappe.db.sql("""
+            UPDATE `zeBayListingCache` SET fetched = NULL
+                WHERE sku IN %(item_codes)s;
+            """, {'item_codes': tuple(item_codes)})
+    if ebay_ids:
+        frappe.db.sql("""
+            UPDATE `zeBayListingCache` AS lc
+                JOIN `tabItem` AS it ON it.name = lc.sku
+                SET lc.fetched = NULL
+                WHERE it.ebay_id IN %(ebay_ids)s;
+            """, {'ebay_ids': tuple(ebay_ids)})
+    if fetched_before:
+        frappe.db.sql("""
+            UPDATE `zeBayListingCache` SET fetched = NULL
+                WHERE fetched < %(fetched_before)s;
+            """, {'fetched_before': fetched_before})
+
+
+def fetch_listings(item_code):
+    """Fetch all listings for an item code in the cache window from
+    GetSellerList, and store them in the cache (does not commit).
+    """
+    from .ebay_get_requests import get_seller_list
+    from .sync_listings import OUTPUT_SELECTOR
+
+    # Get listings from GetSellerList (US site, so we get SiteID)
+    listings = get_seller_list(
+        item_codes=[item_code], site_id=0,
+        output_selector=OUTPUT_SELECTOR, granularity_level='Fine',
+        days_before=LISTING_DAYS_BEFORE, days_after=LISTING_DAYS_AFTER,
+        active_only=False)
+    cache_listings({item_code: listings}, complete=True)
+    return listings
+
+
+def refresh_listing_cache(item_code):
+    """Background job to refresh the cache entry for an item code."""
+    try:
+        fetch_listings(item_code)
+        frappe.db.commit()
+    finally:
+        frappe.cache().delete_value(refresh_pending_key(item_code))
+
+
+def refresh_pending_key(item_code):
+    """Return the cache key flagging a queued refresh for an item code."""
+    return f'erpnext_ebay:listing_cache_refresh:{item_code}'
+
+
+def queue_refresh(item_code):
+    """Queue a background refresh of an item code's cache entry, unless
+    one has recently been queued.
+    """
+    key = refresh_pending_key(item_code)
+    if frappe.cache().get_value(key):
+        return
+    frappe.cache().set_value(key, True,
+                             expires_in_sec=REFRESH_PENDING_EXPIRY)
+    enqueue('erpnext_ebay.listing_cache.refresh_listing_cache',
+            queue='short', job_name=f'eBay listing cache {item_code}',
+            item_code=item_code)
+
+
+def get_listings(item_code):
+    """Return the GetSellerList listings for an item code from the cache.
+
+    If there is no cache entry the listings are fetched live. If the
+    entry is stale, incomplete or older than the listing cache lifetime,
+    the cached listings are returned and a background refresh is queued.
+    """
+    entry = None
+    if listing_cache_table_exists():
+        entry = frappe.db.sql("""
+            SELECT listings, complete, fetched FROM `zeBayListingCache`
+                WHERE sku = %(item_code)s;
+            """, {'item_code': item_code}, as_dict=True)
+    if not entry:
+        return fetch_listings(item_code)
+    entry, = entry
+
+    ttl = frappe.db.get_single_value(
+        'eBay Manager Settings', 'ebay_listing_cache_ttl') or 0
+    expired = (
+        entry.fetched is None
+        or not entry.complete
+        or (frappe.utils.now_datetime() - entry.fetched
+            > datetime.timedelta(minutes=ttl))
+    )
+    if expired:
+        queue_refresh(item_code)
+
+    return json.loads(entry.listings)
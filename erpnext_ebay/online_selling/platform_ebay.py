@@ -4,9 +4,8 @@
 import frappe
 
 from erpnext_ebay.ebay_constants import EBAY_TRANSACTION_SITE_NAMES
-from erpnext_ebay.ebay_get_requests import get_seller_list, get_item
-from erpnext_ebay.sync_listings import (create_ebay_online_selling_item,
-                                        OUTPUT_SELECTOR)
+from erpnext_ebay.listing_cache import get_listings
+from erpnext_ebay.sync_listings import create_ebay_online_selling_item
 from erpnext_ebay.online_selling.platform_base import OnlineSellingPlatformClass
 
 
@@ -29,11 +28,8 @@ class eBayPlatform(OnlineSellingPlatformClass):
 
         site_ids = cls.get_site_ids(subtypes)
 
-        # Get listings from GetSellerList (US site, so we get SiteID)
-        get_seller_listings = get_seller_list(
-            item_codes=[item_code], site_id=0,
-            output_selector=OUTPUT_SELECTOR, granularity_level='Fine',
-            days_before=60, days_after=59, active_only=False)
+        # Get listings from the local listing cache
+        get_seller_listings = get_listings(item_code)
 
         # Find eBay sites of Active listings
         active_ebay_sites = set()
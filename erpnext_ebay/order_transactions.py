@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""Resolve Sell Finances transactions for Sell Fulfillment orders.
+
+Transactions are fetched per order (using the orderId filter, in parallel)
+for small numbers of orders, and with a single transaction date range
+query for large numbers of recent orders. Fetched transactions are cached
+in the zeBayOrderTransactions table, keyed by order ID, and reused while
+the order is unchanged, once eBay has had time to post all of the order's
+transactions.
+"""
+
+import collections
+import datetime
+import json
+import operator
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import redo
+
+from ebay_rest.error import Error as eBayRestError
+
+import frappe
+
+from .ebay_constants import (
+    EBAY_WORKERS, HOME_GLOBAL_ID, REDO_ATTEMPTS, REDO_SLEEPTIME,
+    REDO_SLEEPSCALE, REDO_EXCEPTIONS
+)
+from .ebay_requests_rest import (
+    check_for_warnings, get_transactions, handle_ebay_error
+)
+from .ebay_tokens import get_api
+from .sync_profiler import count_api_calls
+
+# Use a transaction date range query if more than this many orders,
+# created within the range window, need transactions
+RANGE_QUERY_MIN_ORDERS = 20
+# Maximum length of a transaction date range query (days); transactions
+# for orders created before this are fetched individually
+RANGE_QUERY_MAX_DAYS = 14
+# Maximum number of simultaneous single-order fetches
+ORDER_FETCH_WORKERS = min(EBAY_WORKERS, 10)
+# Transactions (e.g. fees) may be posted for some days after an order was
+# last modified; cached transactions fetched within this many days of the
+# order's last modification are fetched again
+FINANCES_POSTING_DAYS = 3
+
+
+def ensure_transactions_table():
+    """Create the order transactions cache table if it does not exist."""
+    frappe.db.sql("""
+        CREATE TABLE IF NOT EXISTS `zeBayOrderTransactions`
+        (
+            order_id VARCHAR(64) PRIMARY KEY,
+            last_modified_date VARCHAR(32) NOT NULL,
+            transactions MEDIUMTEXT NOT NULL,
+            fetched DATETIME NOT NULL
+        );
+        """)
+
+
+def parse_order_date(date_string):
+    """Return a (naive UTC) datetime from a Fulfillment API date."""
+    return datetime.datetime.strptime(
+        date_string[:-1], '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def order_creation_date(order):
+    """Return the creation date of an order from the Fulfillment API."""
+    return parse_order_date(order['creation_date']).date()
+
+
+def has_sale(transactions):
+    """Return True if the transactions include a SALE transaction."""
+    return any(t['transaction_type'] == 'SALE' for t in transactions)
+
+
+def get_cached_transactions(orders):
+    """Return a dict of order_id: transactions from the cache for orders
+    whose last_modified_date is unchanged since the transactions were
+    fetched, and which were fetched at least FINANCES_POSTING_DAYS after
+    the order was last modified.
+    """
+    if not orders:
+        return {}
+    modified_dates = {x['order_id']: x['last_modified_date'] for x in orders}
+    records = frappe.db.sql("""
+        SELECT order_id, last_modified_date, transactions, fetched
+            FROM `zeBayOrderTransactions`
+            WHERE order_id IN %(order_ids)s;
+        """, {'order_ids': tuple(modified_dates)}, as_dict=True)
+    posting_window = datetime.timedelta(days=FINANCES_POSTING_DAYS)
+    return {
+        x.order_id: json.loads(x.transactions) for x in records
+        if x.last_modified_date == modified_dates[x.order_id]
+        and x.fetched >= (parse_order_date(x.last_modified_date)
+                          + posting_window)
+    }
+
+
+def cache_transactions(orders, trans_by_order):
+    """Store fetched transactions in the cache.
+
+    Only orders with a SALE transaction are stored; other orders will be
+    fetched again next time. The fetched time is stored in UTC, as for
+    the order dates.
+    """
+    now = datetime.datetime.utcnow()
+    for order in orders:
+        order_id = order['order_id']
+        transactions = trans_by_order.get(order_id, [])
+        if not has_sale(transactions):
+            continue
+        frappe.db.sql("""
+            REPLACE INTO `zeBayOrderTransactions`
+            VALUES (%(order_id)s, %(last_modified_date)s,
+                    %(transactions)s, %(fetched)s);
+            """, {'order_id': order_id,
+                  'last_modified_date': order['last_modified_date'],
+                  'transactions': json.dumps(transactions),
+                  'fetched': now})
+    frappe.db.commit()
+
+
+def fetch_order_transactions(order_ids, sandbox=False):
+    """Fetch transactions for each order ID using the orderId filter.
+
+    Calls are made in parallel. ebay_rest API objects are not thread-safe,
+    so each worker thread uses its own API object; these are created in
+    the main thread (get_api requires database access).
+    Returns a dict of order_id: transactions.
+    """
+    if not order_ids:
+        return {}
+    n_workers = min(ORDER_FETCH_WORKERS, len(order_ids))
+    apis = [get_api(sandbox=sandbox, marketplace_id=HOME_GLOBAL_ID)
+            for i in range(n_workers)]
+    thread_data = threading.local()
+
+    def fetch(order_id):
+        # Runs in a worker thread - no database or msgprint access
+        if not hasattr(thread_data, 'api'):
+            # One API object per worker thread (list.pop is atomic)
+            thread_data.api = apis.pop()
+        api = thread_data.api
+
+        def get_pages():
+            return list(api.sell_finances_get_transactions(
+                filter=f"orderId:{{{order_id}}}"))
+        return redo.retry(
+            get_pages, attempts=REDO_ATTEMPTS, sleeptime=REDO_SLEEPTIME,
+            sleepscale=REDO_SLEEPSCALE, retry_exceptions=REDO_EXCEPTIONS)
+
+    trans_by_order = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {order_id: executor.submit(fetch, order_id)
+                   for order_id in order_ids}
+        for order_id, future in futures.items():
+            try:
+                pages = future.result()
+            except eBayRestError as e:
+                handle_ebay_error(e)
+            count_api_calls(max(len(pages), 1))
+            if pages:
+                check_for_warnings(pages[0])
+            transactions = []
+            for page in pages:
+                transactions.extend(page['transactions'] or [])
+            trans_by_order[order_id] = transactions
+
+    return trans_by_order
+
+
+def get_transactions_by_order(orders, sandbox=False):
+    """Return a defaultdict of order_id: list of transactions for orders.
+
+    Cached transactions are used where the order has not been modified
+    (see get_cached_transactions).
+    Remaining orders created within the last RANGE_QUERY_MAX_DAYS are
+    fetched with a single date range query if there are at least
+    RANGE_QUERY_MIN_ORDERS of them; all others are fetched individually.
+    """
+    trans_by_order = collections.defaultdict(list)
+    if not orders:
+        return trans_by_order
+
+    # The cache only holds production transactions
+    use_cache = not sandbox
+    if use_cache:
+        ensure_transactions_table()
+        cached = get_cached_transactions(orders)
+        trans_by_order.update(cached)
+    else:
+        cached = {}
+    uncached = [x for x in orders if x['order_id'] not in cached]
+    if not uncached:
+        return trans_by_order
+
+    # Split orders into those that can be covered by a range query and
+    # those that must be fetched individually
+    end_date = datetime.datetime.utcnow().date()
+    window_start = end_date - datetime.timedelta(days=RANGE_QUERY_MAX_DAYS)
+    window_orders = [x for x in uncached
+                     if order_creation_date(x) >= window_start]
+    if len(window_orders) < RANGE_QUERY_MIN_ORDERS:
+        window_orders = []
+    window_ids = {x['order_id'] for x in window_orders}
+    single_ids = [x['order_id'] for x in uncached
+                  if x['order_id'] not in window_ids]
+
+    if window_orders:
+        start_date = min(order_creation_date(x) for x in window_orders)
+        transactions = get_transactions(start_date=start_date,
+                                         end_date=end_date, sandbox=sandbox)
+        for transaction in transactions:
+            order_id = transaction['order_id']
+            if order_id in window_ids:
+                trans_by_order[order_id].append(transaction)
+
+    if single_ids:
+        trans_by_order.update(
+            fetch_order_transactions(single_ids, sandbox=sandbox))
+
+    # Keep transactions in date order, as for a range query
+    for order_id in window_ids.union(single_ids):
+        trans_by_order[order_id].sort(
+            key=operator.itemgetter('transaction_date'))
+
+    if use_cache:
+        cache_transactions(uncached, trans_by_order)
+
+    return trans_by_order
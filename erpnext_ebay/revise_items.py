@@ -11,6 +11,7 @@ import frappe
 
 from erpnext_ebay.ebay_revise_requests import (
     revise_inventory_status, relist_item, end_items)
+from erpnext_ebay.listing_cache import mark_listings_stale
 
 from ebaysdk.exception import ConnectionError
 from ebaysdk.trading import Connection as Trading
@@ -118,24 +119,30 @@ def revise_ebay_inventory(item_data, print=print, error_log=None,
             print(f' - {int(percent)}% complete...')
         prev_percent = percent
 
-        # Submit the updates for these items.
-        for i in range(retries):
-            try:
-                revise_inventory_status(chunked_items)
-            except Exception as e:
-                error_log.append(f'revise_ebay_inventory exception: {e}')
-            else:
-                # Success
-                break
-            print('Retrying transaction...')
-        else:
-            if error_log:
-                # Carry on
-                error_log.append(
-                    f'revise_ebay_inventory failed after {retries} retries')
+        # Submit the updates for these items, then mark their cached
+        # listings stale (even if the revision may have partly failed)
+        try:
+            for i in range(retries):
+                try:
+                    revise_inventory_status(chunked_items)
+                except Exception as e:
+                    error_log.append(f'revise_ebay_inventory exception: {e}')
+                else:
+                    # Success
+                    break
+                print('Retrying transaction...')
             else:
-                # Give up here
-                raise
+                if error_log:
+                    # Carry on
+                    error_log.append(
+                        f'revise_ebay_inventory failed after {retries} '
+                        + 'retries')
+                else:
+                    # Give up here
+                    raise
+        finally:
+            mark_listings_stale(
+                ebay_ids=[x['ItemID'] for x in chunked_items])
 
     print(' - 100% complete.')
 
@@ -164,7 +171,10 @@ def client_revise_ebay_item(item_data):
 def relist_ebay_item(ebay_id, item_dict=None):
     """Relist an eBay listing."""
 
-    relist_item(ebay_id, item_dict=item_dict)
+    try:
+        relist_item(ebay_id, item_dict=item_dict)
+    finally:
+        mark_listings_stale(ebay_ids=[ebay_id])
 
 
 @frappe.whitelist()
@@ -182,7 +192,7 @@ def client_relist_ebay_item(ebay_id, item_dict=None):
     if not isinstance(item_dict, dict):
         frappe.throw('Invalid format for item_dict!')
 
-    relist_item(ebay_id, item_dict=item_dict)
+    relist_ebay_item(ebay_id, item_dict=item_dict)
 
 
 def end_ebay_listings(listings, print=print, **kwargs):
@@ -221,8 +231,13 @@ def end_ebay_listings(listings, print=print, **kwargs):
             print(f' - {int(percent)}% complete...')
         prev_percent = percent
 
-        # Submit the updates for these items.
-        response = end_items(chunked_items)
+        # Submit the updates for these items, then mark their cached
+        # listings stale
+        try:
+            response = end_items(chunked_items)
+        finally:
+            mark_listings_stale(
+                ebay_ids=[x['ItemID'] for x in chunked_items])
         print(response)
 
         print('response[Ack] = ', response['Ack'])
@@ -1,17 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import hashlib
+import html
+import json
 import operator
+import re
+import threading
 from datetime import datetime, timedelta
 
-import bleach
-
 import frappe
 
 from .ebay_get_requests import (
-    get_seller_list, get_item, get_shipping_service_descriptions)
+    ebay_logger, get_seller_list, get_item, get_shipping_service_descriptions)
 from .ebay_constants import (LISTING_DURATION_TOKEN_DICT, EBAY_SITE_IDS,
                              EBAY_TRANSACTION_SITE_NAMES,
                              EBAY_SITE_DOMAINS, HOME_SITE_ID)
+from .listing_cache import merge_active_listings
+from .sync_profiler import profile_stage, profile_sync, stage
+from .utils.bulk_sql import batches, bulk_delete, bulk_insert, fields_differ
 
 from collections.abc import Sequence
 
@@ -45,6 +52,32 @@ OUTPUT_SELECTOR += [
 GET_ITEM_OUTPUT_SELECTOR = [
     x.replace('ItemArray.Item', 'Item') for x in OUTPUT_SELECTOR]
 
+# Maximum number of formatted shipping strings to cache
+SHIPPING_CACHE_SIZE = 256
+
+# Formatted shipping strings by (site, eBay site ID, ShippingDetails hash),
+# in LRU order, and the shipping service descriptions they were formatted
+# with by (site, eBay site ID)
+_shipping_strings = collections.OrderedDict()
+_shipping_descriptions = {}
+_shipping_lock = threading.Lock()
+
+# Template for the listing link (the URL must be HTML-escaped)
+SELLING_URL_TEMPLATE = '<a href="{url}">{url}</a>'
+SAFE_URL_SCHEMES = ('https://', 'http://')
+
+# Online Selling Item fields set from eBay listings
+SELLING_ITEM_FIELDS = (
+    'status', 'selling_platform', 'selling_subtype', 'selling_id',
+    'qty_listed', 'qty_available', 'price_rate', 'price_currency',
+    'tax_rate', 'start_datetime', 'end_datetime', 'title',
+    'ebay_listing_duration', 'ebay_watch_count', 'ebay_question_count',
+    'ebay_hit_count', 'selling_url', 'shipping_options')
+# Standard fields written when inserting rows directly
+CHILD_STANDARD_FIELDS = ('name', 'creation', 'modified', 'owner',
+                         'modified_by', 'docstatus', 'parent', 'parentfield',
+                         'parenttype', 'idx')
+
 
 def get_subtype_site_ids():
     """Get all the supported eBay site IDs."""
@@ -184,6 +217,54 @@ def format_shipping_services(site_id, shipping):
     return '\n'.join(shipping_strings)
 
 
+def format_shipping_services_cached(site_id, shipping):
+    """Memoized version of format_shipping_services.
+
+    Listings mostly share a few shipping profiles, so formatted strings are
+    cached per site and eBay site ID, keyed by a hash of the canonical JSON
+    of the ShippingDetails, with an LRU bound. The cache is cleared when
+    the shipping service descriptions are reloaded.
+    """
+    shipping_json = json.dumps(shipping, sort_keys=True, separators=(',', ':'))
+    key = (frappe.local.site, site_id,
+           hashlib.sha1(shipping_json.encode('utf-8')).digest())
+    descriptions = get_shipping_service_descriptions(site_id=site_id)
+    with _shipping_lock:
+        if _shipping_descriptions.get(key[:2]) != descriptions:
+            # Descriptions (re)loaded; formatted strings may be out of date
+            _shipping_strings.clear()
+            _shipping_descriptions[key[:2]] = descriptions
+        shipping_string = _shipping_strings.get(key)
+        if shipping_string is not None:
+            _shipping_strings.move_to_end(key)
+            return shipping_string
+
+    shipping_string = format_shipping_services(site_id, shipping)
+    with _shipping_lock:
+        _shipping_strings[key] = shipping_string
+        while len(_shipping_strings) > SHIPPING_CACHE_SIZE:
+            _shipping_strings.popitem(last=False)
+    return shipping_string
+
+
+def shipping_cache_clear():
+    """Clear the formatted shipping strings cache."""
+    with _shipping_lock:
+        _shipping_strings.clear()
+        _shipping_descriptions.clear()
+
+
+def format_selling_url(url, site_id):
+    """Return the HTML link for a listing URL on the given eBay site.
+    Only http(s) URLs are linked; anything else is shown as escaped text.
+    """
+    site_domain = EBAY_SITE_DOMAINS[site_id]
+    url = url.replace('ebay.com', f'ebay.{site_domain}')
+    if not url.startswith(SAFE_URL_SCHEMES):
+        return html.escape(url)
+    return SELLING_URL_TEMPLATE.format(url=html.escape(url, quote=True))
+
+
 @frappe.whitelist()
 def sync(site_id=HOME_SITE_ID, update_ebay_id=False):
     """
@@ -195,6 +276,14 @@ def sync(site_id=HOME_SITE_ID, update_ebay_id=False):
     if not frappe.has_permission('eBay Manager'):
         frappe.throw('You do not have permission to access the eBay Manager',
                      frappe.PermissionError)
+
+    with profile_sync('Listings'):
+        run_sync(site_id, update_ebay_id)
+
+
+def run_sync(site_id, update_ebay_id):
+    """Carry out the listings sync for sync."""
+
     frappe.msgprint('Syncing eBay listings...')
 
     # Cast site_id to integer (in case passed from JS)
@@ -206,28 +295,30 @@ def sync(site_id=HOME_SITE_ID, update_ebay_id=False):
     # Get valid site IDs
     valid_site_ids = get_subtype_site_ids()
 
-    # Find all existing Online Selling Items that match eBay
-    all_selling_items = [x['name'] for x in frappe.get_all(
-        'Online Selling Item',
-        filters={'selling_platform': 'eBay'})]
-
-    # Delete all old listing entries matching eBay
-    for selling_item in all_selling_items:
-        frappe.delete_doc('Online Selling Item', selling_item)
-
     # Get a list of all item codes
     item_codes = set(x['name'] for x in frappe.get_all('Item'))
 
     ebay_id_dict = {}
+    new_selling_items = {}
     no_SKU_items = []
     not_found_SKU_items = []
     unsupported_listing_type = []
     multiple_listings = []
 
     # Get data from GetSellerList
-    listings = get_seller_list(site_id=0,  # Use US site
-                               output_selector=OUTPUT_SELECTOR,
-                               granularity_level='Fine')
+    with stage('get_seller_list'):
+        listings = get_seller_list(site_id=0,  # Use US site
+                                   output_selector=OUTPUT_SELECTOR,
+                                   granularity_level='Fine')
+
+    # Merge the active listings into the listing cache; items whose
+    # listings have ended have stale entries
+    with stage('cache_listings'):
+        listings_by_sku = {}
+        for listing in listings:
+            if 'SKU' in listing:
+                listings_by_sku.setdefault(listing['SKU'], []).append(listing)
+        merge_active_listings(listings_by_sku)
 
     for listing in listings:
         # Loop over all listings
@@ -257,7 +348,7 @@ def sync(site_id=HOME_SITE_ID, update_ebay_id=False):
 
         new_listing = create_ebay_online_selling_item(
             listing, item_code, item_site_id, subtype_dict, subtype_tax_dict)
-        new_listing.insert(ignore_permissions=True)
+        new_selling_items[new_listing.selling_id] = new_listing
 
         if item_site_id == site_id:
             if item_code in ebay_id_dict:
@@ -265,20 +356,28 @@ def sync(site_id=HOME_SITE_ID, update_ebay_id=False):
             else:
                 ebay_id_dict[item_code] = listing['ItemID']
 
+    # Update Online Selling Items with the changes since the last sync
+    with stage('load_selling_items'):
+        existing_selling_items = load_ebay_selling_items()
+    with stage('diff_selling_items'):
+        inserts, updates, deletes = diff_selling_items(
+            existing_selling_items, new_selling_items)
+    with stage('apply_selling_items'):
+        apply_selling_item_changes(inserts, updates, deletes)
+
     if update_ebay_id:
-        item_list = [x.item_code for x in
-                     frappe.get_all('Item', fields=['item_code'])]
-        for item_code in item_list:
-            # Loop over every item in the system
-            current_id = frappe.get_value('Item', item_code, 'ebay_id')
-            ebay_id = ebay_id_dict.get(item_code, None)
-
-            if current_id and (not current_id.isdigit()) and not ebay_id:
-                # Current eBay ID is a placeholder; do not remove
-                continue
-            frappe.db.set_value('Item', item_code, 'ebay_id', ebay_id)
+        with stage('update_ebay_ids'):
+            changed_ebay_ids = update_item_ebay_ids(ebay_id_dict)
+        for item_code, old_ebay_id, new_ebay_id in changed_ebay_ids:
+            ebay_logger().info(
+                f'Item {item_code} eBay ID {old_ebay_id} -> {new_ebay_id}')
+    else:
+        changed_ebay_ids = []
 
     messages = [
+        f'{len(inserts)} new, {len(updates)} updated and {len(deletes)} '
+        + 'removed Online Selling Items',
+        f'{len(changed_ebay_ids)} Item eBay IDs updated',
         f'{len(no_SKU_items)} listings had no SKU',
         f'{len(not_found_SKU_items)} listings had an unknown SKU',
         f'{len(unsupported_listing_type)} listings had an unsupported listing '
@@ -296,6 +395,147 @@ def sync(site_id=HOME_SITE_ID, update_ebay_id=False):
     frappe.db.commit()
 
 
+def load_ebay_selling_items():
+    """Load all existing eBay Online Selling Items in a single query.
+
+    Returns a dict of selling_id: row dict. Any further rows with the same
+    selling_id are returned in a list under the key None.
+    """
+    selling_items = {None: []}
+    for row in frappe.db.sql(f"""
+            SELECT name, parent, idx, {', '.join(SELLING_ITEM_FIELDS)}
+                FROM `tabOnline Selling Item`
+                WHERE selling_platform = 'eBay'
+                    AND parenttype = 'Item'
+                    AND parentfield = 'online_selling_items'
+                ORDER BY creation;
+            """, as_dict=True):
+        if row.selling_id in selling_items:
+            selling_items[None].append(row)
+        else:
+            selling_items[row.selling_id] = row
+    return selling_items
+
+
+def diff_selling_items(existing_items, new_items):
+    """Compare existing and new eBay Online Selling Items.
+
+    existing_items is as returned by load_ebay_selling_items; new_items is
+    a dict of selling_id: new Online Selling Item document.
+    Returns a tuple of (new documents to insert, (existing row, new
+    document) pairs to update, names of rows to delete). Listings that
+    have moved to a different item are deleted and reinserted.
+    """
+    inserts = []
+    updates = []
+    deletes = [x.name for x in existing_items[None]]
+    for selling_id, new_item in new_items.items():
+        existing_item = existing_items.get(selling_id)
+        if existing_item is None:
+            inserts.append(new_item)
+        elif existing_item.parent != new_item.parent:
+            deletes.append(existing_item.name)
+            inserts.append(new_item)
+        elif fields_differ(existing_item, new_item, SELLING_ITEM_FIELDS):
+            updates.append((existing_item, new_item))
+    deletes.extend(
+        existing_item.name
+        for selling_id, existing_item in existing_items.items()
+        if selling_id is not None and selling_id not in new_items
+    )
+    return inserts, updates, deletes
+
+
+def apply_selling_item_changes(inserts, updates, deletes):
+    """Apply the changes from diff_selling_items with bulk SQL (does not
+    commit).
+
+    New rows are named as by the document model and appended after the
+    existing Online Selling Items of their Item.
+    """
+    now = frappe.utils.now_datetime()
+    user = frappe.session.user
+
+    bulk_delete('tabOnline Selling Item', 'name', deletes)
+
+    # Find the next free idx for each Item with new rows
+    next_idx = {}
+    parents = {x.parent for x in inserts}
+    if parents:
+        next_idx = {
+            parent: (max_idx or 0) + 1
+            for parent, max_idx in frappe.db.sql("""
+                SELECT parent, MAX(idx) FROM `tabOnline Selling Item`
+                    WHERE parenttype = 'Item' AND parent IN %(parents)s
+                    GROUP BY parent;
+                """, {'parents': tuple(parents)})
+        }
+
+    rows = []
+    for existing_item, new_item in updates:
+        rows.append(
+            (existing_item.name, now, now, user, user, 0,
+             existing_item.parent, 'online_selling_items', 'Item',
+             existing_item.idx)
+            + tuple(new_item.get(x) for x in SELLING_ITEM_FIELDS)
+        )
+    for new_item in inserts:
+        new_item.set_new_name()
+        idx = next_idx.get(new_item.parent, 1)
+        next_idx[new_item.parent] = idx + 1
+        rows.append(
+            (new_item.name, now, now, user, user, 0,
+             new_item.parent, 'online_selling_items', 'Item', idx)
+            + tuple(new_item.get(x) for x in SELLING_ITEM_FIELDS)
+        )
+    bulk_insert(
+        'tabOnline Selling Item',
+        CHILD_STANDARD_FIELDS + SELLING_ITEM_FIELDS,
+        rows,
+        update_fields=('modified', 'modified_by') + SELLING_ITEM_FIELDS
+    )
+
+
+def update_item_ebay_ids(ebay_id_dict):
+    """Set the ebay_id of every Item from ebay_id_dict (item_code: eBay
+    ItemID), clearing it for Items not in ebay_id_dict. Placeholder
+    (non-numeric) eBay IDs are not cleared.
+
+    The changed Items are found from a single query of all Items, and
+    updated with one multi-row UPDATE per batch (no DDL, so this can run
+    after other writes in the same transaction). Returns a list of
+    (item_code, old ebay_id, new ebay_id) for the changed Items.
+    """
+    changed = []
+    for item_code, old_ebay_id in frappe.db.sql("""
+            SELECT name, ebay_id FROM `tabItem`;
+            """):
+        new_ebay_id = ebay_id_dict.get(item_code)
+        if (old_ebay_id or '') == (new_ebay_id or ''):
+            continue
+        if (new_ebay_id is None and old_ebay_id
+                and not re.fullmatch('[0-9]+', old_ebay_id)):
+            # Don't clear placeholders
+            continue
+        changed.append((item_code, old_ebay_id, new_ebay_id))
+
+    now = frappe.utils.now_datetime()
+    for batch in batches(changed):
+        cases = ' '.join(['WHEN %s THEN %s'] * len(batch))
+        values = [x for item_code, old, new in batch for x in (item_code, new)]
+        frappe.db.sql(f"""
+            UPDATE `tabItem`
+                SET ebay_id = CASE name {cases} END,
+                    modified = %s,
+                    modified_by = %s
+                WHERE name IN %s;
+            """, values + [now, frappe.session.user,
+                           tuple(x[0] for x in batch)])
+
+    return changed
+
+
+@profile_stage()
 def create_ebay_online_selling_item(listing, item_code,
                                     site_id=None,
                                     subtype_dict=None,
@@ -333,26 +573,23 @@ def create_ebay_online_selling_item(listing, item_code,
     utc_end_datetime = datetime.strptime(
         listing['ListingDetails']['EndTime'],
         '%Y-%m-%dT%H:%M:%S.%fZ')
-    # Convert eBay UTC time to local time zone:
-    start_datetime = (
-        frappe.utils.convert_utc_to_user_timezone(utc_start_datetime))
-    end_datetime = frappe.utils.convert_utc_to_user_timezone(utc_end_datetime)
+    # Convert eBay UTC time to local time zone
+    # (stored as naive datetimes)
+    start_datetime = frappe.utils.convert_utc_to_user_timezone(
+        utc_start_datetime).replace(tzinfo=None)
+    end_datetime = frappe.utils.convert_utc_to_user_timezone(
+        utc_end_datetime).replace(tzinfo=None)
 
     # Sanitize URL
-    selling_url = '<a href="{link}">{link}</a>'.format(
-        link=listing['ListingDetails']['ViewItemURL'])
-    selling_url = bleach.clean(
-        selling_url, tags=['a'], attributes={'a': ['href']}, styles=[],
-        strip=True, strip_comments=True)
-    site_domain = EBAY_SITE_DOMAINS[site_id]
-    selling_url = selling_url.replace('ebay.com', f'ebay.{site_domain}')
+    selling_url = format_selling_url(
+        listing['ListingDetails']['ViewItemURL'], site_id)
 
     # Quantity (listed) and quantity sold
     qty_listed = int(listing['Quantity'])
     qty_sold = int(listing['SellingStatus'].get('QuantitySold', 0))
 
     # Get formatted shipping string
-    shipping_string = format_shipping_services(
+    shipping_string = format_shipping_services_cached(
         site_id, listing['ShippingDetails'])
 
     # Create listing
@@ -13,14 +13,28 @@ from ebay_rest.error import Error as eBayRestError
 
 from .ebay_get_requests import get_item as get_item_trading, ConnectionError
 from .ebay_requests_rest import get_transactions, get_order, get_payouts
-from .sync_orders_rest import divide_rounded, ErpnextEbaySyncError, VAT_RATES
+from .sync_orders_rest import divide_rounded, ErpnextEbaySyncError
+from .sync_profiler import profile_stage, profile_sync, stage
+from .sync_settings import get_sync_settings
 
 MAX_DAYS = 90
-COMPANY_ACRONYM = frappe.get_all('Company', fields=['abbr'])[0].abbr
 
 FEE_ITEM = 'ITEM-15847'
 EBAY_SUPPLIER = 'eBay'
-DOMESTIC_VAT = VAT_RATES[f'Sales - {COMPANY_ACRONYM}']
+
+# Former module-level company settings, now provided lazily by
+# get_sync_settings() (see __getattr__)
+LAZY_SETTINGS = {
+    'COMPANY_ACRONYM': 'company_acronym',
+    'DOMESTIC_VAT': 'domestic_vat'
+}
+
+
+def __getattr__(name):
+    """Provide the former module-level company settings lazily."""
+    if name in LAZY_SETTINGS:
+        return getattr(get_sync_settings(), LAZY_SETTINGS[name])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def date_range(start_date, end_date):
@@ -138,11 +152,22 @@ def sync_mp_transactions(num_days=None, not_today=False,
     if not frappe.has_permission('eBay Manager', 'write'):
         frappe.throw('You do not have permission to access the eBay Manager',
                      frappe.PermissionError)
+
+    with profile_sync('MP transactions'):
+        run_sync_mp_transactions(num_days, not_today, start_date, end_date,
+                                 payout_account)
+
+
+def run_sync_mp_transactions(num_days, not_today, start_date, end_date,
+                             payout_account):
+    """Carry out the transaction sync for sync_mp_transactions."""
+
     frappe.msgprint('Syncing eBay transactions...')
 
+    settings = get_sync_settings()
     default_currency = get_default_currency()
-    ebay_bank = f'eBay Managed {default_currency} - {COMPANY_ACRONYM}'
-    expense_account = f'eBay Managed Fees - {COMPANY_ACRONYM}'
+    ebay_bank = settings.account(f'eBay Managed {default_currency}')
+    expense_account = settings.account('eBay Managed Fees')
     today = datetime.date.today()
     if payout_account is None:
         payout_account = frappe.get_value(
@@ -174,8 +199,10 @@ def sync_mp_transactions(num_days=None, not_today=False,
     # Load transactions from eBay
     if num_days:
         num_days = min(num_days, MAX_DAYS)
-    transactions = get_transactions(num_days=num_days,
-                                    start_date=start_date, end_date=end_date)
+    with stage('get_transactions'):
+        transactions = get_transactions(num_days=num_days,
+                                        start_date=start_date,
+                                        end_date=end_date)
     transactions.sort(key=operator.itemgetter('transaction_date'))
 
     # Group transactions by date
@@ -183,8 +210,11 @@ def sync_mp_transactions(num_days=None, not_today=False,
     for transaction in transactions:
         transaction_id = transaction['transaction_id']
         # Check for existing PINV entry for this transaction
-        if frappe.get_all('Purchase Invoice Item',
-                          filters={'ebay_transaction_id': transaction_id}):
+        with stage('check_existing_transaction'):
+            existing = frappe.get_all(
+                'Purchase Invoice Item',
+                filters={'ebay_transaction_id': transaction_id})
+        if existing:
             continue
         # Check transaction is not failed
         if transaction['transaction_status'] == 'FAILED':
@@ -232,13 +262,13 @@ def sync_mp_transactions(num_days=None, not_today=False,
             del pinv_doc
             continue
         # Add domestic VAT on eBay fees
-        if DOMESTIC_VAT:
+        if settings.domestic_vat:
             tax_entry = pinv_doc.append('taxes')
             tax_entry.charge_type = 'On Net Total'
-            tax_entry.description = f'VAT ({DOMESTIC_VAT*100}%)'
-            tax_entry.account_head = f'VAT - {COMPANY_ACRONYM}'
+            tax_entry.description = f'VAT ({settings.domestic_vat*100}%)'
+            tax_entry.account_head = settings.vat_account
             tax_entry.included_in_print_rate = True
-            tax_entry.rate = DOMESTIC_VAT * 100
+            tax_entry.rate = settings.domestic_vat * 100
         # If total effect is negative, make a debit note
         # We need to set quantities negative (for debit note to validate)
         # which means we also need to set rates * -1
@@ -249,9 +279,11 @@ def sync_mp_transactions(num_days=None, not_today=False,
                 item.rate = -item.rate
             pinv_doc.is_return = True
         # Save and submit PINV
-        pinv_doc.insert()
+        with stage('purchase_invoice_insert'):
+            pinv_doc.insert()
         if not pinv_doc.flags.do_not_submit:
-            pinv_doc.submit()
+            with stage('purchase_invoice_submit'):
+                pinv_doc.submit()
 
     # Now create Journal Entries for TRANSFER transactions
     for t in transfer_transactions:
@@ -327,8 +359,9 @@ def sync_mp_transactions(num_days=None, not_today=False,
                 }
             ]
         })
-        je_doc.insert()
-        je_doc.submit()
+        with stage('journal_entry'):
+            je_doc.insert()
+            je_doc.submit()
 
     frappe.msgprint('Finished.')
 
@@ -348,7 +381,8 @@ def sync_mp_payouts(num_days=None, payout_account=None):
     frappe.msgprint('Syncing eBay payouts...')
 
     default_currency = get_default_currency()
-    ebay_bank = f'eBay Managed {default_currency} - {COMPANY_ACRONYM}'
+    ebay_bank = get_sync_settings().account(
+        f'eBay Managed {default_currency}')
 
     if num_days is None:
         num_days = int(frappe.get_value(
@@ -441,6 +475,7 @@ def sync_mp_payouts(num_days=None, payout_account=None):
     return
 
 
+@profile_stage()
 def add_pinv_items(transaction, pinv_doc, default_currency, expense_account,
                    transfer_transactions):
     """Add a PINV item or PINV items as required to the PINV doc supplied,
@@ -699,6 +734,7 @@ def find_item_codes(transaction):
     return item_codes
 
 
+@profile_stage()
 def get_item_code_for_item_id(item_id):
     """Get the item code that matches the (legacy?) item ID supplied.
     First search the zeBayListings table, then call Buy Browse get_item."""
@@ -724,6 +760,7 @@ def get_item_code_for_item_id(item_id):
     return item_data['SKU']
 
 
+@profile_stage()
 def get_item_code_for_order(order_id, order_line_item_id=None, item_id=None):
     """Given an eBay order ID and EITHER an order line item ID OR a (legacy?)
     item ID, get the item code.
@@ -4,23 +4,37 @@ using the REST API (Sell-Fulfillment and Sell-Finances).
 """
 
 import collections
+import contextlib
 import datetime
+import hashlib
 import html
+import json
 import operator
 import re
 import sys
+import time
 import traceback
+import zlib
 
 from .country_data import lowercase_country_dict
 from iso3166 import countries, countries_by_name
 
 import frappe
+from frappe.utils.background_jobs import enqueue
 
 from erpnext import get_default_currency
 from erpnext.controllers.sales_and_purchase_return import make_return_doc
 
 from .ebay_constants import EBAY_MARKETPLACE_IDS
-from .ebay_requests_rest import get_orders, get_transactions
+from .erpnext_ebay.doctype.ebay_sync_log.ebay_sync_log import (
+    SyncLogWriter, update_sync_log_summary
+)
+from .ebay_requests_rest import get_orders
+from .order_transactions import get_transactions_by_order
+from .sync_profiler import (
+    profile_stage, profile_sync, set_sync_log, stage
+)
+from .sync_settings import get_sync_settings
 
 # Option to use eBay shipping address name as customer name.
 # eBay does not normally provide buyer name.
@@ -41,6 +55,17 @@ maximum_address_duplicates = 4
 # Maximum number of days that can be polled
 MAX_DAYS = 90
 
+# Commit completed orders after this many orders or this many seconds
+COMMIT_EVERY_ORDERS = 25
+COMMIT_INTERVAL = 10
+
+# Number of background jobs over which to split large order syncs
+ORDER_SYNC_SHARDS = 4
+# Minimum number of orders needed to split the sync into background jobs
+ORDER_SYNC_SHARD_MIN_ORDERS = 50
+# Timeout for each background job (seconds)
+ORDER_SYNC_SHARD_TIMEOUT = 3000
+
 # Should we create a warranty claim with each refund?
 CREATE_WARRANTY_CLAIMS = False
 
@@ -126,9 +151,6 @@ EXTRA_COUNTRIES = {
     'macedonia': 'North Macedonia'
     }
 
-COMPANY_ACRONYM = frappe.get_all('Company', fields=['abbr'])[0].abbr
-WAREHOUSE = f'Main - {COMPANY_ACRONYM}'
-SHIPPING_ITEM = 'ITEM-00358'
 DEDUCT_UK_VAT = True
 
 TAX_DESCRIPTION = {
@@ -140,12 +162,15 @@ TAX_DESCRIPTION = {
     'NOR_VAT': 'Norwegian VAT'
 }
 
-VAT_RATES = {
-    f'Sales - {COMPANY_ACRONYM}': 0.2,
-    f'Sales EU - {COMPANY_ACRONYM}': 0.0,
-    f'Sales Non-EU - {COMPANY_ACRONYM}': 0.0
+# Former module-level company settings, now provided lazily by
+# get_sync_settings() (see __getattr__)
+LAZY_SETTINGS = {
+    'COMPANY_ACRONYM': 'company_acronym',
+    'WAREHOUSE': 'warehouse',
+    'SHIPPING_ITEM': 'shipping_item',
+    'VAT_RATES': 'vat_rates',
+    'VAT_PERCENT': 'vat_percent'
 }
-VAT_PERCENT = {k: 100*v for k, v in VAT_RATES.items()}
 
 # Fee type for (non-refundable) fee type
 EBAY_FIXED_FEE = 'FINAL_VALUE_FEE_FIXED_PER_ORDER'
@@ -153,11 +178,83 @@ EBAY_FIXED_FEE = 'FINAL_VALUE_FEE_FIXED_PER_ORDER'
 # Word used to describe refund
 REFUND_NAME = {'PARTIALLY_REFUNDED': 'Partial', 'FULLY_REFUNDED': 'Full'}
 
+# Order fields consumed by the sync; changes to any of these cause the
+# order to be reprocessed (see order_hash)
+ORDER_HASH_FIELDS = ('order_id', 'order_payment_status', 'buyer',
+                     'buyer_checkout_notes', 'creation_date',
+                     'pricing_summary', 'payment_summary', 'line_items',
+                     'fulfillment_start_instructions')
+
 
 class ErpnextEbaySyncError(Exception):
     pass
 
 
+def __getattr__(name):
+    """Provide the former module-level company settings lazily."""
+    if name in LAZY_SETTINGS:
+        return getattr(get_sync_settings(), LAZY_SETTINGS[name])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+class BatchCommitter():
+    """Commits the database after every COMMIT_EVERY_ORDERS orders, or
+    once COMMIT_INTERVAL seconds have passed since the last commit.
+
+    If supplied, before_commit is called immediately before each commit
+    (e.g. to flush buffered sync log entries).
+    """
+
+    def __init__(self, commit_every=None, commit_interval=None,
+                 before_commit=None):
+        self.commit_every = commit_every or COMMIT_EVERY_ORDERS
+        self.commit_interval = commit_interval or COMMIT_INTERVAL
+        self.before_commit = before_commit
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def order_done(self):
+        """Record a completed order, committing if required."""
+        self.pending += 1
+        if (self.pending >= self.commit_every or
+                time.monotonic() - self.last_commit >= self.commit_interval):
+            self.commit()
+
+    @profile_stage('commit')
+    def commit(self):
+        """Commit the database now."""
+        if self.before_commit:
+            self.before_commit()
+        frappe.db.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+
+@contextlib.contextmanager
+def savepoint(name):
+    """Context manager that creates a database savepoint, and rolls back
+    to the savepoint if an exception is raised.
+
+    If the savepoint no longer exists (because something committed the
+    transaction in the meantime) the whole transaction is rolled back.
+    """
+    frappe.db.sql(f'SAVEPOINT {name}')
+    try:
+        yield
+    except BaseException:
+        try:
+            frappe.db.sql(f'ROLLBACK TO SAVEPOINT {name}')
+        except Exception:
+            frappe.db.rollback()
+        raise
+    else:
+        try:
+            frappe.db.sql(f'RELEASE SAVEPOINT {name}')
+        except Exception:
+            # Savepoint lost after an intermediate commit
+            pass
+
+
 def debug_msgprint(message):
     """Simple wrapper for msgprint that also prints to the console.
 
@@ -169,7 +266,7 @@ def debug_msgprint(message):
 
 
 @frappe.whitelist()
-def sync_orders(num_days=None, sandbox=False):
+def sync_orders(num_days=None, sandbox=False, skip_unchanged=True):
     """
     Pulls the latest orders from eBay. Creates Sales Invoices for sold items.
 
@@ -185,6 +282,15 @@ def sync_orders(num_days=None, sandbox=False):
     Finally we create or update a Sales Invoice based on the eBay
     transaction. This is only created if the order is completed (i.e. paid).
 
+    Large syncs are split by buyer into ORDER_SYNC_SHARDS shards, each of
+    which is processed by a background job on the 'long' queue; all the
+    shards add their entries to a single eBay sync log (entries are
+    stored in the sync log table; see SyncLogWriter).
+
+    If skip_unchanged is true, orders whose hash (see order_hash) matches
+    the hash stored on the eBay order at the last successful sync are
+    skipped without any further processing.
+
     If we raise an ErpnextEbaySyncError during processing of an
     order, then we rollback the database and continue to the next
     order. If a more serious exception occurs, then we rollback the
@@ -196,100 +302,163 @@ def sync_orders(num_days=None, sandbox=False):
         frappe.throw('You do not have permission to access the eBay Manager',
                      frappe.PermissionError)
     frappe.msgprint('Syncing eBay orders...')
+    if isinstance(skip_unchanged, str):
+        skip_unchanged = json.loads(skip_unchanged)
+
+    with profile_sync('Orders'):
+        run_sync_orders(num_days, sandbox, skip_unchanged)
+
+
+def run_sync_orders(num_days, sandbox, skip_unchanged):
+    """Carry out the order sync for sync_orders."""
 
     # Load orders from Ebay
     if num_days is None:
         num_days = int(frappe.get_value(
             'eBay Manager Settings', filters=None, fieldname='ebay_sync_days'))
-    orders = get_orders(min(num_days, MAX_DAYS), sandbox=sandbox)
+    with stage('get_orders'):
+        orders = get_orders(min(num_days, MAX_DAYS), sandbox=sandbox)
+
+    # Hash orders before processing (which can modify the order data)
+    # and drop those that have not changed since the last sync
+    with stage('hash_orders'):
+        order_hashes = {
+            order['order_id']: order_hash(order) for order in orders
+        }
+        num_unchanged = 0
+        if skip_unchanged and orders:
+            stored_hashes = get_stored_order_hashes(list(order_hashes))
+            orders = [
+                order for order in orders
+                if stored_hashes.get(order['order_id'])
+                != order_hashes[order['order_id']]
+            ]
+            num_unchanged = len(order_hashes) - len(orders)
+
+    # Load transactions from eBay (or the cache) for these orders
+    with stage('get_transactions'):
+        trans_by_order = get_transactions_by_order(orders, sandbox=sandbox)
+
+    # Create a synchronization log; entries are added to the sync log
+    # table as we go
+    log_name = None
+    if use_sync_log:
+        log = frappe.get_doc({"doctype": "eBay sync log",
+                              "ebay_sync_datetime": datetime.datetime.now(),
+                              "ebay_sync_days": num_days})
+        log.insert(ignore_permissions=True)
+        frappe.db.commit()
+        log_name = log.name
+        set_sync_log(log_name)
+    msgprint_log = []
+    if num_unchanged:
+        msgprint_log.append(f'Skipped {num_unchanged} unchanged orders.')
+
+    shards = partition_orders(orders)
+    if len(shards) > 1:
+        # Each shard job adds its entries to the sync log
+        for shard_id, shard_orders in enumerate(shards):
+            shard_order_ids = {x['order_id'] for x in shard_orders}
+            enqueue(
+                'erpnext_ebay.sync_orders_rest.sync_orders_shard',
+                queue='long', timeout=ORDER_SYNC_SHARD_TIMEOUT,
+                job_name=f'eBay Order Sync (shard {shard_id})',
+                orders=shard_orders,
+                order_hashes={k: v for k, v in order_hashes.items()
+                              if k in shard_order_ids},
+                trans_by_order={k: v for k, v in trans_by_order.items()
+                                if k in shard_order_ids},
+                log_name=log_name)
+        msgprint_log.append(
+            f'Syncing {len(orders)} orders in {len(shards)} background jobs.')
+        frappe.msgprint(msgprint_log)
+        return
+
+    changes = SyncLogWriter(log_name)
+    try:
+        process_orders(orders, order_hashes, trans_by_order,
+                       changes, msgprint_log)
+    finally:
+        # Save the log, regardless of how far we got
+        finish_sync_log(changes)
+    msgprint_log.append('Finished.')
+    frappe.msgprint(msgprint_log)
+    return
+
+
+def partition_orders(orders):
+    """Partition orders into shards for parallel processing.
 
-    # Get earliest creation date
-    creation_dates = []
+    Orders are partitioned by buyer username, so that all the orders for a
+    given buyer (and so all Customer and Address creation for that buyer)
+    are handled by a single shard. Returns a list of non-empty lists of
+    orders; a single shard is returned for small syncs.
+    """
+    if ORDER_SYNC_SHARDS < 2 or len(orders) < ORDER_SYNC_SHARD_MIN_ORDERS:
+        return [orders] if orders else []
+    shards = [[] for i in range(ORDER_SYNC_SHARDS)]
     for order in orders:
-        creation_dates.append(datetime.datetime.strptime(
-            order['creation_date'][:-1], '%Y-%m-%dT%H:%M:%S.%f').date()
-        )
-    trans_start_date = min(creation_dates)
-    trans_end_date = datetime.datetime.utcnow().date()
-
-    # Load transactions from eBay
-    transactions = get_transactions(start_date=trans_start_date,
-                                    end_date=trans_end_date, sandbox=sandbox)
-    trans_by_order = collections.defaultdict(list)
-    for transaction in transactions:
-        order_id = transaction['order_id']
-        if order_id:
-            trans_by_order[order_id].append(transaction)
-
-    # Create a synchronization log
-    log_dict = {"doctype": "eBay sync log",
-                "ebay_sync_datetime": datetime.datetime.now(),
-                "ebay_sync_days": num_days,
-                "ebay_log_table": []}
-    changes = []
-    msgprint_log = []
+        username = order['buyer']['username'] or ''
+        shards[zlib.crc32(username.encode()) % ORDER_SYNC_SHARDS].append(order)
+    return [shard for shard in shards if shard]
+
+
+def sync_orders_shard(orders, order_hashes, trans_by_order, log_name):
+    """Process a shard of orders as a background job.
+
+    Called from sync_orders. Changes and error messages are added to the
+    existing eBay sync log log_name (if use_sync_log is true).
+    """
+    with profile_sync('Orders', sync_log=log_name):
+        changes = SyncLogWriter(log_name)
+        msgprint_log = []
+        try:
+            process_orders(orders, order_hashes, trans_by_order,
+                           changes, msgprint_log)
+        finally:
+            # Save the log, regardless of how far we got
+            for message in msgprint_log:
+                sync_error(changes, message)
+            finish_sync_log(changes)
+
+
+def finish_sync_log(changes):
+    """Write any remaining sync log entries, update the log summary
+    and commit.
+    """
+    frappe.db.commit()
+    changes.flush()
+    if changes.sync_run:
+        update_sync_log_summary(changes.sync_run)
+    frappe.db.commit()
+
 
+def process_orders(orders, order_hashes, trans_by_order, changes,
+                   msgprint_log):
+    """Process a list of orders in turn, creating/updating Customers,
+    Addresses, eBay orders and Sales Invoices.
+
+    Each order is processed within its own savepoint; if an error occurs
+    the database is rolled back to that savepoint and we continue to the
+    next order (unless the error is not an ErpnextEbaySyncError and
+    continue_on_error is false). Completed orders are committed in batches
+    (see BatchCommitter).
+    """
+    committer = BatchCommitter(before_commit=getattr(changes, 'flush', None))
     try:
         for order in orders:
             try:
-                # Identify the eBay site on which the item was listed.
-                listing_site = 'EBAY_UNKNOWN'
-                purchase_site = 'EBAY_UNKNOWN'
-                try:
-                    listing_marketplaces = {
-                        x['listing_marketplace_id'] for x in order['line_items']
-                    }
-                    purchase_marketplaces = {
-                        x['purchase_marketplace_id']
-                        for x in order['line_items']
-                    }
-                    if len(listing_marketplaces) != 1:
-                        msgprint_log.append(
-                            'WARNING: unable to identify listing eBay site '
-                            + f"from \n{order['line_items']}\n")
-                    else:
-                        listing_site_id, = listing_marketplaces
-                        listing_site = EBAY_MARKETPLACE_IDS[listing_site_id]
-                    if len(purchase_marketplaces) != 1:
-                        msgprint_log.append(
-                            'WARNING: unable to identify purchase eBay site '
-                            + f"from \n{order['line_items']}\n")
-                    else:
-                        purchase_site_id, = purchase_marketplaces
-                        purchase_site = EBAY_MARKETPLACE_IDS[purchase_site_id]
-                except (KeyError, TypeError) as e:
-                    msgprint_log.append(
-                        'WARNING: unable to identify listing/purchase eBay site '
-                        + 'from\n{}\n{}'.format(
-                            order['line_items'], str(e)))
-
-                # Create/update Customer
-                cust_details, address_details = extract_customer(order)
-                db_cust_name, db_address_name = create_customer(
-                    cust_details, address_details, changes)
-
-                # Create/update eBay Order
-                order_details, payment_status = extract_order_info(
-                    order, db_cust_name, db_address_name, changes)
-                create_ebay_order(order_details, payment_status, changes)
-
-                # Create Sales Invoice
-                create_sales_invoice(
-                    order_details, order, listing_site, purchase_site,
-                    trans_by_order, changes
-                )
-
-                # Create Sales Invoice refund
-                create_return_sales_invoice(order_details, order, changes)
+                with savepoint('ebay_order'):
+                    process_order(order, order_hashes[order['order_id']],
+                                  trans_by_order, changes, msgprint_log)
+                committer.order_done()
 
             except ErpnextEbaySyncError as e:
                 # Continue to next order
-                frappe.db.rollback()
                 msgprint_log.append(str(e))
                 print(e)
             except Exception as e:
                 # Continue to next order
-                frappe.db.rollback()
                 err_msg = traceback.format_exc()
                 print(err_msg)
                 if not continue_on_error:
@@ -297,23 +466,118 @@ def sync_orders(num_days=None, sandbox=False):
                     raise
                 else:
                     msgprint_log.append('ORDER FAILED:\n{}'.format(err_msg))
-
     finally:
-        # Save the log, regardless of how far we got
-        frappe.db.commit()
-        for change in changes:
-            log_dict['ebay_log_table'].append(change)
-        log = frappe.get_doc(log_dict)
-        if use_sync_log:
-            log.insert(ignore_permissions=True)
+        # Commit any remaining completed orders
+        committer.commit()
+
+
+def process_order(order, order_hash_value, trans_by_order, changes,
+                  msgprint_log):
+    """Process a single order from the eBay Sell Fulfillment API."""
+
+    # Identify the eBay site on which the item was listed.
+    listing_site = 'EBAY_UNKNOWN'
+    purchase_site = 'EBAY_UNKNOWN'
+    try:
+        listing_marketplaces = {
+            x['listing_marketplace_id'] for x in order['line_items']
+        }
+        purchase_marketplaces = {
+            x['purchase_marketplace_id']
+            for x in order['line_items']
+        }
+        if len(listing_marketplaces) != 1:
+            msgprint_log.append(
+                'WARNING: unable to identify listing eBay site '
+                + f"from \n{order['line_items']}\n")
         else:
-            del log
-        frappe.db.commit()
-    msgprint_log.append('Finished.')
-    frappe.msgprint(msgprint_log)
-    return
+            listing_site_id, = listing_marketplaces
+            listing_site = EBAY_MARKETPLACE_IDS[listing_site_id]
+        if len(purchase_marketplaces) != 1:
+            msgprint_log.append(
+                'WARNING: unable to identify purchase eBay site '
+                + f"from \n{order['line_items']}\n")
+        else:
+            purchase_site_id, = purchase_marketplaces
+            purchase_site = EBAY_MARKETPLACE_IDS[purchase_site_id]
+    except (KeyError, TypeError) as e:
+        msgprint_log.append(
+            'WARNING: unable to identify listing/purchase eBay site '
+            + 'from\n{}\n{}'.format(
+                order['line_items'], str(e)))
+
+    # Create/update Customer
+    cust_details, address_details = extract_customer(order)
+    db_cust_name, db_address_name = create_customer(
+        cust_details, address_details, changes)
+
+    # Create/update eBay Order
+    order_details, payment_status = extract_order_info(
+        order, db_cust_name, db_address_name, changes)
+    create_ebay_order(order_details, payment_status, changes)
+
+    # Create Sales Invoice
+    create_sales_invoice(
+        order_details, order, listing_site, purchase_site,
+        trans_by_order, changes
+    )
+
+    # Create Sales Invoice refund
+    create_return_sales_invoice(order_details, order, changes)
 
+    # Record the order hash so that we can skip this order
+    # until it changes
+    store_order_hash(order_details['ebay_order_id'], order_hash_value)
 
+
+def order_hash(order):
+    """Return a canonical hash of the order fields consumed by the sync.
+
+    The hash is calculated over ORDER_HASH_FIELDS using a canonical JSON
+    representation (sorted keys, no whitespace) so that it does not depend
+    on the order in which eBay returns keys.
+    """
+    order_data = {key: order.get(key) for key in ORDER_HASH_FIELDS}
+    order_json = json.dumps(order_data, sort_keys=True,
+                            separators=(',', ':'), default=str)
+    return hashlib.sha256(order_json.encode()).hexdigest()
+
+
+def get_stored_order_hashes(order_ids):
+    """Return a dict of order_id: stored hash for the given eBay order IDs.
+
+    Orders without an eBay order document or without a stored hash are
+    not included.
+    """
+    if not order_ids:
+        return {}
+    records = frappe.get_all(
+        'eBay order',
+        fields=['ebay_order_id', 'ebay_order_hash'],
+        filters={'ebay_order_id': ['in', order_ids],
+                 'ebay_order_hash': ['is', 'set']}
+    )
+    return {x.ebay_order_id: x.ebay_order_hash for x in records}
+
+
+@profile_stage()
+def store_order_hash(ebay_order_id, hash_value):
+    """Store the order hash on the eBay order, if processing is finished.
+
+    The hash is only stored once the order has a submitted Sales Invoice;
+    until then (e.g. incomplete payment, draft Sales Invoice, old unlinked
+    Sales Invoice) the order must be processed on each sync.
+    """
+    if not frappe.db.exists('eBay order', ebay_order_id):
+        return
+    if not frappe.db.exists('Sales Invoice', {'ebay_order_id': ebay_order_id,
+                                              'docstatus': 1}):
+        return
+    frappe.db.set_value('eBay order', ebay_order_id, 'ebay_order_hash',
+                        hash_value, update_modified=False)
+
+
+@profile_stage()
 def extract_customer(order):
     """Process an order, and extract limited customer information.
 
@@ -441,6 +705,7 @@ def extract_customer(order):
     return customer_dict, address_dict
 
 
+@profile_stage()
 def create_customer(customer_dict, address_dict, changes=None):
     """Process an order and add the customer; add customer address.
     Does not duplicate entries where possible.
@@ -455,8 +720,6 @@ def create_customer(customer_dict, address_dict, changes=None):
     if changes is None:
         changes = []
 
-    updated_db = False
-
     # Test if the customer already exists
     db_cust_name = None
     ebay_user_id = customer_dict['ebay_user_id']
@@ -470,10 +733,23 @@ def create_customer(customer_dict, address_dict, changes=None):
         # We don't have a customer with a matching ebay_user_id
         # Add the customer
         cust_doc = frappe.get_doc(customer_dict)
-        cust_doc.insert()
+        try:
+            with stage('customer_insert'), savepoint('ebay_customer'):
+                cust_doc.insert()
+        except frappe.DuplicateEntryError:
+            # A customer with the same name already exists, or is being
+            # added by another shard (which cannot be seen until it
+            # commits). Each eBay user is only synced by one shard, so
+            # name the customer after the eBay user ID as well.
+            cust_doc = frappe.get_doc(customer_dict)
+            cust_doc.flags.name_set = True
+            cust_doc.name = (
+                frappe.utils.cstr(cust_doc.customer_name).strip()
+                + ' - ' + ebay_user_id)
+            with stage('customer_insert'), savepoint('ebay_customer'):
+                cust_doc.insert()
         db_cust_name = cust_doc.name
         frappe.db.set_value('Customer', db_cust_name, 'represents_company', None)  # Workaround
-        updated_db = True
         debug_msgprint('Adding a user: ' + ebay_user_id +
                        ' : ' + customer_dict['customer_name'])
         changes.append({"ebay_change": "Adding a user",
@@ -511,10 +787,11 @@ def create_customer(customer_dict, address_dict, changes=None):
         for key in keys:
             filters[key] = address_dict[key] or ''
 
-        address_queries = frappe.db.get_all(
-            "Address",
-            fields=["name"],
-            filters=filters)
+        with stage('address_match'):
+            address_queries = frappe.db.get_all(
+                "Address",
+                fields=["name"],
+                filters=filters)
 
         if len(address_queries) >= 1:
             # We have found a matching address; add eBay AddressID
@@ -531,7 +808,6 @@ def create_customer(customer_dict, address_dict, changes=None):
                 link_doc.link_doctype = 'Customer'
                 link_doc.link_name = db_cust_name
             address_doc.save()
-            updated_db = True
             # Update the customer territory, if required
             if cust_fields:
                 territory = determine_territory(address_doc.country)
@@ -547,12 +823,12 @@ def create_customer(customer_dict, address_dict, changes=None):
             'link_name': db_cust_name}]
         address_doc = frappe.get_doc(address_dict)
         try:
-            address_doc.insert()
+            with stage('address_insert'), savepoint('ebay_address'):
+                address_doc.insert()
 
         except frappe.DuplicateEntryError as e:
             # An address based on address_title autonaming already exists
             # Get new doc, add a digit to the name and retry
-            frappe.db.rollback()
             for suffix_id in range(1, maximum_address_duplicates+1):
                 address_doc = frappe.get_doc(address_dict)
                 address_doc.flags.name_set = True
@@ -561,10 +837,10 @@ def create_customer(customer_dict, address_dict, changes=None):
                                     + frappe.utils.cstr(address_doc.address_type).strip()
                                     + "-" + str(suffix_id))
                 try:
-                    address_doc.insert()
+                    with stage('address_insert'), savepoint('ebay_address'):
+                        address_doc.insert()
                     break
                 except frappe.DuplicateEntryError:
-                    frappe.db.rollback()
                     continue
             else:
                 raise ValueError('Too many duplicate entries of this address!')
@@ -574,15 +850,11 @@ def create_customer(customer_dict, address_dict, changes=None):
         if territory != frappe.db.get_value('Customer', db_cust_name,
                                             'territory'):
             frappe.set_value('Customer', db_cust_name, 'territory', territory)
-        updated_db = True
-
-    # Commit changes to database
-    if updated_db:
-        frappe.db.commit()
 
     return db_cust_name, db_address_name
 
 
+@profile_stage()
 def extract_order_info(order, db_cust_name, db_address_name, changes=None):
     """Process an order, and extract limited transaction information.
     order - a single order entry from the eBay Fulfillment API.
@@ -613,6 +885,7 @@ def extract_order_info(order, db_cust_name, db_address_name, changes=None):
     return order_dict, payment_status
 
 
+@profile_stage()
 def create_ebay_order(order_dict, payment_status, changes):
     """Process an eBay order and add eBay order document.
     Does not duplicate entries where possible.
@@ -628,8 +901,6 @@ def create_ebay_order(order_dict, payment_status, changes):
     if changes is None:
         changes = []
 
-    updated_db = False
-
     ebay_order_id = order_dict['ebay_order_id']
     ebay_user_id = order_dict['ebay_user_id']
 
@@ -659,7 +930,6 @@ def create_ebay_order(order_dict, payment_status, changes):
                         "customer": cust_fields['name'],
                         "address": order_dict['address'],
                         "ebay_order": order_doc.name})
-        updated_db = True
 
     else:
         # Order already exists
@@ -675,19 +945,16 @@ def create_ebay_order(order_dict, payment_status, changes):
                         "address": order_fields['address'],
                         "ebay_order": order_fields["name"]})
 
-    # Commit changes to database
-    if updated_db:
-        frappe.db.commit()
-
     return None
 
 
+@profile_stage()
 def create_sales_invoice(order_dict, order, listing_site, purchase_site,
                          trans_by_order, changes):
     """
     Create a Sales Invoice from the eBay order.
     """
-    updated_db = False
+    settings = get_sync_settings()
 
     # Don't create SINV from incomplete order
     if order['order_payment_status'] in ('FAILED', 'PENDING'):
@@ -767,7 +1034,7 @@ def create_sales_invoice(order_dict, order, listing_site, purchase_site,
         income_account, ship_income_account, tax_income_account
     ) = determine_income_accounts(country)
     territory = determine_territory(country)
-    vat_rate = VAT_RATES[income_account]
+    vat_rate = settings.vat_rates[income_account]
 
     # With eBay Managed Payments, only get paid in 'home' currency
     # Need to deal with conversions if paid in foreign currency so that fees
@@ -1021,7 +1288,7 @@ def create_sales_invoice(order_dict, order, listing_site, purchase_site,
         sinv_items.append({
             "item_code": sku,
             "description": description,
-            "warehouse": WAREHOUSE,
+            "warehouse": settings.warehouse,
             "qty": qty,
             "rate": exc_vat / qty,
             "ebay_final_value_fee": item_fee_dict.get(line_item_id, 0.0),
@@ -1036,7 +1303,7 @@ def create_sales_invoice(order_dict, order, listing_site, purchase_site,
             "ebay_item_id": line_item['legacy_item_id'],
             "valuation_rate": 0.0,
             "income_account": income_account,
-            "expense_account": f"Cost of Goods Sold - {COMPANY_ACRONYM}"
+            "expense_account": settings.cogs_account
          })
 
     # Total of all eBay Collect and Remit taxes
@@ -1055,14 +1322,14 @@ def create_sales_invoice(order_dict, order, listing_site, purchase_site,
         sum_line_items += inc_vat
 
         sinv_items.append({
-            "item_code": SHIPPING_ITEM,
+            "item_code": settings.shipping_item,
             "description": "Shipping costs (from eBay)",
-            "warehouse": WAREHOUSE,
+            "warehouse": settings.warehouse,
             "qty": 1.0,
             "rate": exc_vat,
             "valuation_rate": 0.0,
             "income_account": ship_income_account,
-            "expense_account": f"Cost of Goods Sold - {COMPANY_ACRONYM}"
+            "expense_account": settings.cogs_account
         })
 
     sum_line_items = round(sum_line_items, 2)
@@ -1107,12 +1374,12 @@ def create_sales_invoice(order_dict, order, listing_site, purchase_site,
         # If eBay have already deducted UK VAT then no more is payable
         sum_vat -= car_by_type['UK_VAT']
     taxes = []
-    if VAT_RATES[income_account] > 0.00001:
+    if settings.vat_rates[income_account] > 0.00001:
         taxes.append({
             "charge_type": "Actual",
-            "description": f"VAT {VAT_PERCENT[income_account]}%",
-            "account_head": f"VAT - {COMPANY_ACRONYM}",
-            "rate": VAT_PERCENT[income_account],
+            "description": f"VAT {settings.vat_percent[income_account]}%",
+            "account_head": settings.vat_account,
+            "rate": settings.vat_percent[income_account],
             "tax_amount": sum_vat
         })
 
@@ -1169,16 +1436,18 @@ def create_sales_invoice(order_dict, order, listing_site, purchase_site,
     }
 
     sinv = frappe.get_doc(sinv_dict)
-    sinv.run_method('erpnext_ebay_before_insert')
-    sinv.insert()
-    sinv.run_method('erpnext_ebay_after_insert')
+    with stage('sales_invoice_insert'):
+        sinv.run_method('erpnext_ebay_before_insert')
+        sinv.insert()
+        sinv.run_method('erpnext_ebay_after_insert')
 
     if sinv.outstanding_amount:
         debug_msgprint(f'Sales Invoice: {sinv.name} has an outstanding amount!')
     elif submit_on_pay:
         # This is an order which adds up and has an approved payment method
         # Submit immediately
-        sinv.submit()
+        with stage('sales_invoice_submit'):
+            sinv.submit()
 
     debug_msgprint('Adding Sales Invoice: ' + ebay_user_id + ' : ' + sinv.name)
     changes.append({"ebay_change": "Adding Sales Invoice",
@@ -1188,17 +1457,16 @@ def create_sales_invoice(order_dict, order, listing_site, purchase_site,
                     "address": db_address_name,
                     "ebay_order": ebay_order_id})
 
-    # Commit changes to database
-    frappe.db.commit()
-
     return
 
 
+@profile_stage()
 def create_return_sales_invoice(order_dict, order, changes):
     """
     If the order has been refunded, Create a Sales Invoice return from
     the eBay order.
     """
+    shipping_item = get_sync_settings().shipping_item
 
     # Check there is a refund.
     if order['order_payment_status'] not in ('FULLY_REFUNDED',
@@ -1275,7 +1543,8 @@ def create_return_sales_invoice(order_dict, order, changes):
 
     # Create a return Sales Invoice for the relevant quantities and amount.
     sinv_doc = frappe.get_doc('Sales Invoice', sinv_name)
-    return_doc = make_return_doc("Sales Invoice", sinv_name)
+    with stage('make_return_doc'):
+        return_doc = make_return_doc("Sales Invoice", sinv_name)
     return_doc.update_stock = False
     return_doc.posting_date = posting_date.date()
     return_doc.posting_time = posting_date.time()
@@ -1330,12 +1599,12 @@ def create_return_sales_invoice(order_dict, order, changes):
         # other items
         non_shipping_total = sum(
             x.amount for x in sinv_doc.items
-            if x.item_code != SHIPPING_ITEM
+            if x.item_code != shipping_item
         )
         if ex_tax_refund < non_shipping_total:
             # We can remove shipping items
             return_doc.items[:] = [
-                x for x in return_doc.items if x.item_code != SHIPPING_ITEM
+                x for x in return_doc.items if x.item_code != shipping_item
             ]
 
         # Get return items in quantity order
@@ -1388,7 +1657,8 @@ def create_return_sales_invoice(order_dict, order, changes):
         if sum(round(x.amount, 2) for x in return_doc.items) != -ex_tax_refund:
             raise ErpnextEbaySyncError('Problem calculating refund rates!')
 
-    return_doc.insert()
+    with stage('return_sales_invoice_insert'):
+        return_doc.insert()
     #return_doc.submit()
 
     if CREATE_WARRANTY_CLAIMS:
@@ -1433,9 +1703,6 @@ def create_return_sales_invoice(order_dict, order, changes):
                         "address": order_dict['address'],
                         "ebay_order": ebay_order_id})
 
-    # Commit changes to database
-    frappe.db.commit()
-
 
 def determine_territory(country):
     """Determine correct UK, EU or non-EU territory for Customer."""
@@ -1450,24 +1717,25 @@ def determine_territory(country):
 
 def determine_income_accounts(country):
     """Determine correct UK, EU or non-EU income accounts."""
+    settings = get_sync_settings()
     if (not country) or country == 'United Kingdom':
         return (
-            f'Sales - {COMPANY_ACRONYM}',
-            f'Shipping (Sales) - {COMPANY_ACRONYM}',
-            f'Sales Tax UK - {COMPANY_ACRONYM}'
+            settings.account('Sales'),
+            settings.account('Shipping (Sales)'),
+            settings.account('Sales Tax UK')
         )
 
     if country in EU_COUNTRIES:
         return (
-            f'Sales EU - {COMPANY_ACRONYM}',
-            f'Shipping EU (Sales) - {COMPANY_ACRONYM}',
-            f'Sales Tax EU - {COMPANY_ACRONYM}'
+            settings.account('Sales EU'),
+            settings.account('Shipping EU (Sales)'),
+            settings.account('Sales Tax EU')
         )
 
     return (
-        f'Sales Non-EU - {COMPANY_ACRONYM}',
-        f'Shipping Non-EU (Sales) - {COMPANY_ACRONYM}',
-        f'Sales Tax Non-EU - {COMPANY_ACRONYM}'
+        settings.account('Sales Non-EU'),
+        settings.account('Shipping Non-EU (Sales)'),
+        settings.account('Sales Tax Non-EU')
     )
 
 
@@ -9,21 +9,41 @@ import operator
 
 import frappe
 
-from .ebay_get_requests import (
-    get_orders, get_shipping_service_descriptions, ConnectionError)
+from .ebay_get_requests import get_orders, get_shipping_service_descriptions
 from .ebay_constants import (
     EBAY_TRANSACTION_SITE_IDS, EBAY_TRANSACTION_SITE_NAMES
 )
 from .sync_orders_rest import sanitize_country_code
+from .sync_profiler import profile_sync, stage
+from .utils.bulk_sql import bulk_delete, bulk_insert, fields_differ
 
 
 # Maximum number of days that should be polled
 MAX_DAYS = 90
+# Maximum age of the watermark for an incremental sync (eBay limits
+# modification time ranges to 30 days)
+MAX_MOD_TIME_DAYS = 29
+# Overlap between incremental syncs, to allow for clock differences
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
 
 # Fields to use to get addresses
 ADDRESS_FIELDS = ('Name', 'Street1', 'Street2', 'CityName',
                   'StateOrProvince', 'PostalCode', 'CountryName')
 
+# eBay Pending Order fields set from eBay orders
+ORDER_FIELDS = ('ebay_order_id', 'last_modified', 'created_time',
+                'ebay_site', 'buyer_username', 'shipping_address',
+                'country', 'currency', 'shipping_type', 'shipping_cost',
+                'total_cost')
+# eBay Pending Order Item fields set from eBay transactions
+ITEM_FIELDS = ('item_code', 'qty', 'price', 'ebay_id')
+
+# Standard fields written when inserting rows directly
+STANDARD_FIELDS = ('name', 'creation', 'modified', 'owner', 'modified_by',
+                   'docstatus')
+CHILD_FIELDS = ('parent', 'parentfield', 'parenttype', 'idx')
+
+
 @frappe.whitelist()
 def sync_pending_orders(site_id=None, num_days=None):
     """
@@ -39,6 +59,20 @@ def sync_pending_orders(site_id=None, num_days=None):
         frappe.throw('You do not have permission to access the eBay Manager',
                      frappe.PermissionError)
 
+    with profile_sync('Pending orders'):
+        run_sync_pending_orders(site_id, num_days)
+
+
+def run_sync_pending_orders(site_id, num_days):
+    """Carry out the pending order sync for sync_pending_orders.
+
+    If all sites are being synced, the number of days is not specified
+    and there is a recent watermark, only orders modified since the
+    watermark are fetched (with any OrderStatus, so that orders which are
+    no longer Active can be removed). Otherwise all Active orders in the
+    window are fetched and any other pending orders removed.
+    """
+
     # Prepare parameters
     if site_id is None or int(site_id) == -1:
         ebay_site_name = None
@@ -46,34 +80,104 @@ def sync_pending_orders(site_id=None, num_days=None):
         site_id = int(site_id)
         ebay_site_name = EBAY_TRANSACTION_SITE_IDS[site_id]
 
+    use_watermark = ebay_site_name is None and num_days is None
+
+    pending_sync_days, watermark = frappe.get_value(
+        'eBay Manager Settings', 'eBay Manager Settings',
+        ['ebay_pending_sync_days', 'ebay_pending_sync_watermark'])
     if num_days is None:
-        num_days = int(
-            frappe.get_value('eBay Manager Settings', 'eBay Manager Settings',
-                             'ebay_pending_sync_days')
-        )
+        num_days = int(pending_sync_days)
+    num_days = min(num_days, MAX_DAYS)
+
+    sync_start = datetime.datetime.utcnow()
+    mod_time_from = None
+    if use_watermark and watermark:
+        mod_time_from = (frappe.utils.get_datetime(watermark)
+                         - WATERMARK_OVERLAP)
+        max_range = datetime.timedelta(
+            days=min(num_days, MAX_MOD_TIME_DAYS))
+        if sync_start - mod_time_from > max_range:
+            # Watermark too old; do a full refresh
+            mod_time_from = None
 
     frappe.msgprint('Syncing eBay orders...')
 
-    # Load orders from Ebay (retry up to three times)
-    for i in range(3):
-        try:
+    # Load orders from eBay
+    with stage('get_orders'):
+        if mod_time_from:
+            orders, _ = get_orders(order_status='All',
+                                   mod_time_from=mod_time_from,
+                                   mod_time_to=sync_start)
+        else:
             orders, num_days = get_orders(order_status='Active',
                                           num_days=num_days)
-        except ConnectionError:
-            pass
+
+    with stage('build_pending_orders'):
+        # An incremental sync also returns orders that are no longer
+        # Active; these are only used to remove their pending orders
+        new_orders = build_pending_orders(active_orders(orders),
+                                          ebay_site_name)
+
+    with stage('load_existing_orders'):
+        existing_orders = load_pending_orders(ebay_site_name)
+
+    with stage('diff_orders'):
+        if mod_time_from:
+            # Only orders in this response may have changed, except that
+            # orders not modified within the window have expired
+            changes = diff_pending_orders(
+                existing_orders, new_orders,
+                seen_order_ids={x['OrderID'] for x in orders},
+                expire_before=sync_start - datetime.timedelta(days=num_days))
         else:
-            break
-    else:
-        raise
+            changes = diff_pending_orders(existing_orders, new_orders)
 
-    # Build list of existing eBay Pending Orders
-    existing_order_dict = {
-        x.ebay_order_id: x.name for x in frappe.get_all(
-            'eBay Pending Order',
-            fields=['name', 'ebay_order_id']
-        )
+    with stage('apply_changes'):
+        apply_pending_order_changes(*changes)
+
+    if use_watermark:
+        frappe.db.set_value(
+            'eBay Manager Settings', 'eBay Manager Settings',
+            'ebay_pending_sync_watermark', sync_start, update_modified=False)
+
+    inserts, updates, _, deletes = changes
+    frappe.msgprint(
+        f'Finished: {len(inserts)} new, {len(updates)} updated and '
+        f'{len(deletes)} removed pending orders.')
+
+
+def active_orders(orders):
+    """Return only the orders from GetOrders with OrderStatus Active."""
+    return [x for x in orders if x['OrderStatus'] == 'Active']
+
+
+def build_pending_orders(orders, ebay_site_name=None):
+    """Build a dict of ebay_order_id: pending order dict from the orders
+    returned by GetOrders.
+
+    Each pending order dict has the values of ORDER_FIELDS and a list of
+    item dicts (with the values of ITEM_FIELDS, sorted by item code) in
+    'items'. Orders without any valid items are excluded. If
+    ebay_site_name is set, only orders from that site are included.
+    """
+    # Check all the SKUs in one query (case-insensitively, like the
+    # database)
+    skus = {
+        transaction['Item'].get('SKU', None)
+        for order in orders
+        for transaction in order['TransactionArray']['Transaction']
     }
+    skus.discard(None)
+    if skus:
+        valid_skus = {
+            x.lower() for x, in frappe.db.sql("""
+                SELECT name FROM `tabItem` WHERE name IN %(skus)s;
+                """, {'skus': tuple(skus)})
+        }
+    else:
+        valid_skus = set()
 
+    new_orders = {}
     for order in orders:
         # Identify the eBay site on which the item was listed.
         # Filter if we have a site_id set.
@@ -84,7 +188,6 @@ def sync_pending_orders(site_id=None, num_days=None):
             continue
 
         ebay_order_id = order['OrderID']
-        existing_order = existing_order_dict.get(ebay_order_id, False)
 
         ship_add = order['ShippingAddress']
         shipping = order['ShippingServiceSelected']
@@ -98,9 +201,10 @@ def sync_pending_orders(site_id=None, num_days=None):
 
         # Get shipping strings
         order_site_id = EBAY_TRANSACTION_SITE_NAMES[order_site_name]
-        shipping_strings = (
-            get_shipping_service_descriptions(order_site_id)
-        )
+        with stage('get_shipping_service_descriptions'):
+            shipping_strings = (
+                get_shipping_service_descriptions(order_site_id)
+            )
 
         order_dict = {
             'last_modified': datetime.datetime.strptime(
@@ -124,7 +228,7 @@ def sync_pending_orders(site_id=None, num_days=None):
         transactions = order['TransactionArray']['Transaction']
         for transaction in transactions:
             sku = transaction['Item'].get('SKU', None)
-            if not frappe.db.exists('Item', sku):
+            if sku is None or sku.lower() not in valid_skus:
                 # This is not a valid item code; skip this item
                 continue
             items.append({
@@ -141,48 +245,148 @@ def sync_pending_orders(site_id=None, num_days=None):
         # Sort item codes for later comparisons
         items.sort(key=operator.itemgetter('item_code'))
 
-        if existing_order:
-            # If there is an existing order, see if the quantities or item
-            # codes have changed.
-            existing_doc = frappe.get_doc('eBay Pending Order',
-                                          existing_order)
-            order_details = [(x.item_code, x.qty) for x in existing_doc.items]
-            item_details = [(x['item_code'], x['qty']) for x in items]
-            if order_details == item_details:
-                # The existing orders match. Update any values that
-                # have changed.
-                changed = False
-                for key, value in order_dict.items():
-                    if getattr(existing_doc, key) != value:
-                        setattr(existing_doc, key, value)
-                        changed = True
-                for existing_item, order_item in zip(existing_doc.items, items):
-                    for key, value in order_item.items():
-                        if getattr(existing_item, key) != value:
-                            setattr(existing_item, key, value)
-                            changed = True
-                if changed:
-                    existing_doc.save()
-                # We have dealt with the existing order, so remove it from
-                # the dictionary
-                del existing_order_dict[ebay_order_id]
-            else:
-                # The item codes and quantities do not match
-                # Delete the existing doc
-                frappe.delete_doc('eBay Pending Order', existing_order)
-                del existing_order_dict[ebay_order_id]
-                existing_order = False
-
-        if not existing_order:
-            # Either there was no existing doc, or we deleted/updated it
-            # Create a new eBay Pending Order
-            order_dict['items'] = items
-            order_dict['doctype'] = 'eBay Pending Order'
-            pending_order_doc = frappe.get_doc(order_dict)
-            pending_order_doc.insert()
-
-    # Remove any remaining eBay Pending Order documents
-    for docname in existing_order_dict.values():
-        frappe.delete_doc('eBay Pending Order', docname)
-
-    frappe.msgprint('Finished.')
+        order_dict['items'] = items
+        new_orders[ebay_order_id] = order_dict
+
+    return new_orders
+
+
+def load_pending_orders(ebay_site_name=None):
+    """Load all existing eBay Pending Orders (optionally only those from
+    one eBay site) with their items, in two queries.
+
+    Returns a dict of ebay_order_id: pending order dict, as for
+    build_pending_orders, with the document name in 'name'.
+    """
+    if ebay_site_name:
+        site_condition = 'WHERE po.ebay_site = %(ebay_site)s'
+    else:
+        site_condition = ''
+    values = {'ebay_site': ebay_site_name}
+
+    existing_orders = {}
+    order_fields = ', '.join(f'po.`{x}`' for x in ORDER_FIELDS)
+    for order in frappe.db.sql(f"""
+            SELECT po.name, {order_fields}
+                FROM `tabeBay Pending Order` AS po
+                {site_condition};
+            """, values, as_dict=True):
+        order['items'] = []
+        existing_orders[order.ebay_order_id] = order
+    orders_by_name = {x.name: x for x in existing_orders.values()}
+
+    item_fields = ', '.join(f'poi.`{x}`' for x in ITEM_FIELDS)
+    for item in frappe.db.sql(f"""
+            SELECT poi.parent, {item_fields}
+                FROM `tabeBay Pending Order Item` AS poi
+                JOIN `tabeBay Pending Order` AS po ON po.name = poi.parent
+                {site_condition}
+                {'AND' if site_condition else 'WHERE'}
+                    poi.parenttype = 'eBay Pending Order'
+                ORDER BY poi.parent, poi.idx;
+            """, values, as_dict=True):
+        order = orders_by_name.get(item.pop('parent'))
+        if order is not None:
+            order['items'].append(item)
+
+    return existing_orders
+
+
+def diff_pending_orders(existing_orders, new_orders, seen_order_ids=None,
+                        expire_before=None):
+    """Compare existing and new pending orders.
+
+    By default, existing orders not in new_orders are deleted. If
+    seen_order_ids is given (for an incremental sync), only existing orders
+    in seen_order_ids but not in new_orders are deleted, together with any
+    last modified before expire_before.
+
+    Returns a tuple of:
+      - new orders to insert,
+      - orders to update (new values, with the existing document name),
+      - names of updated orders whose items must be replaced,
+      - names of existing orders to delete.
+    """
+    inserts = []
+    updates = []
+    item_changes = []
+    for ebay_order_id, new_order in new_orders.items():
+        existing_order = existing_orders.get(ebay_order_id)
+        if existing_order is None:
+            inserts.append(new_order)
+            continue
+        items_changed = (
+            len(existing_order['items']) != len(new_order['items'])
+            or any(fields_differ(existing_item, new_item, ITEM_FIELDS)
+                   for existing_item, new_item in zip(
+                        existing_order['items'], new_order['items']))
+        )
+        if items_changed or fields_differ(existing_order, new_order,
+                                          ORDER_FIELDS):
+            new_order['name'] = existing_order['name']
+            updates.append(new_order)
+            if items_changed:
+                item_changes.append(existing_order['name'])
+
+    deletes = []
+    for ebay_order_id, existing_order in existing_orders.items():
+        if ebay_order_id in new_orders:
+            continue
+        if (seen_order_ids is None
+                or ebay_order_id in seen_order_ids
+                or (expire_before and existing_order['last_modified']
+                    and existing_order['last_modified'] < expire_before)):
+            deletes.append(existing_order['name'])
+
+    return inserts, updates, item_changes, deletes
+
+
+def apply_pending_order_changes(inserts, updates, item_changes, deletes):
+    """Apply the changes from diff_pending_orders with bulk SQL.
+
+    New and updated orders are written with a single upsert; the items
+    of new orders and orders with changed items are (re)inserted after
+    deleting any old items.
+    """
+    now = frappe.utils.now_datetime()
+    user = frappe.session.user
+
+    # Delete removed orders and replaced items
+    bulk_delete('tabeBay Pending Order Item', 'parent',
+                deletes + item_changes,
+                extra_conditions={'parenttype': 'eBay Pending Order'})
+    bulk_delete('tabeBay Pending Order', 'name', deletes)
+
+    # Insert or update orders (keeping the creation time and owner of
+    # existing orders)
+    order_rows = [
+        (order.get('name') or order['ebay_order_id'],
+         now, now, user, user, 0)
+        + tuple(order[x] for x in ORDER_FIELDS)
+        for order in inserts + updates
+    ]
+    bulk_insert(
+        'tabeBay Pending Order',
+        STANDARD_FIELDS + ORDER_FIELDS,
+        order_rows,
+        update_fields=('modified', 'modified_by') + ORDER_FIELDS
+    )
+
+    # Insert items for new orders and orders with changed items
+    item_changes = set(item_changes)
+    item_rows = []
+    for order in inserts + updates:
+        parent = order.get('name') or order['ebay_order_id']
+        if 'name' in order and parent not in item_changes:
+            continue
+        for idx, item in enumerate(order['items'], start=1):
+            item_rows.append(
+                (frappe.generate_hash(length=10), now, now, user, user, 0,
+                 parent, 'items', 'eBay Pending Order', idx)
+                + tuple(item[x] for x in ITEM_FIELDS)
+            )
+    bulk_insert(
+        'tabeBay Pending Order Item',
+        STANDARD_FIELDS + CHILD_FIELDS + ITEM_FIELDS,
+        item_rows
+    )
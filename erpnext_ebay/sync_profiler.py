@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Lightweight per-stage profiling for the eBay sync pipelines.
+
+Profiling is switched on by 'Profile sync runs' in eBay Manager Settings.
+Pipelines wrap their work in profile_sync(), and mark stages with the
+stage() context manager or the profile_stage() decorator. For each stage
+the wall time, number of database queries and number of eBay API calls
+are recorded and aggregated over the run. Results (and an optional
+cProfile or pyinstrument capture) are stored on an eBay sync log.
+
+When profiling is switched off, stage() and profile_stage() do nothing.
+"""
+
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+
+import frappe
+
+# Number of lines of cProfile output to store
+CPROFILE_LINES = 60
+
+
+def get_profiler():
+    """Return the active SyncProfiler, or None."""
+    return getattr(frappe.local, 'ebay_sync_profiler', None)
+
+
+def count_api_calls(num_calls=1):
+    """Add to the number of API calls made by the active profiler."""
+    profiler = get_profiler()
+    if profiler is not None:
+        profiler.count_api_calls(num_calls)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager that records a stage in the active profiler."""
+    profiler = get_profiler()
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
+
+
+def profile_stage(name=None):
+    """Decorator that records each call of the function as a stage
+    (by default named after the function).
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def hook_connection(api):
+    """Count the calls made with an ebaysdk connection in the active
+    profiler (if any). Only this connection is affected.
+    """
+    profiler = get_profiler()
+    if profiler is None:
+        return api
+    connection_execute = api.execute
+
+    def execute(*args, **kwargs):
+        profiler.count_api_calls()
+        return connection_execute(*args, **kwargs)
+    api.execute = execute
+    return api
+
+
+def set_sync_log(sync_log):
+    """Set the eBay sync log on which the active profiler saves results."""
+    profiler = get_profiler()
+    if profiler is not None:
+        profiler.sync_log = sync_log
+
+
+@contextlib.contextmanager
+def profile_sync(sync_type, sync_log=None):
+    """Profile a sync run, if profiling is enabled in eBay Manager Settings.
+
+    On exit, results are saved to sync_log (see set_sync_log) or, if no
+    sync log has been set, to a new eBay sync log. If the run raises, its
+    uncommitted writes are rolled back before the results are saved.
+    """
+    enabled, capture = frappe.db.get_value(
+        'eBay Manager Settings', 'eBay Manager Settings',
+        ['ebay_profile_syncs', 'ebay_profile_capture'])
+    if not enabled or get_profiler() is not None:
+        # Profiling off, or this run is already being profiled
+        yield None
+        return
+    profiler = SyncProfiler(sync_type, capture=capture, sync_log=sync_log)
+    profiler.start()
+    try:
+        yield profiler
+    except BaseException:
+        # Don't commit the failed run's writes when saving the results
+        profiler.stop()
+        frappe.db.rollback()
+        profiler.save()
+        raise
+    else:
+        profiler.stop()
+        profiler.save()
+
+
+class SyncProfiler():
+    """Records wall time, database queries and API calls per stage."""
+
+    def __init__(self, sync_type, capture=None, sync_log=None):
+        self.sync_type = sync_type
+        self.capture = capture or None
+        self.sync_log = sync_log
+        self.stages = {}
+        self.queries = 0
+        self.api_calls = 0
+        self.start_time = None
+        self.total_time = None
+        self.capture_output = None
+        self._api_lock = threading.Lock()
+        self._db = None
+        self._capture_profiler = None
+
+    def start(self):
+        """Start profiling and make this the active profiler.
+
+        Trading API calls are counted on connections created while
+        profiling (see hook_connection); REST API calls are counted
+        explicitly. If starting fails, everything is restored.
+        """
+        try:
+            self._start()
+        except BaseException:
+            self._restore()
+            raise
+
+    def _start(self):
+        frappe.local.ebay_sync_profiler = self
+
+        # Count database queries by wrapping frappe.db.sql on this
+        # connection only
+        self._db = frappe.local.db
+        db_sql = self._db.sql
+
+        def sql(*args, **kwargs):
+            self.queries += 1
+            return db_sql(*args, **kwargs)
+        self._db.sql = sql
+
+        if self.capture == 'cProfile':
+            self._capture_profiler = cProfile.Profile()
+            self._capture_profiler.enable()
+        elif self.capture == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                frappe.msgprint('pyinstrument is not installed!')
+            else:
+                self._capture_profiler = Profiler()
+                self._capture_profiler.start()
+
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        """Stop profiling and restore the patched functions."""
+        try:
+            self.total_time = time.perf_counter() - self.start_time
+
+            if self.capture == 'cProfile' and self._capture_profiler:
+                self._capture_profiler.disable()
+                stream = io.StringIO()
+                stats = pstats.Stats(self._capture_profiler, stream=stream)
+                stats.sort_stats('cumulative').print_stats(CPROFILE_LINES)
+                self.capture_output = stream.getvalue()
+            elif self.capture == 'pyinstrument' and self._capture_profiler:
+                self._capture_profiler.stop()
+                self.capture_output = self._capture_profiler.output_text()
+            self._capture_profiler = None
+        finally:
+            self._restore()
+
+    def _restore(self):
+        """Stop any capture profiler, restore frappe.db.sql and clear the
+        active profiler. Safe to call more than once.
+        """
+        if self._capture_profiler is not None:
+            try:
+                if self.capture == 'cProfile':
+                    self._capture_profiler.disable()
+                else:
+                    self._capture_profiler.stop()
+            except Exception:
+                pass
+            self._capture_profiler = None
+        if self._db is not None:
+            vars(self._db).pop('sql', None)
+            self._db = None
+        if get_profiler() is self:
+            frappe.local.ebay_sync_profiler = None
+
+    def count_api_calls(self, num_calls=1):
+        """Add to the number of API calls."""
+        with self._api_lock:
+            self.api_calls += num_calls
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that records the time, database queries and
+        API calls within a stage. Stages may be nested; inner stages are
+        also counted in their outer stages.
+        """
+        start_queries = self.queries
+        start_api_calls = self.api_calls
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(
+                name, {'calls': 0, 'time': 0.0, 'queries': 0, 'api_calls': 0})
+            stats['calls'] += 1
+            stats['time'] += time.perf_counter() - start_time
+            stats['queries'] += self.queries - start_queries
+            stats['api_calls'] += self.api_calls - start_api_calls
+
+    def as_dict(self):
+        """Return the profiling results as a dict."""
+        return {
+            'sync_type': self.sync_type,
+            'total': {'time': self.total_time, 'queries': self.queries,
+                      'api_calls': self.api_calls},
+            'stages': self.stages
+        }
+
+    def save(self):
+        """Save the profiling results to the eBay sync log.
+
+        If the sync log already has results (e.g. from another background
+        job in the same sync) the results are combined. Commits.
+        """
+        results = self.as_dict()
+        capture = self.capture_output
+        if self.sync_log and not frappe.db.sql("""
+                SELECT name FROM `tabeBay sync log` WHERE name = %s FOR UPDATE
+                """, (self.sync_log,)):
+            # The sync log was rolled back with a failed run
+            self.sync_log = None
+        if self.sync_log:
+            old_stats, old_capture = frappe.db.get_value(
+                'eBay sync log', self.sync_log,
+                ['ebay_profile_stats', 'ebay_profile_capture'])
+            if old_stats:
+                results = merge_results(json.loads(old_stats), results)
+            if old_capture and capture:
+                capture = f'{old_capture}\n\n{capture}'
+            frappe.db.set_value('eBay sync log', self.sync_log, {
+                'ebay_sync_type': self.sync_type,
+                'ebay_profile_stats': json.dumps(results, indent=1),
+                'ebay_profile_capture': capture or old_capture
+            }, update_modified=False)
+        else:
+            frappe.get_doc({
+                'doctype': 'eBay sync log',
+                'ebay_sync_datetime': frappe.utils.now_datetime(),
+                'ebay_sync_type': self.sync_type,
+                'ebay_profile_stats': json.dumps(results, indent=1),
+                'ebay_profile_capture': capture
+            }).insert(ignore_permissions=True)
+        frappe.db.commit()
+
+
+def merge_results(results_a, results_b):
+    """Combine two sets of profiling results (as from as_dict)."""
+    merged = {
+        'sync_type': results_a['sync_type'],
+        'total': {k: (results_a['total'][k] or 0) + (results_b['total'][k] or 0)
+                  for k in ('time', 'queries', 'api_calls')},
+        'stages': {}
+    }
+    for results in (results_a, results_b):
+        for name, stats in results['stages'].items():
+            merged_stats = merged['stages'].setdefault(
+                name, {'calls': 0, 'time': 0.0, 'queries': 0, 'api_calls': 0})
+            for key, value in stats.items():
+                merged_stats[key] += value
+    return merged
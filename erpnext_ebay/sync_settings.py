@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Company settings used by the eBay sync modules.
+
+The settings (warehouse, account names, shipping item and VAT rates) all
+depend on the company abbreviation. They are built the first time they are
+needed, rather than at import time, and cached per site. The cache is
+cleared whenever a Company is saved or renamed, or by calling
+clear_sync_settings().
+"""
+
+import frappe
+
+CACHE_KEY = 'erpnext_ebay:sync_settings'
+
+SHIPPING_ITEM = 'ITEM-00358'
+
+# VAT rate for each sales income account (account names without the
+# company abbreviation)
+SALES_VAT_RATES = {
+    'Sales': 0.2,
+    'Sales EU': 0.0,
+    'Sales Non-EU': 0.0
+}
+
+
+class SyncSettings():
+    """Company-dependent names and rates for the sync modules."""
+
+    def __init__(self, company_acronym):
+        self.company_acronym = company_acronym
+        self.warehouse = self.account('Main')
+        self.shipping_item = SHIPPING_ITEM
+        self.cogs_account = self.account('Cost of Goods Sold')
+        self.vat_account = self.account('VAT')
+        self.vat_rates = {
+            self.account(k): v for k, v in SALES_VAT_RATES.items()
+        }
+        self.vat_percent = {k: 100*v for k, v in self.vat_rates.items()}
+        self.domestic_vat = self.vat_rates[self.account('Sales')]
+
+    def __repr__(self):
+        return f'SyncSettings({self.company_acronym!r})'
+
+    def account(self, account_name):
+        """Return the full name of a company account (or warehouse)."""
+        return f'{account_name} - {self.company_acronym}'
+
+
+def load_sync_settings():
+    """Build the sync settings from the database."""
+    company_acronym = frappe.get_all('Company', fields=['abbr'])[0].abbr
+    return SyncSettings(company_acronym)
+
+
+def get_sync_settings():
+    """Return the sync settings for the current site.
+
+    The settings are cached in Redis (per site) and in frappe.local for
+    the current request.
+    """
+    return frappe.cache().get_value(CACHE_KEY, generator=load_sync_settings)
+
+
+def clear_sync_settings(doc=None, method=None):
+    """Clear the cached sync settings for the current site.
+
+    Also used as a Company doc event hook.
+    """
+    frappe.cache().delete_value(CACHE_KEY)
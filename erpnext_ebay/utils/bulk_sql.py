@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Helpers for applying many row changes with multi-row SQL statements.
+
+These write directly to tables and bypass the document model (no
+validation, hooks or version tracking). None of them commit.
+"""
+
+import frappe
+
+# Maximum number of rows per statement
+BATCH_SIZE = 500
+
+
+def batches(seq, batch_size=BATCH_SIZE):
+    """Yield successive slices of seq of length batch_size."""
+    seq = list(seq)
+    for i in range(0, len(seq), batch_size):
+        yield seq[i:i+batch_size]
+
+
+def normalize_value(value):
+    """Normalize a field value for comparison with a value loaded from
+    the database (empty strings are null; floats are rounded).
+    """
+    if value == '':
+        return None
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def fields_differ(existing, new, fields):
+    """Return True if any of the fields differ between two dicts (or
+    documents).
+    """
+    return any(
+        normalize_value(existing.get(x)) != normalize_value(new.get(x))
+        for x in fields
+    )
+
+
+def bulk_insert(table, fields, rows, update_fields=None,
+                batch_size=BATCH_SIZE):
+    """Insert rows into table using multi-row INSERTs.
+
+    Each row is a sequence of values in the same order as fields. If
+    update_fields is supplied, rows whose key already exists have those
+    fields updated instead (INSERT ... ON DUPLICATE KEY UPDATE).
+    """
+    columns = ', '.join(f'`{x}`' for x in fields)
+    row_placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    if update_fields:
+        on_duplicate = 'ON DUPLICATE KEY UPDATE ' + ', '.join(
+            f'`{x}` = VALUES(`{x}`)' for x in update_fields)
+    else:
+        on_duplicate = ''
+    for batch in batches(rows, batch_size):
+        values = [value for row in batch for value in row]
+        placeholders = ', '.join([row_placeholder] * len(batch))
+        frappe.db.sql(f"""
+            INSERT INTO `{table}` ({columns})
+            VALUES {placeholders}
+            {on_duplicate};
+            """, values)
+
+
+def bulk_delete(table, column, keys, extra_conditions=None,
+                batch_size=BATCH_SIZE):
+    """Delete all rows from table where column is one of keys.
+
+    extra_conditions, if supplied, is a dict of column: value that
+    deleted rows must also match.
+    """
+    conditions = ''
+    values = {}
+    for i, (extra_column, value) in enumerate(
+            (extra_conditions or {}).items()):
+        conditions += f' AND `{extra_column}` = %(extra_{i})s'
+        values[f'extra_{i}'] = value
+    for batch in batches(keys, batch_size):
+        values['keys'] = tuple(batch)
+        frappe.db.sql(f"""
+            DELETE FROM `{table}`
+                WHERE `{column}` IN %(keys)s{conditions};
+            """, values)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Redis lease locks, shared by all workers for a site.
+
+A lease lock expires automatically after its lease time, so a crashed
+worker cannot hold it forever. It is only released by its holder.
+"""
+
+import frappe
+
+# Delete the key only if it still holds our token
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Reset the expiry of the key only if it still holds our token
+EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LeaseLock():
+    """A named lock in Redis (per site) with a lease time in seconds."""
+
+    def __init__(self, name, lease):
+        self.name = name
+        self.lease = lease
+        self.token = None
+
+    def __str__(self):
+        return f'LeaseLock {self.name}'
+
+    @property
+    def key(self):
+        return frappe.cache().make_key(f'erpnext_ebay:lock:{self.name}')
+
+    def acquire(self):
+        """Try to acquire the lock without waiting. Returns True on
+        success.
+        """
+        token = frappe.generate_hash(length=20)
+        if frappe.cache().set(self.key, token, ex=self.lease, nx=True):
+            self.token = token
+            return True
+        return False
+
+    def extend(self):
+        """Renew the lease for another lease time, if we still hold the
+        lock. Returns True if the lock is still held.
+        """
+        if self.token is None:
+            return False
+        return bool(frappe.cache().eval(
+            EXTEND_SCRIPT, 1, self.key, self.token, int(self.lease * 1000)))
+
+    def release(self):
+        """Release the lock, if we still hold it."""
+        if self.token is None:
+            return
+        frappe.cache().eval(RELEASE_SCRIPT, 1, self.key, self.token)
+        self.token = None